@@ -2,6 +2,6 @@
 public methods.
 """
 
-from interface import run_scenario, run_multiple_windfields, generate_wind_profiles_from_ncep, generate_hazardmap, contour_hazardmap, join_wind_profiles
+from interface import run_scenario, run_multiple_windfields, run_sampled_scenarios, generate_wind_profiles_from_ncep, generate_hazardmap, update_hazardmap, generate_hazardmap_from_histogram, generate_summary_statistics, generate_site_hazard, contour_hazardmap, join_wind_profiles
 from utilities import get_scenario_parameters
 
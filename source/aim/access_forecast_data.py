@@ -205,21 +205,22 @@ def read_access_file(filename, location=None):
     msg = 'Time vector in ACCESS-R files is assumed to contain one and only one element'
     assert len(time) == 1, msg
 
-    # Extract wind data at that point (for each time step and each level)
-    u = fid.variables['zonal_wnd'][:] # East/west wind velocity component
-    v = fid.variables['merid_wnd'][:] # North/south wind velocity component
-    T = fid.variables['air_temp'][:]  # Temperature
-    z = fid.variables['geop_ht'][:]   # Geopotential height
+    # Extract wind data at that point (for each level). Only the column
+    # at the point is read rather than the whole domain.
+    u = fid.variables['zonal_wnd'][0, :, m, n] # East/west wind velocity component
+    v = fid.variables['merid_wnd'][0, :, m, n] # North/south wind velocity component
+    T = fid.variables['air_temp'][0, :, m, n]  # Temperature
+    z = fid.variables['geop_ht'][0, :, m, n]   # Geopotential height
 
     fid.close()
 
     # Build dataset
     X = []
     for l, _ in enumerate(lvl):
-        altitude = z[0, l, m, n]
-        u_wind = u[0, l, m, n]
-        v_wind = v[0, l, m, n]
-        temperature = T[0, l, m, n] - 273.15 # Konvert from Kelvin to Centigrade
+        altitude = z[l]
+        u_wind = u[l]
+        v_wind = v[l]
+        temperature = T[l] - 273.15 # Konvert from Kelvin to Centigrade
 
         X.append([altitude, u_wind, v_wind, temperature])
 
@@ -0,0 +1,274 @@
+"""Content addressed cache for intermediate Fall3d files
+
+Some Fall3d utilities produce files that depend only on a small part of
+the scenario. For instance the grain size file made by SetGrn depends only
+on the GRANULOMETRY section of the input file, which is typically the same
+for every member of a wind ensemble or a sweep over source parameters.
+
+Such files are stored in the cache under a key computed as a hash of
+exactly the inputs that determine them. A later run with the same inputs
+gets a hard link (or a copy if linking is not possible) to the cached file
+instead of running the utility again.
+
+The cache lives in the directory given by the environment variable
+AIMCACHE and defaults to a subdirectory named cache under TEPHRADATA.
+Set AIMCACHE=off to disable caching.
+
+Each entry is stored with the MD5 checksum of its contents in a file with
+extension .md5. An entry that no longer matches its checksum, e.g. because
+a hard linked output was written to in place, is discarded when fetched.
+
+The total size of the cache is bounded by AIMCACHE_SIZE (in MB, default
+given by cache_size_limit). When an entry is stored the least recently
+used entries are removed until the cache fits.
+"""
+
+import os
+import shutil
+import hashlib
+
+from utilities import get_tephradata, makedir
+from manifest import compute_checksum
+
+cache_dir_name = 'cache'
+checksum_extension = '.md5'
+cache_size_limit = 10000 # MB
+
+# Top level sections of a Fall3d input file as written by AIM.write_input_file
+input_file_sections = ['TIME_UTC', 'GRID', 'GRANULOMETRY', 'SOURCE',
+                       'FALL3D', 'OUTPUT', 'POSTPROCESS']
+
+
+def get_cache_dir():
+    """Determine location of AIM cache
+
+    Return None if caching has been disabled.
+    """
+
+    if 'AIMCACHE' in os.environ:
+        cache_dir = os.environ['AIMCACHE']
+        if cache_dir.lower() in ['off', 'no', 'none', '']:
+            return None
+    else:
+        cache_dir = os.path.join(get_tephradata(), cache_dir_name)
+
+    return cache_dir
+
+
+def get_cache_size_limit():
+    """Determine maximal size of cache in bytes
+    """
+
+    limit = os.environ.get('AIMCACHE_SIZE', cache_size_limit)
+    try:
+        limit = float(limit)
+    except:
+        msg = 'AIMCACHE_SIZE must be a number (MB). I got %s' % str(limit)
+        raise Exception(msg)
+
+    return int(limit*2**20)
+
+
+def compute_key(*items):
+    """Compute cache key from strings
+    """
+
+    m = hashlib.md5()
+    for item in items:
+        m.update(item)
+        m.update('\0') # Separator so that ('ab', 'c') differs from ('a', 'bc')
+
+    return m.hexdigest()
+
+
+def get_input_file_section(inputfile, section):
+    """Return lines of given section of Fall3d input file as one string
+
+    Sub headings such as LON-LAT in the GRID section are not indented in
+    the input file, so only the names in input_file_sections are taken to
+    start a new section.
+    """
+
+    if section not in input_file_sections:
+        msg = 'Unknown section "%s" in Fall3d input file. ' % section
+        msg += 'Options are %s' % input_file_sections
+        raise Exception(msg)
+
+    lines = []
+    current = None
+    fid = open(inputfile)
+    for line in fid.readlines():
+        name = line.strip()
+        if name in input_file_sections:
+            current = name
+            continue
+
+        if current == section and name != '' and not name.startswith('---'):
+            lines.append(name)
+    fid.close()
+
+    if len(lines) == 0:
+        msg = 'Section %s not found in Fall3d input file %s' % (section, inputfile)
+        raise Exception(msg)
+
+    return '\n'.join(lines)
+
+
+def get_cached_filename(category, key, extension=''):
+    """Return name of cache entry or None if caching is disabled
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+
+    return os.path.join(cache_dir, category, key + extension)
+
+
+def read_cached_checksum(filename):
+    """Return checksum recorded for cache entry or None if there is none
+    """
+
+    try:
+        fid = open(filename + checksum_extension)
+        checksum = fid.read().strip()
+        fid.close()
+    except IOError:
+        return None
+
+    return checksum
+
+
+def fetch_from_cache(category, key, target, extension=''):
+    """Make target a link to (or copy of) the cache entry for key
+
+    Entries whose contents do not match their recorded checksum are
+    removed and treated as missing.
+
+    Return True if the entry was found, False otherwise.
+    """
+
+    filename = get_cached_filename(category, key, extension)
+    if filename is None or not os.path.isfile(filename):
+        return False
+
+    checksum = read_cached_checksum(filename)
+    if checksum is not None and compute_checksum(filename) != checksum:
+        print 'WARNING: Cache entry %s is corrupted and will be removed' % filename
+        for name in [filename, filename + checksum_extension]:
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+        return False
+
+    if os.path.exists(target):
+        os.remove(target)
+
+    try:
+        os.link(filename, target)
+    except OSError:
+        # E.g. cache and target are on different file systems
+        try:
+            shutil.copyfile(filename, target)
+        except IOError:
+            # Entry was evicted by another process in the meantime
+            return False
+
+    # Mark entry as recently used
+    try:
+        os.utime(filename, None)
+    except OSError:
+        pass
+
+    return True
+
+
+def store_in_cache(category, key, source, extension=''):
+    """Store copy of source in cache under key
+
+    The file is copied to a temporary name in the cache and then renamed
+    so that concurrent runs never see a partial entry. Cache entries are
+    made read only as they may be hard linked into output directories.
+    """
+
+    filename = get_cached_filename(category, key, extension)
+    if filename is None:
+        return
+
+    tmpname = '%s.%i.tmp' % (filename, os.getpid())
+    try:
+        makedir(os.path.dirname(filename))
+        shutil.copyfile(source, tmpname)
+        os.chmod(tmpname, 0444)
+
+        # Checksum goes first so that every entry has one
+        fid = open(tmpname + checksum_extension, 'w')
+        fid.write(compute_checksum(tmpname) + '\n')
+        fid.close()
+        os.rename(tmpname + checksum_extension, filename + checksum_extension)
+
+        os.rename(tmpname, filename)
+    except (IOError, OSError), e:
+        # A cache that can't be written to should not stop the run
+        print 'WARNING: Could not store %s in cache: %s' % (source, e)
+    else:
+        evict_from_cache()
+
+
+def evict_from_cache(max_size=None):
+    """Remove least recently used entries until cache fits within max_size
+
+    Checksum files count towards the size of their entries and are
+    removed with them.
+
+    Input:
+        max_size: Maximal size of cache in bytes. Default is given by
+                  get_cache_size_limit.
+    """
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None or not os.path.isdir(cache_dir):
+        return
+
+    if max_size is None:
+        max_size = get_cache_size_limit()
+
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for name in filenames:
+            if name.endswith('.tmp') or name.endswith(checksum_extension):
+                # Entry being stored by another process or checksum file
+                continue
+
+            filename = os.path.join(dirpath, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+
+            size = stat.st_size
+            try:
+                size += os.path.getsize(filename + checksum_extension)
+            except OSError:
+                pass
+
+            entries.append((stat.st_mtime, size, filename))
+            total += size
+
+    # Oldest first
+    entries.sort()
+    for _, size, filename in entries:
+        if total <= max_size:
+            break
+
+        try:
+            os.remove(filename)
+        except OSError:
+            continue
+        try:
+            os.remove(filename + checksum_extension)
+        except OSError:
+            pass
+        total -= size
@@ -0,0 +1,342 @@
+"""Catalog of ensemble members for selecting subsets of results
+
+Every Fall3d result file of an ensemble is indexed in an SQLite database
+by its path, member name, wind field, the time of the wind field and the
+scenario parameters it was computed with (e.g. sampled source
+parameters). Subsets such as seasonal ensembles are selected with simple
+queries like
+
+    month in 11..3 and hour == 12 and height_above_vent > 10000
+
+and the resulting list of files is passed straight to the hazard map
+aggregator, so no result files need to be copied.
+
+Conditions are joined by "and". Each condition has the form
+<name> <operator> <value> where the operator is one of ==, !=, <, <=,
+>, >= or in. The value of "in" is either a comma separated list or an
+inclusive range a..b. Ranges of month and hour wrap around, so
+month in 11..3 selects November to March. Names are either those of
+member_columns or parameter names.
+"""
+
+import os
+import re
+import csv
+import sqlite3
+
+from hazard import get_member_timestamp, hazardmap_filename
+from summary import summary_filename
+from manifest import Manifest, manifest_filename
+
+catalog_filename = 'catalog.db'
+member_columns = ['path', 'member', 'windfield', 'year', 'month', 'day', 'hour']
+cyclic_columns = {'month': (1, 12), 'hour': (0, 23)}
+operators = ['==', '!=', '<=', '>=', '<', '>', 'in']
+
+schema = """
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    member TEXT,
+    windfield TEXT,
+    year INTEGER,
+    month INTEGER,
+    day INTEGER,
+    hour INTEGER);
+CREATE TABLE IF NOT EXISTS parameters (
+    member_id INTEGER REFERENCES members(id) ON DELETE CASCADE,
+    name TEXT,
+    value REAL,
+    text TEXT,
+    PRIMARY KEY (member_id, name));
+CREATE INDEX IF NOT EXISTS members_month ON members(month);
+CREATE INDEX IF NOT EXISTS members_hour ON members(hour);
+CREATE INDEX IF NOT EXISTS parameters_name_value ON parameters(name, value);
+"""
+
+
+def parse_value(value):
+    """Convert value to float if possible and to string without quotes otherwise
+    """
+
+    if isinstance(value, (int, long, float)):
+        return float(value)
+
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"':
+            value = value[1:-1]
+        return value
+
+
+def parse_condition(condition):
+    """Split condition into name, operator and value(s)
+
+    For operator 'in' the value is a list of values or, for a range, a
+    tuple (low, high).
+    """
+
+    match = re.match('^\s*([A-Za-z_][A-Za-z0-9_]*)\s*(==|!=|<=|>=|<|>|=|\s+in\s+)\s*(.+?)\s*$',
+                     condition)
+    if match is None:
+        msg = 'Could not parse condition "%s". Expected <name> <operator> <value> ' % condition
+        msg += 'with operator one of %s' % operators
+        raise Exception(msg)
+
+    name, operator, value = match.groups()
+    operator = operator.strip()
+    if operator == '=':
+        operator = '=='
+
+    if operator == 'in':
+        if '..' in value:
+            low, high = value.split('..')
+            value = (parse_value(low), parse_value(high))
+        else:
+            value = [parse_value(x) for x in value.split(',')]
+    else:
+        value = parse_value(value)
+
+    return name, operator, value
+
+
+def compile_condition(name, operator, value):
+    """Translate parsed condition into SQL expression and arguments
+    """
+
+    if name in member_columns:
+        column = name
+        prefix = ''
+        suffix = ''
+        args = []
+    else:
+        # Parameters are stored as numbers or text
+        if isinstance(value, tuple) or isinstance(value, float) or \
+                (isinstance(value, list) and isinstance(value[0], float)):
+            column = 'value'
+        else:
+            column = 'text'
+        prefix = 'EXISTS (SELECT 1 FROM parameters WHERE member_id = members.id AND name = ? AND '
+        suffix = ')'
+        args = [name]
+
+    if operator == 'in' and isinstance(value, tuple):
+        low, high = value
+        if name in cyclic_columns and low > high:
+            # Wrap around, e.g. November to March
+            expression = '(%s >= ? OR %s <= ?)' % (column, column)
+        else:
+            expression = '%s BETWEEN ? AND ?' % column
+        args += [low, high]
+    elif operator == 'in':
+        expression = '%s IN (%s)' % (column, ', '.join(['?']*len(value)))
+        args += value
+    else:
+        sql_operator = {'==': '=', '!=': '<>'}.get(operator, operator)
+        expression = '%s %s ?' % (column, sql_operator)
+        args.append(value)
+
+    return prefix + expression + suffix, args
+
+
+def read_samples(filename):
+    """Read parameters of sampled members from samples.csv
+
+    Return dictionary of parameter dictionaries keyed by member name.
+    """
+
+    samples = {}
+
+    fid = open(filename)
+    reader = csv.reader(fid)
+    names = reader.next()
+    for row in reader:
+        if len(row) != len(names):
+            continue
+        samples[row[0]] = dict(zip(names[1:], row[1:]))
+    fid.close()
+
+    return samples
+
+
+class Catalog:
+
+    def __init__(self, filename):
+        """Open catalog with given filename. It is created if needed.
+        """
+
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.executescript(schema)
+
+    def close(self):
+        """Close database
+        """
+
+        self.connection.close()
+
+    def add(self, path, member=None, windfield=None, parameters=None):
+        """Add result file to catalog, replacing any previous entry
+
+        Input:
+            path: Name of Fall3d result file
+            member: Name of member. Default is the basename of path.
+            windfield: Name of wind field. Default is the name of the
+                       wind_profile parameter if given and the member
+                       name otherwise.
+            parameters: Optional dictionary of scenario parameters. Numbers
+                        and strings are indexed, other values are ignored.
+
+        The time of the wind field is taken from the time stamp YYYYMMDDhh
+        in the member or wind field name if present.
+        """
+
+        path = os.path.abspath(path)
+
+        if member is None:
+            member = os.path.basename(path)
+
+        if parameters is None:
+            parameters = {}
+
+        if windfield is None:
+            if parameters.get('wind_profile'):
+                windfield, _ = os.path.splitext(os.path.basename(parameters['wind_profile']))
+            else:
+                windfield = member
+
+        timestamp = (None, None, None, None)
+        for name in [member, windfield]:
+            try:
+                timestamp = get_member_timestamp(name)
+            except Exception:
+                continue
+            else:
+                break
+
+        cursor = self.connection.cursor()
+        cursor.execute('DELETE FROM members WHERE path = ?', (path,))
+        cursor.execute('INSERT INTO members (path, member, windfield, year, month, day, hour) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (path, member, windfield) + tuple(timestamp))
+        member_id = cursor.lastrowid
+
+        for name, value in parameters.items():
+            if isinstance(value, bool) or not isinstance(value, (int, long, float, str, unicode)):
+                continue
+
+            value = parse_value(value)
+            if isinstance(value, float):
+                cursor.execute('INSERT INTO parameters VALUES (?, ?, ?, NULL)',
+                               (member_id, name, value))
+            else:
+                cursor.execute('INSERT INTO parameters VALUES (?, ?, NULL, ?)',
+                               (member_id, name, value))
+
+        self.connection.commit()
+
+    def index_directory(self, directory, parameters=None, verbose=True):
+        """Add all result files in directory to catalog
+
+        Input:
+            directory: Hazard output folder (see run_multiple_windfields
+                       and run_sampled_scenarios)
+            parameters: Optional dictionary of parameters common to all
+                        members, e.g. those of the scenario
+
+        Member names are taken from the manifest and sampled parameters
+        from samples.csv where these exist.
+
+        Return number of result files indexed.
+        """
+
+        if parameters is None:
+            parameters = {}
+
+        # Member names of result files
+        members = {}
+        manifest = Manifest(os.path.join(directory, manifest_filename))
+        for member, entry in manifest.read().items():
+            if entry['status'] == 'completed' and entry.get('result'):
+                members[entry['result']] = member
+
+        samples = {}
+        samplesfilename = os.path.join(directory, 'samples.csv')
+        if os.path.isfile(samplesfilename):
+            samples = read_samples(samplesfilename)
+
+        count = 0
+        for file in sorted(os.listdir(directory)):
+            if not file.endswith('.nc') or file in [hazardmap_filename,
+                                                    summary_filename]:
+                continue
+
+            member = members.get(file, file)
+            member_parameters = parameters.copy()
+            member_parameters.update(samples.get(member, {}))
+
+            self.add(os.path.join(directory, file), member=member,
+                     parameters=member_parameters)
+            count += 1
+
+        if verbose:
+            print 'Indexed %i result files in %s' % (count, directory)
+
+        return count
+
+    def remove_missing(self):
+        """Remove entries whose result file no longer exists
+
+        Return number of entries removed.
+        """
+
+        missing = [path for path in self.query() if not os.path.isfile(path)]
+        for path in missing:
+            self.connection.execute('DELETE FROM members WHERE path = ?', (path,))
+        self.connection.commit()
+
+        return len(missing)
+
+    def query(self, conditions=None):
+        """Get result files of members satisfying conditions
+
+        Input:
+            conditions: Query string (see module documentation). If None
+                        or empty, all members are returned.
+
+        Return sorted list of paths.
+        """
+
+        sql = 'SELECT path FROM members'
+        args = []
+
+        if conditions:
+            expressions = []
+            for condition in re.split('\s+and\s+', conditions.strip()):
+                expression, condition_args = compile_condition(*parse_condition(condition))
+                expressions.append(expression)
+                args += condition_args
+            sql += ' WHERE ' + ' AND '.join(expressions)
+
+        sql += ' ORDER BY path'
+
+        return [str(row[0]) for row in self.connection.execute(sql, args)]
+
+    def get_parameters(self, path):
+        """Get indexed parameters of result file as dictionary
+        """
+
+        parameters = {}
+        rows = self.connection.execute('SELECT name, value, text FROM parameters '
+                                       'JOIN members ON members.id = parameters.member_id '
+                                       'WHERE path = ?', (os.path.abspath(path),))
+        for name, value, text in rows:
+            if value is None:
+                parameters[str(name)] = text
+            else:
+                parameters[str(name)] = value
+
+        return parameters
@@ -0,0 +1,1361 @@
+"""Probabilistic hazard maps from ensembles of Fall3d results
+
+This is a NumPy implementation of the Fall3d utility HazardMapping.exe
+(see aftermarket_modules/HazardMaps/HazardMaps.f90). Each Fall3d result
+file is read once, one time slice at a time, and the following are
+accumulated for all thresholds at once:
+
+    PLOAD_i:   Percentage of members where the ground load at the last
+               time step is at least load_values[i]
+    ISOCHRO_i: Average time (in hours since the first output) at which the
+               ground load first reaches load_values[i], taken over the
+               members where it does. -1 where it never does.
+    PFLxxx_i:  Percentage of members where the concentration at flight
+               level FLxxx is at least fl_values[i] at some time step
+
+The result is written in the same format as HazardMaps.res.nc produced by
+HazardMapping.exe so it can be contoured with contour_hazardmap.
+
+Since only counts and sums are accumulated, the state of a hazard map can
+be saved (HazardMap.save_state) and loaded again (load_hazardmap_state) to
+add new members or remove old ones without reading the other members.
+
+Optionally, per cell histograms of the final ground load (and, if asked
+for, the peak concentration at each flight level) are accumulated in
+logarithmic bins (see HazardHistogram). They are saved with the state and
+allow exceedance probabilities for thresholds chosen after the fact to be
+computed without reading the members again.
+
+The uncertainty of the probabilities due to the finite number of members
+is quantified with Wilson score intervals (see wilson_interval). If a
+confidence level is given, the largest half width of the intervals and the
+largest change of the probabilities are recorded as members are added, so
+the convergence of the estimate can be judged (HazardMap.convergence).
+
+Members can be given weights, e.g. to make up for wind fields sampled
+unevenly across the year. The counts above are then sums of weights and
+the probabilities are weighted averages.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+import numpy
+
+from Scientific.IO.NetCDF import NetCDFFile
+from parallel import run_in_pool, get_number_of_processes
+from sampling import normal_ppf
+
+hazardmap_filename = 'HazardMaps.res.nc' # Hardwired name as per Fall3d
+hazardmap_state_filename = 'HazardMaps.state.npz'
+flight_levels = ['FL050', 'FL100', 'FL150', 'FL200', 'FL250', 'FL300']
+
+# Global attributes describing the grid
+grid_attributes = {'UTM': ['XMIN', 'YMIN', 'XMAX', 'YMAX'],
+                   'LON-LAT': ['LONMIN', 'LATMIN', 'LONMAX', 'LATMAX']}
+
+# Coordinate variables (west-east, south-north)
+coordinate_variables = {'UTM': ['x', 'y'],
+                        'LON-LAT': ['lon', 'lat']}
+
+
+def wilson_interval(count, N, confidence=0.95):
+    """Wilson score interval for a binomial proportion
+
+    Input:
+        count: Number of successes (array)
+        N: Number of trials
+        confidence: Confidence level, e.g. 0.95
+
+    Return lower and upper bounds of the proportion (between 0 and 1).
+    Unlike the normal approximation, the interval is sensible where
+    count is 0 or N.
+    """
+
+    if not 0 < confidence < 1:
+        msg = 'Confidence level must be between 0 and 1. I got %s' % str(confidence)
+        raise Exception(msg)
+
+    z = float(normal_ppf([(1 + confidence)/2.0])[0])
+    N = float(N)
+    p = numpy.asarray(count, dtype='d')/N
+
+    denominator = 1 + z*z/N
+    centre = (p + z*z/(2*N))/denominator
+    half_width = z*numpy.sqrt(p*(1 - p)/N + z*z/(4*N*N))/denominator
+
+    # Exact bounds at the ends despite rounding
+    lower = numpy.where(p <= 0, 0, numpy.maximum(centre - half_width, 0))
+    upper = numpy.where(p >= 1, 1, numpy.minimum(centre + half_width, 1))
+
+    return lower, upper
+
+
+def read_grid(infile):
+    """Get grid of open Fall3d result file
+
+    Return tuple (grid, x, y) where grid is a dictionary with the
+    coordinate system and its bounding box and x and y are the cell
+    coordinates.
+    """
+
+    coordinates = getattr(infile, 'COORDINATES', 'UTM')
+    if coordinates not in grid_attributes:
+        msg = 'Unknown coordinate system %s in Fall3d result' % coordinates
+        raise Exception(msg)
+
+    xname, yname = coordinate_variables[coordinates]
+
+    grid = {'COORDINATES': coordinates}
+    for name in grid_attributes[coordinates]:
+        grid[name] = float(getattr(infile, name))
+
+    x = numpy.array(infile.variables[xname][:], dtype='d')
+    y = numpy.array(infile.variables[yname][:], dtype='d')
+
+    return grid, x, y
+
+
+def check_grid(infile, filename, grid, x, y):
+    """Verify that open result file is on the given grid (see read_grid)
+    """
+
+    coordinates = getattr(infile, 'COORDINATES', 'UTM')
+    if coordinates != grid['COORDINATES']:
+        msg = 'File %s uses coordinates %s. Expected %s'\
+            % (filename, coordinates, grid['COORDINATES'])
+        raise Exception(msg)
+
+    for name in grid_attributes[coordinates]:
+        value = float(getattr(infile, name))
+        if value != grid[name]:
+            msg = 'Different values for %s in files: %s has %f, expected %f'\
+                % (name, filename, value, grid[name])
+            raise Exception(msg)
+
+    xname, yname = coordinate_variables[coordinates]
+    if (len(infile.variables[xname][:]) != len(x) or
+        len(infile.variables[yname][:]) != len(y)):
+        msg = 'File %s has a different number of grid cells' % filename
+        raise Exception(msg)
+
+
+def write_grid_variables(filename, variables, grid, x, y):
+    """Write 2D variables to NetCDF file in the format of HazardMapping.exe
+
+    Input:
+        filename: Name of NetCDF file
+        variables: Dictionary of tuples (data, description, units, value)
+                   where value is an associated threshold or None
+        grid, x, y: Grid as returned by read_grid
+
+    The file is written under a temporary name and then renamed.
+    """
+
+    coordinates = grid['COORDINATES']
+    xname, yname = coordinate_variables[coordinates]
+
+    tmpname = filename + '.part'
+    outfile = NetCDFFile(tmpname, 'w')
+
+    outfile.createDimension(xname, len(x))
+    outfile.createDimension(yname, len(y))
+    outfile.createDimension('time', 1)
+
+    if coordinates == 'UTM':
+        descriptions = ['UTM. West-East distance', 'UTM. South-North distance']
+        units = ['m', 'm']
+    else:
+        descriptions = ['longitude. East positive', 'latitude. North positive']
+        units = ['degrees_east', 'degrees_north']
+
+    for name, data, description, unit in [(xname, x, descriptions[0], units[0]),
+                                          (yname, y, descriptions[1], units[1])]:
+        var = outfile.createVariable(name, 'f', (name,))
+        var.units = unit
+        var.description = description
+        var[:] = data.astype('f')
+
+    names = variables.keys()
+    names.sort()
+    for name in names:
+        data, description, unit, value = variables[name]
+        var = outfile.createVariable(name, 'f', ('time', yname, xname))
+        var.units = unit
+        var.description = description
+        if value is not None:
+            var.value = numpy.float32(value)
+        var[:] = data[numpy.newaxis, :, :].astype('f')
+
+    outfile.TITLE = 'Fall3d 6.0 results'
+    outfile.COORDINATES = coordinates
+    for name in grid_attributes[coordinates]:
+        setattr(outfile, name, grid[name])
+
+    outfile.close()
+    os.rename(tmpname, filename)
+
+
+# Weighting of members by the time of their wind field
+weighting_methods = ['month', 'hour']
+days_in_month = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+# Default histogram bin edges, 10 bins per decade
+histogram_load_edges = numpy.logspace(-3, 4, 71)   # kg/m^2
+histogram_fl_edges = numpy.logspace(-6, 1, 71)     # g/m^3
+
+
+class HazardHistogram:
+
+    def __init__(self, shape, flight_levels, load_edges=None, fl_edges=None):
+        """Create empty per cell histograms
+
+        Input:
+            shape: Grid shape (ny, nx)
+            flight_levels: List of flight levels to keep histograms of
+                           peak concentration for
+            load_edges: Increasing bin edges for final ground load.
+                        Default is histogram_load_edges.
+            fl_edges: Increasing bin edges for peak concentrations.
+                      Default is histogram_fl_edges.
+
+        Bin 0 holds values below the first edge (including zero), bin i
+        values in [edges[i-1], edges[i]) and the last bin values from
+        the last edge upwards.
+
+        Counts of unweighted members are kept as 16 bit integers, which
+        are widened to 32 bits when more members are added and to single
+        precision floats when a member has a fractional weight.
+        """
+
+        if load_edges is None:
+            load_edges = histogram_load_edges
+        if fl_edges is None:
+            fl_edges = histogram_fl_edges
+
+        self.load_edges = numpy.array(load_edges, dtype='d')
+        self.fl_edges = numpy.array(fl_edges, dtype='d')
+        self.flight_levels = list(flight_levels)
+
+        self.load = numpy.zeros((len(self.load_edges) + 1,) + tuple(shape), dtype='u2')
+        self.fl = {}
+        for fl in self.flight_levels:
+            self.fl[fl] = numpy.zeros((len(self.fl_edges) + 1,) + tuple(shape), dtype='u2')
+
+    def get_total(self):
+        """Return sum of weights added so far
+
+        Every cell has one count per member, so the bins of any cell add
+        up to the total.
+        """
+
+        return self.load.reshape((self.load.shape[0], -1))[:, 0].sum()
+
+    def get_dtype(self, total, weight=0):
+        """Return smallest type holding counts up to total and given weight
+        """
+
+        if self.load.dtype.kind == 'f' or weight != int(weight):
+            return numpy.dtype('f')
+
+        for dtype in ['u2', 'u4']:
+            if total <= numpy.iinfo(dtype).max:
+                return numpy.dtype(dtype)
+
+        return numpy.dtype('f')
+
+    def set_dtype(self, dtype):
+        """Convert counts to given type if different
+        """
+
+        if self.load.dtype == dtype:
+            return
+
+        self.load = self.load.astype(dtype)
+        for fl in self.flight_levels:
+            self.fl[fl] = self.fl[fl].astype(dtype)
+
+    def add_to_bins(self, counts, edges, values, weight):
+        """Add weight to the bin of each cell value
+        """
+
+        index = numpy.searchsorted(edges, numpy.ravel(values), side='right')
+        cells = numpy.arange(index.shape[0])
+
+        # Each cell occurs once so the fancy indexed update is safe
+        counts = counts.reshape((counts.shape[0], -1))
+        if counts.dtype.kind == 'u' and weight < 0:
+            counts[index, cells] -= counts.dtype.type(-weight)
+        else:
+            counts[index, cells] += counts.dtype.type(weight)
+
+    def accumulate(self, final_load, peaks, weight=1):
+        """Add fields of one member with given weight (negative to subtract)
+
+        Input:
+            final_load: Ground load at last time step
+            peaks: Dictionary of peak concentrations for each flight level
+        """
+
+        self.set_dtype(self.get_dtype(self.get_total() + abs(weight), weight))
+
+        self.add_to_bins(self.load, self.load_edges, final_load, weight)
+        for fl in self.flight_levels:
+            self.add_to_bins(self.fl[fl], self.fl_edges, peaks[fl], weight)
+
+    def merge(self, other):
+        """Add counts of another histogram with the same bins
+        """
+
+        if (list(self.load_edges) != list(other.load_edges) or
+            list(self.fl_edges) != list(other.fl_edges) or
+            self.flight_levels != other.flight_levels):
+            msg = 'Histograms with different bins cannot be merged'
+            raise Exception(msg)
+
+        if other.load.dtype.kind == 'f':
+            self.set_dtype(numpy.dtype('f'))
+        else:
+            self.set_dtype(self.get_dtype(self.get_total() + other.get_total()))
+
+        self.load += other.load
+        for fl in self.flight_levels:
+            self.fl[fl] += other.fl[fl]
+
+    def zeros_like(self):
+        """Return empty histogram with the same bins
+        """
+
+        histogram = HazardHistogram(self.load.shape[1:], self.flight_levels,
+                                    load_edges=self.load_edges,
+                                    fl_edges=self.fl_edges)
+        histogram.set_dtype(self.load.dtype)
+
+        return histogram
+
+    def count_exceeding(self, counts, edges, threshold):
+        """Estimate number of members at or above threshold in each cell
+
+        Bins entirely above the threshold are counted in full. The bin
+        containing the threshold is counted in proportion to the part of
+        it above the threshold in logarithmic space, so the error is at
+        most the count of that bin. Thresholds that are bin edges are
+        exact. Thresholds outside the range of the edges give a lower
+        bound.
+        """
+
+        # Threshold lies in bin k
+        k = numpy.searchsorted(edges, threshold, side='right')
+
+        if k > 0 and edges[k-1] == threshold:
+            # Lower edge of bin k so the whole bin counts
+            return counts[k:].sum(axis=0).astype('d')
+
+        count = counts[k+1:].sum(axis=0).astype('d')
+
+        if k == 0 or k == len(edges):
+            # Open ended bins can't be interpolated. This is a lower bound.
+            return count
+
+        fraction = ((numpy.log(edges[k]) - numpy.log(threshold)) /
+                    (numpy.log(edges[k]) - numpy.log(edges[k-1])))
+
+        return count + fraction*counts[k]
+
+    def get_variables(self, load_values, fl_values, total_weight):
+        """Return exceedance probabilities for given thresholds
+
+        Input:
+            load_values, fl_values: Thresholds
+            total_weight: Sum of weights of all members (the number of
+                          members if they are not weighted)
+
+        The dictionary has the same form as HazardMap.get_variables
+        without isochrones.
+        """
+
+        if total_weight <= 0:
+            msg = 'Hazard map has no members'
+            raise Exception(msg)
+
+        N = float(total_weight)
+
+        variables = {}
+        for i, value in enumerate(load_values):
+            count = self.count_exceeding(self.load, self.load_edges, value)
+            variables['PLOAD_%i' % (i+1)] = (100*count/N,
+                                             'Probability for load %i' % (i+1),
+                                             'in %', value)
+
+        for fl in self.flight_levels:
+            for i, value in enumerate(fl_values):
+                count = self.count_exceeding(self.fl[fl], self.fl_edges, value)
+                description = 'Probability for concentration threshold %i' % (i+1)
+                variables['P%s_%i' % (fl, i+1)] = (100*count/N,
+                                                   description,
+                                                   'in %', value)
+
+        return variables
+
+
+class HazardMap:
+
+    def __init__(self, load_values, fl_values=None,
+                 isochrones=True, flight_levels=None, histogram=False,
+                 fl_histogram=False, confidence=None):
+        """Create empty hazard map
+
+        Input:
+            load_values: List of ground load thresholds (kg/m^2)
+            fl_values: List of concentration thresholds (g/m^3) at
+                       flight levels
+            isochrones: If True, compute average arrival times for each
+                        load value
+            flight_levels: List of flight levels, e.g. ['FL050', 'FL100'],
+                           for which to compute exceedance. Default is all
+                           levels present in the first result file if
+                           fl_values are given or fl_histogram is True and
+                           none otherwise.
+            histogram: If True, also accumulate per cell histograms of
+                       final load (see HazardHistogram)
+            fl_histogram: If True, the histograms also cover the peak
+                          concentration at each flight level. Only used
+                          with histogram.
+            confidence: Optional confidence level, e.g. 0.95, at which to
+                        record convergence each time members are added
+                        (see record_convergence)
+        """
+
+        self.load_values = numpy.array(load_values, dtype='d')
+        if fl_values is None:
+            self.fl_values = numpy.zeros(0, dtype='d')
+        else:
+            self.fl_values = numpy.array(fl_values, dtype='d')
+
+        self.isochrones = isochrones
+        self.flight_levels = flight_levels
+        self.use_histogram = histogram
+        self.use_fl_histogram = histogram and fl_histogram
+        self.histogram = None
+
+        # Set when first file is read
+        self.grid = None
+        self.number_of_members = 0
+        self.members = []
+        self.removed = [] # Members taken out again
+        self.weights = {} # Weight of each member
+
+        self.confidence = confidence
+        self.convergence = [] # Rows of (number of members, widths, changes)
+
+    def initialise(self, infile):
+        """Record grid and allocate counters from first result file
+        """
+
+        self.grid, self.x, self.y = read_grid(infile)
+        shape = (len(self.y), len(self.x))
+
+        if self.flight_levels is None:
+            if len(self.fl_values) > 0 or self.use_fl_histogram:
+                self.flight_levels = [fl for fl in flight_levels
+                                      if 'C_' + fl in infile.variables]
+            else:
+                self.flight_levels = []
+
+        nload = len(self.load_values)
+        nfl = len(self.fl_values)
+
+        # Counts are sums of member weights
+        self.pload = numpy.zeros((nload,) + shape, dtype='d')
+        self.isochrone_sum = numpy.zeros((nload,) + shape, dtype='d')
+        self.isochrone_count = numpy.zeros((nload,) + shape, dtype='d')
+        self.pfl = {}
+        for fl in self.flight_levels:
+            self.pfl[fl] = numpy.zeros((nfl,) + shape, dtype='d')
+
+        if self.use_histogram:
+            if self.use_fl_histogram:
+                self.histogram = HazardHistogram(shape, self.flight_levels)
+            else:
+                self.histogram = HazardHistogram(shape, [])
+
+    def read_member(self, filename):
+        """Read contribution of one Fall3d result file
+
+        The file is read one time slice at a time.
+
+        Return tuple (exceeded, arrival, found, fields) where exceeded
+        flags the load thresholds exceeded at the last time step, arrival
+        holds the first arrival times (-1 if never reached), found is a
+        dictionary of flight level exceedance flags and fields is None or,
+        if histograms are kept, the final load and a dictionary of peak
+        concentrations.
+        """
+
+        infile = NetCDFFile(filename)
+
+        if self.grid is None:
+            self.initialise(infile)
+        else:
+            check_grid(infile, filename, self.grid, self.x, self.y)
+
+        load = infile.variables['LOAD']
+        nt = load.shape[0]
+
+        if 'time' in infile.variables:
+            times = numpy.array(infile.variables['time'][:], dtype='d')
+        else:
+            times = numpy.arange(nt, dtype='d')
+
+        for fl in self.flight_levels:
+            if 'C_' + fl not in infile.variables:
+                msg = 'Variable C_%s was not found in file %s' % (fl, filename)
+                raise Exception(msg)
+
+        # Thresholds broadcast against 2D slices
+        cload = self.load_values[:, numpy.newaxis, numpy.newaxis]
+        cfl = self.fl_values[:, numpy.newaxis, numpy.newaxis]
+
+        exceeded = numpy.zeros(self.pload.shape, dtype=bool)
+        arrival = -numpy.ones(self.pload.shape, dtype='d')
+        found = {}
+        peaks = {}
+        for fl in self.flight_levels:
+            found[fl] = numpy.zeros(self.pfl[fl].shape, dtype=bool)
+            peaks[fl] = numpy.zeros(self.pload.shape[1:], dtype='d')
+        final_load = numpy.zeros(self.pload.shape[1:], dtype='d')
+
+        for it in range(nt):
+            field = load[it]
+            exceeded = field >= cload
+
+            if self.isochrones:
+                first = exceeded & (arrival == -1)
+                arrival[first] = times[it] - times[0]
+
+            for fl in self.flight_levels:
+                concentration = infile.variables['C_' + fl][it]
+                found[fl] |= concentration >= cfl
+                if self.histogram is not None and fl in self.histogram.fl:
+                    peaks[fl] = numpy.maximum(peaks[fl], concentration)
+
+            if it == nt - 1:
+                final_load = field
+
+        infile.close()
+
+        if self.histogram is None:
+            fields = None
+        else:
+            fields = (final_load, peaks)
+
+        return exceeded, arrival, found, fields
+
+    def accumulate(self, filename, weight):
+        """Add contribution of result file with given weight
+
+        A negative weight subtracts the contribution.
+        """
+
+        exceeded, arrival, found, fields = self.read_member(filename)
+
+        self.pload += weight*exceeded
+        if fields is not None:
+            final_load, peaks = fields
+            self.histogram.accumulate(final_load, peaks, weight)
+
+        for fl in self.flight_levels:
+            self.pfl[fl] += weight*found[fl]
+
+        if self.isochrones:
+            reached = arrival > -1
+            self.isochrone_sum[reached] += weight*arrival[reached]
+            self.isochrone_count += weight*reached
+
+        if weight > 0:
+            self.number_of_members += 1
+        else:
+            self.number_of_members -= 1
+
+    def add(self, filename, member=None, weight=1.0):
+        """Add Fall3d result file to hazard map
+
+        Input:
+            filename: Fall3d NetCDF result file
+            member: Name identifying the member. Default is the basename
+                    of filename.
+            weight: Positive weight of member in the probabilities
+        """
+
+        if member is None:
+            member = os.path.basename(filename)
+        if member in self.members:
+            msg = 'Member %s is already part of the hazard map' % member
+            raise Exception(msg)
+
+        if not weight > 0:
+            msg = 'Weight of member %s must be positive. I got %s' % (member, str(weight))
+            raise Exception(msg)
+
+        previous = None
+        if self.confidence is not None and self.number_of_members > 0:
+            previous = self.get_probabilities()
+
+        self.accumulate(filename, weight)
+        self.members.append(member)
+        self.weights[member] = weight
+        if member in self.removed:
+            self.removed.remove(member)
+
+        if self.confidence is not None:
+            self.record_convergence(previous)
+
+    def remove(self, filename):
+        """Remove Fall3d result file from hazard map
+
+        The file must still be present and unchanged since it was added
+        as its contribution is read again and subtracted.
+        """
+
+        member = os.path.basename(filename)
+        if member not in self.members:
+            msg = 'Member %s is not part of the hazard map' % member
+            raise Exception(msg)
+
+        self.accumulate(filename, -self.weights[member])
+        self.members.remove(member)
+        del self.weights[member]
+        self.removed.append(member)
+
+    def merge(self, other):
+        """Add counts of another hazard map with different members
+
+        Both hazard maps must use the same thresholds and grid.
+        """
+
+        if other.grid is None:
+            return
+
+        if self.grid is None:
+            self.initialise_from(other)
+        else:
+            if (list(self.load_values) != list(other.load_values) or
+                list(self.fl_values) != list(other.fl_values) or
+                self.isochrones != other.isochrones or
+                self.flight_levels != other.flight_levels):
+                msg = 'Hazard maps with different thresholds cannot be merged'
+                raise Exception(msg)
+
+            if (self.grid != other.grid or len(self.x) != len(other.x) or
+                len(self.y) != len(other.y)):
+                msg = 'Hazard maps on different grids cannot be merged'
+                raise Exception(msg)
+
+            if (self.histogram is None) != (other.histogram is None):
+                msg = 'Hazard maps with and without histograms cannot be merged'
+                raise Exception(msg)
+
+        duplicates = set(self.members) & set(other.members)
+        if duplicates:
+            msg = 'Members %s are part of both hazard maps' % str(list(duplicates))
+            raise Exception(msg)
+
+        previous = None
+        if self.confidence is not None and self.number_of_members > 0:
+            previous = self.get_probabilities()
+
+        self.pload += other.pload
+        self.isochrone_sum += other.isochrone_sum
+        self.isochrone_count += other.isochrone_count
+        for fl in self.flight_levels:
+            self.pfl[fl] += other.pfl[fl]
+        if self.histogram is not None:
+            self.histogram.merge(other.histogram)
+
+        self.number_of_members += other.number_of_members
+        self.members.extend(other.members)
+        self.weights.update(other.weights)
+        for member in other.removed:
+            if member not in self.removed and member not in self.members:
+                self.removed.append(member)
+
+        if self.confidence is not None:
+            if previous is None and other.confidence == self.confidence:
+                # Same members, so the history of other applies
+                self.convergence = list(other.convergence)
+            if previous is not None or len(self.convergence) == 0:
+                # Only the merged block as a whole can be recorded
+                self.record_convergence(previous)
+
+    def initialise_from(self, other):
+        """Take thresholds and grid from another hazard map and zero all counts
+        """
+
+        self.load_values = other.load_values.copy()
+        self.fl_values = other.fl_values.copy()
+        self.isochrones = other.isochrones
+        self.flight_levels = list(other.flight_levels)
+        self.grid = other.grid.copy()
+        self.x = other.x.copy()
+        self.y = other.y.copy()
+
+        self.pload = numpy.zeros(other.pload.shape, dtype='d')
+        self.isochrone_sum = numpy.zeros(other.isochrone_sum.shape, dtype='d')
+        self.isochrone_count = numpy.zeros(other.isochrone_count.shape, dtype='d')
+        self.pfl = {}
+        for fl in self.flight_levels:
+            self.pfl[fl] = numpy.zeros(other.pfl[fl].shape, dtype='d')
+
+        self.use_histogram = other.histogram is not None
+        self.use_fl_histogram = other.use_fl_histogram
+        if self.use_histogram:
+            self.histogram = other.histogram.zeros_like()
+
+    def save_state(self, filename):
+        """Save accumulated counts so that members can be added or removed later
+
+        The state is written as a NumPy .npz file under a temporary name
+        and then renamed.
+        """
+
+        if self.grid is None:
+            msg = 'Hazard map has no members'
+            raise Exception(msg)
+
+        coordinates = self.grid['COORDINATES']
+        arrays = {'load_values': self.load_values,
+                  'fl_values': self.fl_values,
+                  'isochrones': numpy.array(self.isochrones),
+                  'flight_levels': numpy.array(self.flight_levels, dtype='S5'),
+                  'coordinates': numpy.array(coordinates),
+                  'grid': numpy.array([self.grid[name] for name in
+                                       grid_attributes[coordinates]]),
+                  'x': self.x,
+                  'y': self.y,
+                  'members': numpy.array(self.members, dtype='S'),
+                  'weights': numpy.array([self.weights[member] for member in self.members],
+                                         dtype='d'),
+                  'removed': numpy.array(self.removed, dtype='S'),
+                  'pload': self.pload,
+                  'isochrone_sum': self.isochrone_sum,
+                  'isochrone_count': self.isochrone_count}
+        for fl in self.flight_levels:
+            arrays['pfl_' + fl] = self.pfl[fl]
+
+        if self.confidence is not None:
+            arrays['confidence'] = numpy.array(self.confidence, dtype='d')
+
+        if self.convergence:
+            names = sorted(self.convergence[0][1].keys())
+            arrays['convergence_names'] = numpy.array(names, dtype='S')
+            arrays['convergence_members'] = numpy.array([row[0] for row in self.convergence])
+            for i, key in [(1, 'convergence_widths'), (2, 'convergence_changes')]:
+                arrays[key] = numpy.array([[row[i][name] for name in names]
+                                           for row in self.convergence], dtype='d')
+
+        if self.histogram is not None:
+            arrays['histogram_load_edges'] = self.histogram.load_edges
+            arrays['histogram_fl_edges'] = self.histogram.fl_edges
+            arrays['histogram_flight_levels'] = numpy.array(self.histogram.flight_levels,
+                                                            dtype='S5')
+            arrays['histogram_load'] = self.histogram.load
+            for fl in self.histogram.flight_levels:
+                arrays['histogram_' + fl] = self.histogram.fl[fl]
+
+        tmpname = filename + '.part'
+        fid = open(tmpname, 'wb')
+        numpy.savez(fid, **arrays)
+        fid.close()
+        os.rename(tmpname, filename)
+
+    def get_variables(self):
+        """Return dictionary of hazard map variables as 2D arrays
+
+        Each entry is a tuple (data, description, units, value) where
+        value is the associated threshold.
+        """
+
+        if self.number_of_members == 0:
+            msg = 'Hazard map has no members'
+            raise Exception(msg)
+
+        N = self.get_total_weight()
+
+        variables = {}
+        for i, value in enumerate(self.load_values):
+            variables['PLOAD_%i' % (i+1)] = (100*self.pload[i]/N,
+                                             'Probability for load %i' % (i+1),
+                                             'in %', value)
+
+        for fl in self.flight_levels:
+            for i, value in enumerate(self.fl_values):
+                description = 'Probability for concentration threshold %i' % (i+1)
+                variables['P%s_%i' % (fl, i+1)] = (100*self.pfl[fl][i]/N,
+                                                   description,
+                                                   'in %', value)
+
+        if self.isochrones:
+            for i, value in enumerate(self.load_values):
+                count = self.isochrone_count[i]
+                isochrone = -numpy.ones(count.shape, dtype='d')
+                reached = count > 0
+                isochrone[reached] = self.isochrone_sum[i][reached]/count[reached]
+                variables['ISOCHRO_%i' % (i+1)] = (isochrone,
+                                                   'Averaged arrival time for load %i' % (i+1),
+                                                   'in h', value)
+
+        return variables
+
+    def get_total_weight(self):
+        """Return sum of member weights (the number of members by default)
+        """
+
+        return float(sum(self.weights.values()))
+
+    def get_effective_number_of_members(self):
+        """Return Kish's effective sample size of the weighted members
+
+        This equals the number of members if all weights are the same.
+        """
+
+        weights = numpy.array(self.weights.values(), dtype='d')
+
+        return weights.sum()**2/(weights**2).sum()
+
+    def get_counts(self):
+        """Return dictionary of exceedance counts and their thresholds
+
+        Keys are the names of the probability variables, e.g. PLOAD_1.
+        Counts are sums of member weights.
+        """
+
+        counts = {}
+        for i, value in enumerate(self.load_values):
+            counts['PLOAD_%i' % (i+1)] = (self.pload[i], value)
+
+        for fl in self.flight_levels:
+            for i, value in enumerate(self.fl_values):
+                counts['P%s_%i' % (fl, i+1)] = (self.pfl[fl][i], value)
+
+        return counts
+
+    def get_probabilities(self):
+        """Return dictionary of exceedance probabilities (between 0 and 1)
+
+        Keys are the names of the probability variables, e.g. PLOAD_1.
+        """
+
+        W = self.get_total_weight()
+
+        probabilities = {}
+        for name, (count, value) in self.get_counts().items():
+            probabilities[name] = count/W
+
+        return probabilities
+
+    def record_convergence(self, previous=None):
+        """Record convergence of probabilities with the current members
+
+        Input:
+            previous: Optional probabilities before the last members were
+                      added (see get_probabilities)
+
+        A row (number of members, widths, changes) is appended to
+        self.convergence. Widths is a dictionary with the largest half
+        width (in percentage points) over all cells of the confidence
+        bands of each probability variable at level self.confidence.
+        Changes holds the largest change of each probability (in
+        percentage points) since previous, or nan without previous.
+        """
+
+        probabilities = self.get_probabilities()
+        N = self.get_effective_number_of_members()
+
+        widths = {}
+        changes = {}
+        for name, probability in probabilities.items():
+            lower, upper = wilson_interval(probability*N, N, self.confidence)
+            widths[name] = 100*(upper - lower).max()/2
+            if previous is None:
+                changes[name] = numpy.nan
+            else:
+                changes[name] = 100*abs(probability - previous[name]).max()
+
+        self.convergence.append((self.number_of_members, widths, changes))
+
+    def get_confidence_variables(self, confidence=0.95):
+        """Return Wilson confidence bands of exceedance probabilities
+
+        For each probability variable, e.g. PLOAD_1, the dictionary has
+        variables PLOAD_1_LOWER and PLOAD_1_UPPER in the form of
+        get_variables. For weighted members the effective number of
+        members is used.
+        """
+
+        if self.number_of_members == 0:
+            msg = 'Hazard map has no members'
+            raise Exception(msg)
+
+        W = self.get_total_weight()
+        N = self.get_effective_number_of_members()
+
+        variables = {}
+        for name, (count, value) in self.get_counts().items():
+            lower, upper = wilson_interval(count/W*N, N, confidence)
+            for bound, data in [('lower', lower), ('upper', upper)]:
+                description = '%s %g%% confidence bound of %s' % (bound.capitalize(),
+                                                                 100*confidence, name)
+                variables['%s_%s' % (name, bound.upper())] = (100*data,
+                                                              description,
+                                                              'in %', value)
+
+        return variables
+
+    def get_projected_widths(self, member_counts, confidence=0.95):
+        """Predict width of confidence bands for other numbers of members
+
+        Input:
+            member_counts: List of ensemble sizes
+            confidence: Confidence level of the Wilson intervals
+
+        The probabilities estimated from the current members are assumed
+        to hold for every ensemble size and so is the ratio of effective
+        to actual number of members. See self.convergence for the widths
+        actually obtained as members were added.
+
+        Return list of tuples (number of members, widths) where widths is
+        a dictionary with the largest half width (in percentage points)
+        over all cells for each probability variable.
+        """
+
+        if self.number_of_members == 0:
+            msg = 'Hazard map has no members'
+            raise Exception(msg)
+
+        counts = self.get_counts()
+        W = self.get_total_weight()
+        ratio = self.get_effective_number_of_members()/self.number_of_members
+
+        curve = []
+        for N in member_counts:
+            widths = {}
+            for name, (count, value) in counts.items():
+                # Same probability with N members
+                lower, upper = wilson_interval(count/W*N*ratio, N*ratio,
+                                               confidence)
+                widths[name] = 100*(upper - lower).max()/2
+            curve.append((N, widths))
+
+        return curve
+
+    def get_histogram_variables(self, load_values, fl_values=None):
+        """Return exceedance probabilities for any thresholds from histograms
+
+        See HazardHistogram.get_variables.
+        """
+
+        if self.histogram is None:
+            msg = 'Hazard map was computed without histograms'
+            raise Exception(msg)
+
+        if fl_values is None:
+            fl_values = []
+
+        return self.histogram.get_variables(load_values, fl_values,
+                                            self.get_total_weight())
+
+    def write(self, filename, variables=None):
+        """Write hazard map to NetCDF file in the format of HazardMapping.exe
+
+        Input:
+            filename: Name of NetCDF file
+            variables: Optional dictionary of variables as returned by
+                       get_variables (default) or get_histogram_variables
+
+        The file is written under a temporary name and then renamed.
+        """
+
+        if variables is None:
+            variables = self.get_variables()
+
+        write_grid_variables(filename, variables, self.grid, self.x, self.y)
+
+
+def load_hazardmap_state(filename):
+    """Create hazard map from state saved with HazardMap.save_state
+    """
+
+    state = numpy.load(filename)
+
+    hazard_map = HazardMap(state['load_values'],
+                           fl_values=state['fl_values'],
+                           isochrones=bool(state['isochrones']),
+                           flight_levels=[str(fl) for fl in state['flight_levels']])
+
+    coordinates = str(state['coordinates'])
+    hazard_map.grid = {'COORDINATES': coordinates}
+    for name, value in zip(grid_attributes[coordinates], state['grid']):
+        hazard_map.grid[name] = float(value)
+
+    hazard_map.x = state['x']
+    hazard_map.y = state['y']
+
+    if 'confidence' in state.files:
+        hazard_map.confidence = float(state['confidence'])
+    if 'convergence_names' in state.files:
+        names = [str(name) for name in state['convergence_names']]
+        for N, widths, changes in zip(state['convergence_members'],
+                                      state['convergence_widths'],
+                                      state['convergence_changes']):
+            hazard_map.convergence.append((int(N), dict(zip(names, widths)),
+                                           dict(zip(names, changes))))
+    hazard_map.members = [str(member) for member in state['members']]
+    hazard_map.removed = [str(member) for member in state['removed']]
+    hazard_map.number_of_members = len(hazard_map.members)
+    if 'weights' in state.files:
+        weights = state['weights']
+    else:
+        weights = numpy.ones(len(hazard_map.members))
+    for member, weight in zip(hazard_map.members, weights):
+        hazard_map.weights[member] = float(weight)
+
+    # States from before weighting have integer counts
+    hazard_map.pload = state['pload'].astype('d')
+    hazard_map.isochrone_sum = state['isochrone_sum']
+    hazard_map.isochrone_count = state['isochrone_count'].astype('d')
+    hazard_map.pfl = {}
+    for fl in hazard_map.flight_levels:
+        hazard_map.pfl[fl] = state['pfl_' + fl].astype('d')
+
+    if 'histogram_load' in state.files:
+        if 'histogram_flight_levels' in state.files:
+            histogram_flight_levels = [str(fl) for fl in state['histogram_flight_levels']]
+        else:
+            # States from before flight level histograms were optional
+            histogram_flight_levels = hazard_map.flight_levels
+
+        hazard_map.use_histogram = True
+        hazard_map.use_fl_histogram = len(histogram_flight_levels) > 0
+        hazard_map.histogram = HazardHistogram(hazard_map.pload.shape[1:],
+                                               histogram_flight_levels,
+                                               load_edges=state['histogram_load_edges'],
+                                               fl_edges=state['histogram_fl_edges'])
+        hazard_map.histogram.load = state['histogram_load']
+        for fl in histogram_flight_levels:
+            hazard_map.histogram.fl[fl] = state['histogram_' + fl]
+
+    state.close()
+
+    return hazard_map
+
+
+def merge_hazardmap_states(filenames):
+    """Merge hazard map states saved by different processes
+
+    Input:
+        filenames: List of state files written with HazardMap.save_state.
+                   The members of the states must be distinct.
+
+    Return HazardMap instance holding the combined counts.
+    """
+
+    if len(filenames) == 0:
+        msg = 'No hazard map states to merge'
+        raise Exception(msg)
+
+    hazard_map = load_hazardmap_state(filenames[0])
+    for filename in filenames[1:]:
+        hazard_map.merge(load_hazardmap_state(filename))
+
+    return hazard_map
+
+
+def get_member_timestamp(member):
+    """Get time of wind field from name of ensemble member
+
+    The name must contain a time stamp of the form YYYYMMDDhh as in
+    merapi.ncep_2007012506.res.nc.
+
+    Return tuple (year, month, day, hour).
+    """
+
+    match = re.search('(?<![0-9])([0-9]{4})([0-9]{2})([0-9]{2})([0-9]{2})(?![0-9])',
+                      member)
+    if match is None:
+        msg = 'Name of member %s does not contain a time stamp YYYYMMDDhh' % member
+        raise Exception(msg)
+
+    year, month, day, hour = [int(x) for x in match.groups()]
+    if not (1 <= month <= 12 and 1 <= day <= 31 and 0 <= hour <= 23):
+        msg = 'Invalid time stamp in name of member %s' % member
+        raise Exception(msg)
+
+    return year, month, day, hour
+
+
+def get_member_weights(members, method):
+    """Weight members so that each month or hour of day is represented fairly
+
+    Input:
+        members: List of member names containing time stamps (see
+                 get_member_timestamp)
+        method: 'month' to give each calendar month a total weight
+                proportional to its number of days or 'hour' to give each
+                hour of the day present equal total weight
+
+    Within each month or hour, members have equal weights. Weights are
+    scaled so that their mean is one.
+
+    Return dictionary of weights keyed by member.
+    """
+
+    if method not in weighting_methods:
+        msg = 'Unknown weighting method "%s". Options are %s' % (method,
+                                                                weighting_methods)
+        raise Exception(msg)
+
+    strata = {}
+    for member in members:
+        year, month, day, hour = get_member_timestamp(member)
+        if method == 'month':
+            stratum = month
+        else:
+            stratum = hour
+
+        if stratum not in strata:
+            strata[stratum] = []
+        strata[stratum].append(member)
+
+    weights = {}
+    for stratum, stratum_members in strata.items():
+        if method == 'month':
+            # Share of the year. Months without members are left out.
+            share = days_in_month[stratum - 1]
+        else:
+            share = 1.0
+
+        for member in stratum_members:
+            weights[member] = float(share)/len(stratum_members)
+
+    mean = sum(weights.values())/len(weights)
+    for member in weights:
+        weights[member] /= mean
+
+    return weights
+
+
+def read_member_weights(filename):
+    """Read member weights from file
+
+    Each line has the name of a member and its weight separated by a
+    comma, e.g.
+
+    ncep_2007012506, 1.5
+
+    The name is either the name of the result file or one of its fields
+    separated by dots, such as the wind field name. Blank lines and lines
+    starting with # are ignored.
+
+    Return dictionary of weights keyed by name.
+    """
+
+    weights = {}
+
+    fid = open(filename)
+    for i, line in enumerate(fid.readlines()):
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        fields = line.split(',')
+        try:
+            weights[fields[0].strip()] = float(fields[1])
+        except (IndexError, ValueError):
+            msg = 'Line %i in %s must have a member name and a weight. I got "%s"'\
+                % (i+1, filename, line)
+            raise Exception(msg)
+    fid.close()
+
+    return weights
+
+
+def get_weight(weights, filename):
+    """Look up weight of result file
+
+    Input:
+        weights: Dictionary of weights or None for equal weights
+        filename: Name of result file. The weight may be given for its
+                  basename or any field of it separated by dots.
+    """
+
+    if weights is None:
+        return 1.0
+
+    member = os.path.basename(filename)
+    if member in weights:
+        return weights[member]
+
+    for field in member.split('.'):
+        if field in weights:
+            return weights[field]
+
+    msg = 'No weight given for member %s' % member
+    raise Exception(msg)
+
+
+def get_flight_levels(filename):
+    """Get flight levels with concentrations in Fall3d result file
+    """
+
+    infile = NetCDFFile(filename)
+    levels = [fl for fl in flight_levels if 'C_' + fl in infile.variables]
+    infile.close()
+
+    return levels
+
+
+def partition_files(filenames, number_of_partitions):
+    """Split files into partitions of about equal total size
+
+    Files are assigned largest first to the partition with the smallest
+    total so far. The order of files within each partition is preserved.
+    """
+
+    sizes = {}
+    for filename in filenames:
+        sizes[filename] = os.path.getsize(filename)
+
+    partitions = [[] for i in range(number_of_partitions)]
+    totals = [0]*number_of_partitions
+    for filename in sorted(filenames, key=lambda x: sizes[x], reverse=True):
+        i = totals.index(min(totals))
+        partitions[i].append(filename)
+        totals[i] += sizes[filename]
+
+    order = {}
+    for i, filename in enumerate(filenames):
+        order[filename] = i
+    for partition in partitions:
+        partition.sort(key=lambda x: order[x])
+
+    return [partition for partition in partitions if partition]
+
+
+def _compute_partial_hazardmap(job):
+    """Compute hazard map for one partition of files (for use in a pool)
+
+    The counts are saved to the state file given in the job rather than
+    returned, so they are not pickled back to the parent process.
+
+    Return name of state file and number of members.
+    """
+
+    (filenames, load_values, fl_values, isochrones, flight_levels,
+     histogram, fl_histogram, confidence, weights, statefilename) = job
+
+    hazard_map = HazardMap(load_values, fl_values=fl_values,
+                           isochrones=isochrones,
+                           flight_levels=flight_levels,
+                           histogram=histogram,
+                           fl_histogram=fl_histogram,
+                           confidence=confidence)
+    for filename in filenames:
+        hazard_map.add(filename, weight=get_weight(weights, filename))
+    hazard_map.save_state(statefilename)
+
+    return statefilename, hazard_map.number_of_members
+
+
+def compute_hazardmap(filenames, load_values, fl_values=None,
+                      isochrones=True, flight_levels=None, histogram=False,
+                      fl_histogram=False, confidence=None, weights=None,
+                      outputfilename=None, statefilename=None,
+                      number_of_processes=1, verbose=True):
+    """Compute hazard map from list of Fall3d result files
+
+    Input:
+        filenames: List of Fall3d NetCDF result files
+        load_values, fl_values, isochrones, flight_levels, histogram,
+        fl_histogram, confidence: See HazardMap
+        weights: Optional dictionary of member weights keyed by the
+                 basenames of filenames (see get_member_weights). Default
+                 is equal weights.
+        outputfilename: Optional name of NetCDF file to write the result to
+        statefilename: Optional name of file to save the accumulated state to
+        number_of_processes: Number of local processes reading files.
+                             If None, AIM_NUMBER_OF_PROCESSES or the number
+                             of processors on this machine is used.
+
+    With more than one process the files are partitioned by size across a
+    pool of processes, each computing the counts for its partition and
+    saving them to a temporary state file. The partial states are merged
+    one at a time as they become available. Convergence is then recorded
+    for each member of the first partition and after each further merge.
+
+    Return HazardMap instance.
+    """
+
+    number_of_processes = get_number_of_processes(number_of_processes)
+    number_of_processes = min(number_of_processes, len(filenames))
+
+    if number_of_processes > 1:
+        if flight_levels is None:
+            # All partitions must agree on the flight levels
+            if ((fl_values is not None and len(fl_values) > 0) or
+                (histogram and fl_histogram)):
+                flight_levels = get_flight_levels(filenames[0])
+            else:
+                flight_levels = []
+
+        partitions = partition_files(filenames, number_of_processes)
+        tmpdir = tempfile.mkdtemp()
+        jobs = [(partition, load_values, fl_values, isochrones, flight_levels,
+                 histogram, fl_histogram, confidence, weights,
+                 os.path.join(tmpdir, 'P%i.state.npz' % i))
+                for i, partition in enumerate(partitions)]
+
+        if verbose:
+            print 'Reading %i files in %i partitions' % (len(filenames),
+                                                         len(partitions))
+
+        hazard_map = None
+        try:
+            count = 0
+            for partial_statefilename, number_of_members in \
+                    run_in_pool(_compute_partial_hazardmap, jobs,
+                                number_of_processes=number_of_processes):
+                partial = load_hazardmap_state(partial_statefilename)
+                os.remove(partial_statefilename)
+                if hazard_map is None:
+                    hazard_map = partial
+                else:
+                    hazard_map.merge(partial)
+
+                count += 1
+                if verbose:
+                    print 'Partition of %i files done (%i of %i)' % (number_of_members,
+                                                                   count,
+                                                                   len(partitions))
+        finally:
+            shutil.rmtree(tmpdir)
+    else:
+        hazard_map = HazardMap(load_values, fl_values=fl_values,
+                               isochrones=isochrones,
+                               flight_levels=flight_levels,
+                               histogram=histogram,
+                               fl_histogram=fl_histogram,
+                               confidence=confidence)
+
+        for i, filename in enumerate(filenames):
+            if verbose:
+                print 'Reading %s (%i of %i)' % (filename, i+1, len(filenames))
+            hazard_map.add(filename, weight=get_weight(weights, filename))
+
+    if outputfilename is not None:
+        hazard_map.write(outputfilename)
+
+    if statefilename is not None:
+        hazard_map.save_state(statefilename)
+
+    return hazard_map
@@ -77,16 +77,31 @@ variable 'eruption_comment' and use that.
 """
 
 import os, sys, time, string
+import logging
+import itertools
+import csv
 import numpy
 
 from config import tephra_output_dir
 from utilities import get_scenario_parameters, header, run, makedir, get_eruptiontime_from_windfield, get_layers_from_windfield, get_fall3d_home, get_timestamp
+from utilities import get_temporal_parameters_from_windfield
 from utilities import list_to_string, nc2asc
 from utilities import generate_contours as _generate_contours
 from utilities import build_output_dir
 from wrapper import AIM
 from coordinate_transforms import UTMtoLL, redfearn
 from logmodule import start_logging
+from parallel import get_backend, get_number_of_processes, run_in_pool
+from parallel import run_pypar_master, run_pypar_worker
+from manifest import Manifest, manifest_filename, compute_checksum, compute_input_checksum
+from stages import stages, run_stages, get_sweep_rounds
+from sampling import draw_samples
+from hazard import HazardMap, compute_hazardmap, load_hazardmap_state, merge_hazardmap_states
+from hazard import hazardmap_filename, hazardmap_state_filename
+from hazard import weighting_methods, get_member_weights, read_member_weights, get_weight
+from summary import compute_summary, summary_filename
+from catalog import Catalog, catalog_filename
+from sites import compute_site_hazard, site_hazard_basename
 
 DEFAULT_SCENARIO_NAME = 'no_name'
 
@@ -94,6 +109,8 @@ def run_scenario(scenario,
                  dircomment=None,
                  store_locally=False,
                  timestamp_output=True,
+                 incremental=False,
+                 number_of_processes=1,
                  verbose=True):
     """Run volcanic ash impact scenario
 
@@ -113,9 +130,19 @@ def run_scenario(scenario,
       store_locally: if True, don't use TEPHRAHOME for outputs
       timestamp_output: If True, add timestamp to output dir
                         If False overwrite previous output with same name
+      incremental: If True, reuse previous output with same name and only
+                   rerun the stages whose inputs have changed (see stages.py).
+                   This implies timestamp_output=False.
+      number_of_processes: Number of local processes used if parameters
+                           are given as tuples (see run_parameter_sweep).
+                           Default is 1, i.e. combinations are run one
+                           after the other.
 
     """
 
+    if incremental:
+        timestamp_output = False
+
     if isinstance(scenario, dict):
         # Establish scenario name is it is given as a dictionary
         if 'scenario_name' in scenario:
@@ -167,7 +194,8 @@ def run_scenario(scenario,
                                       scenario_name=scenario_name,
                                       dircomment=dircomment,
                                       store_locally=store_locally,
-                                      timestamp_output=timestamp_output)
+                                      timestamp_output=timestamp_output,
+                                      clean=not incremental)
 
         logdir = os.path.join(output_dir, 'logs')
         makedir(logdir)
@@ -179,6 +207,8 @@ def run_scenario(scenario,
                             timestamp_output=timestamp_output,
                             store_locally=store_locally,
                             output_dir=output_dir,
+                            incremental=incremental,
+                            number_of_processes=number_of_processes,
                             verbose=verbose)
 
         # Return aim object in case further processing is needed
@@ -190,6 +220,10 @@ def _run_scenario(scenario, dircomment=None,
                   store_locally=False,
                   timestamp_output=True,
                   output_dir=None,
+                  results_only=False,
+                  resultfile=None,
+                  incremental=False,
+                  number_of_processes=1,
                   verbose=True):
     """Run volcanic ash impact scenario
 
@@ -209,9 +243,19 @@ def _run_scenario(scenario, dircomment=None,
       store_locally: if True, don't use TEPHRAHOME for outputs
       timestamp_output: If True, add timestamp to output dir
                         If False overwrite previous output with same name
-
-
-
+      results_only: If True, stop after Fall3d has produced the NetCDF
+                    result file. No audit trail, ASCII grids or contours
+                    are generated.
+      resultfile: Optional name of Fall3d result file (without the .nc
+                  that Fall3d adds). Default is <output_dir>/<scenario_name>.res
+      incremental: Passed on to run_scenario for each combination of
+                   tuple valued parameters.
+      number_of_processes: Number of local processes used for running
+                           combinations of tuple valued parameters
+                           (see run_parameter_sweep)
+
+    Stages are run through run_stages so that stages whose inputs are
+    unchanged since a previous run in the same output directory are skipped.
     """
 
     t_start = time.time()
@@ -224,19 +268,14 @@ def _run_scenario(scenario, dircomment=None,
     # Determine if any of the parameters provide are a tuple
     # in which case each combination is run separately
     for name in params:
-        p = params[name]
-        if type(p) is tuple:
-            # Unpack tuple and run scenario for each parameter value
-            # This recursion will continue until no parameters
-            # have tuples as values
-            params_unpacked = params.copy()
-            for value in p:
-                params_unpacked[name] = value
-                aim = run_scenario(params_unpacked, dircomment=dircomment + '_%s_%s' % (name, value),
-                                   store_locally=store_locally,
-                                   timestamp_output=timestamp_output,
-                                   verbose=verbose)
-
+        if type(params[name]) is tuple:
+            run_parameter_sweep(params, dircomment=dircomment,
+                                store_locally=store_locally,
+                                timestamp_output=timestamp_output,
+                                incremental=incremental,
+                                number_of_processes=number_of_processes,
+                                output_dir=output_dir,
+                                verbose=verbose)
             return
 
     # Instantiate model object
@@ -245,35 +284,31 @@ def _run_scenario(scenario, dircomment=None,
               store_locally=store_locally,
               timestamp_output=timestamp_output,
               output_dir=output_dir,
+              resultfile=resultfile,
               verbose=verbose)
 
     if not aim.postprocessing:
         # Store scenario script, input data files and
         # actual parameters to provide a complete audit trail
-        aim.store_inputdata(verbose=verbose)
+        if not results_only:
+            aim.store_inputdata(verbose=verbose)
 
         # Generate input file for Fall3d-6
         aim.write_input_file(verbose=verbose)
 
-        # Generate input data files in Fall3D format
-        aim.generate_topography(verbose=verbose)
-
-        # Run scripts for Fall3d
-        aim.set_granum(verbose=verbose)
-        aim.set_database(verbose=verbose)
-        aim.set_source(verbose=verbose)
-        aim.run_fall3d(verbose=verbose)
+        # Generate topography, run scripts for Fall3d and
+        # AIM post processing as needed
+        names = [stage['name'] for stage in stages]
+        if results_only:
+            names.remove('postprocess')
+        run_stages(aim, names=names, verbose=verbose)
+    elif not results_only:
+        # AIM post processing only
+        aim.postprocess(verbose=verbose)
 
     # Fall3d postprocessing nc2grd
     #aim.nc2grd()
 
-    # AIM post processing
-    aim.convert_ncgrids_to_asciigrids(verbose=verbose)
-    #aim.convert_surfergrids_to_asciigrids()
-    aim.generate_contours(verbose=verbose)
-
-    aim.organise_output()
-
     # Done
     if verbose:
         header('Simulation finished in %.2f seconds, output data are in %s'
@@ -301,6 +336,184 @@ def _run_scenario(scenario, dircomment=None,
 
 
 
+#-----------------------
+# Parameter sweeps
+#-----------------------
+
+sweep_manifest_filename = 'sweep.jsonl'
+
+def get_parameter_sweep(params):
+    """Generate all combinations of tuple valued parameters
+
+    Input:
+        params: Dictionary of scenario parameters
+
+    Return list of names of the tuple valued parameters and a function
+    which when called returns a fresh generator of (values, params) with
+    one entry for each combination. Combinations are generated lazily.
+    """
+
+    names = [name for name in params if type(params[name]) is tuple]
+    names.sort()
+
+    def combinations():
+        for values in itertools.product(*[params[name] for name in names]):
+            params_unpacked = params.copy()
+            for name, value in zip(names, values):
+                params_unpacked[name] = value
+            yield values, params_unpacked
+
+    return names, combinations
+
+
+def _reset_logging():
+    """Remove log handlers inherited by a pool worker
+
+    Each member of a sweep run in a pool worker then logs to its own
+    output directory (see start_logging).
+    """
+
+    logging.getLogger().handlers = []
+
+
+def _run_sweep_member(job):
+    """Run one combination of a parameter sweep and report outcome
+
+    Input:
+        job: Tuple of (params, dircomment, store_locally, timestamp_output,
+             incremental, verbose)
+    """
+
+    params, dircomment, store_locally, timestamp_output, incremental, verbose = job
+
+    t_start = time.time()
+    outcome = {'dircomment': dircomment,
+               'output_dir': None,
+               'error': None}
+    try:
+        aim = run_scenario(params, dircomment=dircomment,
+                           store_locally=store_locally,
+                           timestamp_output=timestamp_output,
+                           incremental=incremental,
+                           verbose=verbose)
+        outcome['output_dir'] = aim.output_dir
+    except Exception, e:
+        outcome['error'] = str(e)
+
+    outcome['seconds'] = time.time() - t_start
+    return outcome
+
+
+def run_parameter_sweep(params, dircomment=None,
+                        store_locally=False,
+                        timestamp_output=True,
+                        incremental=False,
+                        number_of_processes=1,
+                        output_dir=None,
+                        verbose=True):
+    """Run scenario for every combination of tuple valued parameters
+
+    Input:
+        params: Dictionary of scenario parameters where one or more
+                parameters are tuples, e.g. maximum_grainsize = (3,4,5).
+                wind_profile must be a file (or a tuple of files) as
+                directories of wind fields are not supported.
+        dircomment: Base comment for output directories. Each combination
+                    adds _<name>_<value> for every tuple valued parameter.
+        store_locally, timestamp_output, incremental: See run_scenario
+        number_of_processes: Size of local process pool. Default is 1,
+                             i.e. combinations are run one after the other.
+                             Use None for AIM_NUMBER_OF_PROCESSES or the
+                             number of processors (see get_number_of_processes).
+        output_dir: Optional directory in which to record a summary of
+                    the sweep (sweep.jsonl)
+
+    Combinations are run in rounds. The first rounds run the combinations
+    that need a grain size file or a meteorological database not made by
+    an earlier combination, so each of these is computed once and cached
+    (see cache.py). No two combinations in the same round share SetGrn or
+    SetDbs inputs (see get_upstream_key), so the same file is never made
+    concurrently. The last round runs the remaining combinations which
+    then reuse the cached files.
+
+    Return list of outcomes, one dictionary for each combination.
+    """
+
+    if dircomment is None:
+        dircomment = params['eruption_comment']
+
+    names, combinations = get_parameter_sweep(params)
+    number_of_processes = get_number_of_processes(number_of_processes)
+
+    if output_dir is None:
+        manifest = None
+    else:
+        manifest = Manifest(os.path.join(output_dir, sweep_manifest_filename))
+
+    for values, params_unpacked in combinations():
+        wind_profile = params_unpacked['wind_profile']
+        if os.path.isdir(wind_profile):
+            # The members of a sweep are single scenarios whose upstream
+            # inputs are identified by the name of one wind profile
+            msg = 'Wind profile %s is a directory. Parameter sweeps require ' % wind_profile
+            msg += 'wind_profile to be a single file (or a tuple of files). '
+            msg += 'Use run_multiple_windfields for each combination instead.'
+            raise Exception(msg)
+
+    # Combinations making the same SetGrn or SetDbs files run in different rounds
+    rounds = get_sweep_rounds([p for _, p in combinations()], names)
+    number_of_rounds = max(rounds) + 1
+
+    def jobs(r):
+        for i, (values, params_unpacked) in enumerate(combinations()):
+            if rounds[i] == r:
+                comment = dircomment
+                for name, value in zip(names, values):
+                    comment += '_%s_%s' % (name, value)
+                yield (params_unpacked, comment, store_locally,
+                       timestamp_output, incremental, verbose)
+
+    if verbose:
+        header('Running parameter sweep over %s using %i processes'
+               % (', '.join(names), number_of_processes))
+
+    outcomes = []
+    for r in range(number_of_rounds):
+        if number_of_processes > 1:
+            results = run_in_pool(_run_sweep_member, jobs(r),
+                                  number_of_processes=number_of_processes,
+                                  initializer=_reset_logging)
+        else:
+            results = (_run_sweep_member(job) for job in jobs(r))
+
+        for outcome in results:
+            outcomes.append(outcome)
+            if manifest is not None:
+                if outcome['error'] is None:
+                    manifest.record(outcome['dircomment'], 'completed',
+                                    output_dir=outcome['output_dir'],
+                                    seconds=outcome['seconds'])
+                else:
+                    manifest.record(outcome['dircomment'], 'failed',
+                                    error=outcome['error'],
+                                    seconds=outcome['seconds'])
+
+    # Summary
+    failures = [x for x in outcomes if x['error'] is not None]
+    header('Parameter sweep finished: %i of %i combinations completed'
+           % (len(outcomes) - len(failures), len(outcomes)))
+    for outcome in outcomes:
+        if outcome['error'] is None:
+            print '  %s: %.2f seconds, output in %s' % (outcome['dircomment'],
+                                                       outcome['seconds'],
+                                                       outcome['output_dir'])
+    for outcome in failures:
+        print '  %s FAILED: %s' % (outcome['dircomment'], outcome['error'])
+
+    return outcomes
+
+
+
 def run_nc2prof(windfield_directory, verbose=True):
     """Run nc2prof - extract wind profiles from NCEP data
 
@@ -325,7 +538,7 @@ def run_nc2prof(windfield_directory, verbose=True):
 
     cmd = 'cd %s; %s ' % (windfield_directory, executable)
 
-    logfile = 'run_nc2prof.log'
+    logfile = os.path.join(windfield_directory, 'run_nc2prof.log')
     run(cmd, verbose=verbose, stdout=logfile, stderr='/dev/null')
 
 
@@ -348,7 +561,7 @@ def run_hazardmap(model_output_directory, verbose=True):
 
     cmd = 'cd %s; %s ' % (model_output_directory, executable)
 
-    logfile = 'run_hazardmapping.log'
+    logfile = os.path.join(model_output_directory, 'run_hazardmapping.log')
     run(cmd, verbose=verbose, stdout=logfile, stderr='/dev/null')
 
 
@@ -598,10 +811,420 @@ def generate_wind_profiles_from_ncep(scenario, update_timeblocks=False, verbose=
 # Parallel computing and hazard maps
 #-----------------------------------
 
+def get_windfields(windfield_directory, longest_first=False):
+    """Get list of Fall3d wind profiles in windfield_directory
+
+    Only files with extension .profile are returned and they are sorted
+    by name so that all processors agree on the order.
+
+    If longest_first is True, wind fields are instead ordered by their
+    expected run time with the most expensive first (see
+    estimate_windfield_cost). Scheduling long jobs first reduces the time
+    processors spend idle at the end of an ensemble.
+    """
+
+    windfields = []
+    for file in os.listdir(windfield_directory):
+        if file.endswith('.profile'):
+            windfields.append(os.path.join(windfield_directory, file))
+
+    windfields.sort()
+
+    if longest_first:
+        costs = {}
+        for windfield in windfields:
+            costs[windfield] = estimate_windfield_cost(windfield)
+
+        # Stable sort keeps name order among equally expensive wind fields
+        windfields.sort(key=lambda x: costs[x], reverse=True)
+
+    return windfields
+
+
+def estimate_windfield_cost(windfield):
+    """Estimate relative cost of running a scenario with given wind field
+
+    The estimate is the time span covered by the wind profile (seconds)
+    followed by the length of the profile (number of lines) as a tie
+    breaker. Only the ordering of estimates is meaningful.
+    """
+
+    _, _, _, start_time, end_time, _ = get_temporal_parameters_from_windfield(windfield)
+
+    fid = open(windfield)
+    number_of_lines = len(fid.readlines())
+    fid.close()
+
+    return end_time - start_time, number_of_lines
+
+
+def _run_windfield(params, windfield, i, p, hazard_output_folder,
+                   dircomment, results_only=True, membername=None,
+                   hazard_params=None, keep_result=True,
+                   verbose=True):
+    """Run one member of a multiple wind field ensemble
+
+    The result file is stored in hazard_output_folder as
+    <scenario>.<membername>.res.nc and all other outputs are removed.
+    The member name defaults to the name of the wind field.
+    The result is first written under a temporary name and then renamed
+    so that a result file in hazard_output_folder is always complete.
+
+    If results_only is True, the scenario stops after Fall3d and Fall3d
+    writes its result directly into hazard_output_folder. Otherwise the
+    full post processing is done and the result is copied from the
+    scenario output directory.
+
+    If hazard_params (parameters of a hazard map scenario) are given, the
+    result is added to the hazard map state of this process (see
+    _aggregate_member). In that case the result file is deleted afterwards
+    unless keep_result is True.
+
+    Return dictionary with keys
+        member: Name of member
+        error: None if successful, otherwise the error message
+        result: Name of result file in hazard_output_folder or None if
+                it was not kept
+        checksum: MD5 checksum of result file
+        aggregated: True if result was added to hazard map state
+    """
+
+    windname, _ = os.path.splitext(os.path.split(windfield)[-1])
+    if membername is None:
+        membername = windname
+    header('Computing event %i on processor %i using wind field: %s' % (i, p, windfield))
+
+    outcome = {'member': membername,
+               'error': None,
+               'result': None,
+               'checksum': None,
+               'aggregated': False}
+
+    # Override or create parameters derived from native Fall3d wind field
+    params = params.copy()
+    params['wind_profile'] = windfield
+    params['wind_altitudes'] = get_layers_from_windfield(windfield) # FIXME: Try to comment this out.
+    params['Meteorological_model'] = 'profile'
+
+    newname = params['scenario_name'] + '.%s.res.nc' % membername # Name after wind file by default
+
+    if results_only:
+        # Let Fall3d write into a staging area next to the final result
+        partial_dir = os.path.join(hazard_output_folder, 'partial')
+        makedir(partial_dir)
+        resultfile = os.path.join(partial_dir, newname[:-3]) # Fall3d adds .nc
+        tmpname = resultfile + '.nc'
+    else:
+        resultfile = None
+        tmpname = os.path.join(hazard_output_folder, newname + '.part')
+
+    try:
+        # Run scenario
+        aim = _run_scenario(params,
+                            timestamp_output=True,
+                            dircomment=dircomment + '_run%i_proc%i' % (i, p),
+                            results_only=results_only,
+                            resultfile=resultfile,
+                            verbose=verbose)
+
+        if not results_only:
+            # Copy result file to output folder
+            result_file = aim.scenario_name + '.res.nc'
+            s = 'cp %s/%s %s' % (aim.output_dir, result_file, tmpname)
+            run(s)
+
+        # Make sure result can be shared by group
+        s = 'chmod g+w %s' % tmpname
+        run(s)
+
+        _store_member_result(hazard_params, tmpname, newname,
+                             hazard_output_folder, p, keep_result, outcome)
+    except Exception, e:
+        print 'P%i: Wind field %s failed: %s' % (p, windfield, e)
+        outcome['error'] = str(e)
+        return outcome
+
+    # Clean up outputs from this scenario
+    print 'P%i: Cleaning up %s' % (p, aim.output_dir)
+    s = '/bin/rm -rf %s' % aim.output_dir
+    run(s)
+
+    return outcome
+
+
+def _store_member_result(hazard_params, tmpname, member, hazard_output_folder,
+                         p, keep_result, outcome):
+    """Aggregate result of one ensemble member and move it into place
+
+    Input:
+        hazard_params: Parameters of hazard map scenario or None
+        tmpname: Temporary name of result file
+        member: Name of member (and of result file in hazard_output_folder)
+        hazard_output_folder: Folder with results and hazard map states
+        p: Processor number
+        keep_result: If True, the result file is kept after aggregation
+        outcome: Dictionary updated with keys aggregated, result and checksum
+                 (see _run_windfield)
+
+    Once the member is in the saved hazard map state it is counted, so a
+    later failure to keep its result file only gives a warning. Reporting
+    the member as failed would run it again on resume and count it twice.
+    """
+
+    if hazard_params is not None:
+        _aggregate_member(hazard_params, tmpname, member,
+                          hazard_output_folder, p)
+        outcome['aggregated'] = True
+
+    try:
+        if keep_result or hazard_params is None:
+            outcome['checksum'] = compute_checksum(tmpname)
+            os.rename(tmpname, os.path.join(hazard_output_folder, member))
+            outcome['result'] = member
+        else:
+            os.remove(tmpname)
+    except Exception, e:
+        if not outcome['aggregated']:
+            raise
+
+        print 'WARNING: P%i: %s was added to hazard map but its result was not kept: %s' % (p, member, e)
+        outcome['result'] = None
+        outcome['checksum'] = None
+
+
+def _run_windfield_job(job, p=None):
+    """Run one ensemble member given as a job tuple (see _run_windfield)
+
+    If processor number p is not given, the process id is used.
+    """
+
+    params, windfield, i, hazard_output_folder, dircomment, results_only, hazard_params, keep_result, verbose = job
+
+    if p is None:
+        p = os.getpid()
+
+    return _run_windfield(params, windfield, i, p,
+                          hazard_output_folder, dircomment,
+                          results_only=results_only,
+                          hazard_params=hazard_params,
+                          keep_result=keep_result,
+                          verbose=verbose)
+
+
+# Hazard map state of each worker process, keyed by state file name
+_worker_hazardmaps = {}
+
+def get_worker_statefilename(hazard_output_folder, p):
+    """Name of hazard map state file for processor p
+    """
+
+    return os.path.join(hazard_output_folder, 'partial',
+                        'HazardMaps.P%i.state.npz' % p)
+
+
+def _aggregate_member(hazard_params, filename, member, hazard_output_folder, p):
+    """Add result of one ensemble member to the hazard map of this process
+
+    The hazard map is kept in memory between members and saved after each
+    one so that the counts survive if the process is interrupted.
+    """
+
+    statefilename = get_worker_statefilename(hazard_output_folder, p)
+
+    if statefilename not in _worker_hazardmaps:
+        if os.path.isfile(statefilename):
+            # Continue from a previous run of this processor
+            hazard_map = load_hazardmap_state(statefilename)
+        else:
+            hazard_map = HazardMap(hazard_params['load_values'],
+                                   fl_values=hazard_params['fl_values'],
+                                   confidence=hazard_params.get('hazard_confidence'))
+        _worker_hazardmaps[statefilename] = hazard_map
+
+    hazard_map = _worker_hazardmaps[statefilename]
+    hazard_map.add(filename, member=member,
+                   weight=get_weight(hazard_params.get('member_weights'), member))
+    try:
+        hazard_map.save_state(statefilename)
+    except:
+        # Member is not in the saved state. Start again from that state.
+        del _worker_hazardmaps[statefilename]
+        raise
+
+
+def get_hazardmap_statefilenames(hazard_output_folder):
+    """Get hazard map state files in hazard_output_folder
+
+    The merged state HazardMaps.state.npz comes first if present,
+    followed by the worker states in subfolder partial.
+    """
+
+    partial_dir = os.path.join(hazard_output_folder, 'partial')
+    statefilenames = []
+    if os.path.isdir(partial_dir):
+        for file in os.listdir(partial_dir):
+            if file.startswith('HazardMaps.P') and file.endswith('.state.npz'):
+                statefilenames.append(os.path.join(partial_dir, file))
+    statefilenames.sort()
+
+    statefilename = os.path.join(hazard_output_folder, hazardmap_state_filename)
+    if os.path.isfile(statefilename):
+        statefilenames.insert(0, statefilename)
+
+    return statefilenames
+
+
+def get_aggregated_members(hazard_output_folder):
+    """Get names of members in the hazard map states in hazard_output_folder
+    """
+
+    members = []
+    for statefilename in get_hazardmap_statefilenames(hazard_output_folder):
+        state = numpy.load(statefilename)
+        members.extend([str(member) for member in state['members']])
+        state.close()
+
+    return members
+
+
+def _recover_aggregated_member(manifest, windname, member, input_checksum,
+                               hazard_output_folder, aggregated_members,
+                               keep_result, records=None):
+    """Record member as completed if it was aggregated before an interruption
+
+    A worker saves its hazard map state before the manifest records the
+    member as completed. If the run was interrupted in between, or the
+    member was recorded as failed after it had been added to the state,
+    the member is already counted and must not be run again. Its result
+    file is moved into place if it was kept.
+
+    Input:
+        manifest: Manifest of hazard_output_folder
+        windname: Name of member in the manifest
+        member: Name of member in the hazard map states
+        input_checksum: Checksum of the inputs of the member
+        hazard_output_folder: Folder with results and hazard map states
+        aggregated_members: Members of the hazard map states
+                            (see get_aggregated_members)
+        keep_result: If True, the result file is kept
+        records: Optional records read from manifest
+
+    Return True if the member was recorded as completed.
+    """
+
+    if records is None:
+        records = manifest.read()
+
+    entry = records.get(windname)
+    if (member not in aggregated_members or entry is None or
+        entry['status'] not in ['queued', 'failed'] or
+        entry.get('input') != input_checksum):
+        return False
+
+    resultfile = os.path.join(hazard_output_folder, member)
+    tmpnames = [os.path.join(hazard_output_folder, 'partial', member),
+                resultfile + '.part']
+
+    if keep_result and not os.path.isfile(resultfile):
+        for tmpname in tmpnames:
+            if os.path.isfile(tmpname):
+                os.rename(tmpname, resultfile)
+                break
+
+    for tmpname in tmpnames:
+        if os.path.isfile(tmpname):
+            os.remove(tmpname)
+
+    if keep_result and os.path.isfile(resultfile):
+        manifest.record(windname, 'completed',
+                        input=input_checksum,
+                        result=member,
+                        checksum=compute_checksum(resultfile),
+                        aggregated=True)
+    else:
+        manifest.record(windname, 'completed',
+                        input=input_checksum,
+                        result=None,
+                        checksum=None,
+                        aggregated=True)
+
+    return True
+
+
+def _merge_worker_hazardmaps(hazard_params, hazard_output_folder, manifest,
+                             verbose=True):
+    """Combine hazard map states of all workers into one hazard map
+
+    The states are merged with any previously merged state in
+    hazard_output_folder. Completed members whose result file is present
+    but which are not part of any state (e.g. from a run without
+    aggregation that was resumed) are read and added.
+
+    HazardMaps.res.nc and HazardMaps.state.npz are written to
+    hazard_output_folder and the worker states are removed.
+    """
+
+    statefilenames = get_hazardmap_statefilenames(hazard_output_folder)
+    statefilename = os.path.join(hazard_output_folder, hazardmap_state_filename)
+
+    if statefilenames:
+        hazard_map = merge_hazardmap_states(statefilenames)
+    else:
+        hazard_map = HazardMap(hazard_params['load_values'],
+                               fl_values=hazard_params['fl_values'],
+                               confidence=hazard_params.get('hazard_confidence'))
+
+    records = manifest.read()
+    for windname in sorted(records.keys()):
+        entry = records[windname]
+        result = entry.get('result')
+        if (entry['status'] == 'completed' and result is not None and
+            result not in hazard_map.members and
+            os.path.isfile(os.path.join(hazard_output_folder, result))):
+            if verbose:
+                print 'Adding %s to hazard map' % result
+            hazard_map.add(os.path.join(hazard_output_folder, result),
+                           weight=get_weight(hazard_params.get('member_weights'),
+                                             result))
+
+    if hazard_map.number_of_members == 0:
+        print 'WARNING: No members to generate hazard map from'
+        return
+
+    write_hazardmap(hazard_map, hazard_params, hazard_output_folder)
+    hazard_map.save_state(statefilename)
+
+    for filename in statefilenames:
+        if filename != statefilename:
+            os.remove(filename)
+    _worker_hazardmaps.clear()
+
+    print 'Hazard map of %i members done in directory: %s' % (hazard_map.number_of_members,
+                                                             hazard_output_folder)
+
+
+def _start_worker_logging(logdir):
+    """Direct output from a local worker process to its own log file
+    """
+
+    # Discard log handlers inherited from the parent process
+    logging.getLogger().handlers = []
+
+    AIM_logfile = os.path.join(logdir, 'P%i.log' % os.getpid())
+    start_logging(filename=AIM_logfile, echo=False, verbose=False)
+
+
 def run_multiple_windfields(scenario,
                             windfield_directory=None,
                             hazard_output_folder=None,
                             dircomment=None,
+                            backend=None,
+                            number_of_processes=None,
+                            longest_first=False,
+                            resume=False,
+                            results_only=True,
+                            hazard_scenario=None,
+                            keep_results=True,
                             echo=False,
                             verbose=True):
     """Run volcanic ash impact model for multiple wind fields.
@@ -609,18 +1232,54 @@ def run_multiple_windfields(scenario,
     The wind fields are assumed to be in subfolder specified by windfield_directory,
     have the extension *.profile and follow the format use with scenarios.
 
-    This function makes use of Open MPI and Pypar to execute in parallel but can also run sequentially.
+    Optional parameters:
+      backend: How to execute the ensemble. One of
+               'pypar':           Distribute wind fields across MPI processes.
+                                  Processor 0 hands out the next wind field
+                                  whenever a worker finishes.
+               'multiprocessing': Distribute wind fields across a pool of
+                                  local processes
+               'serial':          Run one wind field after the other
+               If None, the environment variable AIM_PARALLEL_BACKEND is used
+               if set. Otherwise pypar is used if available.
+      number_of_processes: Size of local pool for the multiprocessing backend.
+               If None, AIM_NUMBER_OF_PROCESSES or the number of processors
+               on this machine is used.
+      longest_first: If True, run the wind fields expected to take longest
+               first (see estimate_windfield_cost).
+      resume: If True, skip wind fields that the manifest in
+               hazard_output_folder records as completed with the same
+               inputs and an intact result file. All other wind fields
+               (including those interrupted or failed) are run again,
+               except those already added to a hazard map state.
+               hazard_output_folder must be given explicitly for this to
+               pick up a previous run.
+      results_only: If True (default), each scenario stops after Fall3d
+               and writes its NetCDF result directly into
+               hazard_output_folder. If False, the full post processing
+               (ASCII grids, contours) is done for each wind field before
+               the result is copied.
+      hazard_scenario: Optional hazard map script or dictionary (see
+               templates/create_hazard_map.py). If given, each process adds
+               its results to a hazard map using load_values, fl_values and
+               hazard_weights from this scenario as soon as Fall3d
+               finishes, and the hazard map HazardMaps.res.nc is written
+               to hazard_output_folder when the last wind field completes.
+      keep_results: If False, the result of each wind field is deleted
+               once it has been added to the hazard map. Only used with
+               hazard_scenario.
+
+    The result for each wind field is stored in hazard_output_folder as
+    <scenario>.<windname>.res.nc together with the projection file
+    HazardMaps.res.prj. The status of each wind field is recorded in the
+    manifest file manifest.jsonl in the same folder.
     """
 
-    try:
+    backend = get_backend(backend)
+
+    if backend == 'pypar':
         import pypar
-    except:
-        P = 1
-        p = 0
-        processor_name = os.uname()[1]
 
-        print 'Pypar could not be imported. Running sequentially on node %s' % processor_name,
-    else:
         time.sleep(1)
         P = pypar.size()
         p = pypar.rank()
@@ -629,7 +1288,26 @@ def run_multiple_windfields(scenario,
         print 'Processor %d initialised on node %s' % (p, processor_name)
 
         pypar.barrier()
+    else:
+        P = 1
+        p = 0
+        processor_name = os.uname()[1]
 
+        if backend == 'serial':
+            print 'Running sequentially on node %s' % processor_name
+
+    params = get_scenario_parameters(scenario)
+
+    if hazard_scenario is None:
+        hazard_params = None
+    else:
+        hazard_params = get_scenario_parameters(hazard_scenario)
+
+    if dircomment is None:
+        dircomment = params['eruption_comment']
+
+    if hazard_output_folder is None:
+        hazard_output_folder = params['scenario_name'] + '_hazard_outputs'
 
     if p == 0:
 
@@ -644,123 +1322,743 @@ def run_multiple_windfields(scenario,
 
         t_start = time.time()
 
-        # Communicate hazard output directory name to all nodes to ensure they have exactly the same time stamp.
-        for i in range(P):
-            pypar.send((hazard_output_folder), i)
+        # Make sure folder can be shared by group
+        s = 'chmod -R g+w %s' % hazard_output_folder
+        run(s)
+
+        # Create projectionfile in hazard output
+        basename, _ = os.path.splitext(params['topography_grid'])
+        s = 'cp %s %s/%s' % (basename + '.prj', hazard_output_folder, 'HazardMaps.res.prj')
+        run(s)
+
+        if backend == 'pypar':
+            # Communicate hazard output directory name to all nodes to ensure they have exactly the same time stamp.
+            for i in range(1, P):
+                pypar.send((hazard_output_folder), i)
     else:
         # Receive correctly timestamped output directory names
         hazard_output_folder = pypar.receive(0)
         logdir = os.path.join(hazard_output_folder, 'logs')
 
+    if backend == 'pypar':
+        # Wait until log dir has been created
+        pypar.barrier()
 
-    try:
-        name = os.path.splitext(scenario)[0]
-    except:
-        name = 'run'
-
-
-    # Wait until log dir has been created
-    pypar.barrier()
-
-    params = get_scenario_parameters(scenario)
+    if backend == 'multiprocessing':
+        number_of_processes = get_number_of_processes(number_of_processes)
+        print '     Local pool of %i processes on node %s' % (number_of_processes, processor_name)
+    else:
+        # Start processes staggered to avoid race conditions for disk access (otherwise it is slow to get started)
+        time.sleep(2*p)
 
-    # Start processes staggered to avoid race conditions for disk access (otherwise it is slow to get started)
-    time.sleep(2*p)
+        s = 'Proc %i' % p
+        print '     %s -' % string.ljust(s, 8),
 
     # Logging
-    s = 'Proc %i' % p
-    print '     %s -' % string.ljust(s, 8),
     AIM_logfile = os.path.join(logdir, 'P%i.log' % p)
-    start_logging(filename=AIM_logfile, echo=False)
+    start_logging(filename=AIM_logfile, echo=echo)
 
     # Get cracking
-    basename, _ = os.path.splitext(scenario)
+    failures = []
     count_local = 0
-    count_all = 0
-    for i, file in enumerate(os.listdir(windfield_directory)):
+    if p == 0:
+        windfields = get_windfields(windfield_directory,
+                                    longest_first=longest_first)
+
+        manifest = Manifest(os.path.join(hazard_output_folder, manifest_filename))
+        records = manifest.read()
+
+        if hazard_params is not None:
+            # Weights are fixed up front from the names of all members
+            members = []
+            for windfield in windfields:
+                windname, _ = os.path.splitext(os.path.split(windfield)[-1])
+                members.append(params['scenario_name'] + '.%s.res.nc' % windname)
+
+            hazard_params = hazard_params.copy()
+            hazard_params['member_weights'] = get_hazard_weights(hazard_params, members,
+                                                                 hazard_output_folder)
+
+        if hazard_params is not None and not resume:
+            # Don't mix in members of a previous run
+            for filename in [os.path.join(hazard_output_folder, hazardmap_state_filename)]:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+            partial_dir = os.path.join(hazard_output_folder, 'partial')
+            if os.path.isdir(partial_dir):
+                for file in os.listdir(partial_dir):
+                    if file.endswith('.state.npz'):
+                        os.remove(os.path.join(partial_dir, file))
+
+        aggregated_members = []
+        if hazard_params is not None and resume:
+            aggregated_members = get_aggregated_members(hazard_output_folder)
+
+        jobs = []
+        input_checksums = {}
+        for i, windfield in enumerate(windfields):
+            windname, _ = os.path.splitext(os.path.split(windfield)[-1])
+            input_checksums[windname] = compute_input_checksum(params, [windfield])
+
+            if resume and manifest.is_complete(windname,
+                                               input_checksums[windname],
+                                               hazard_output_folder,
+                                               records=records):
+                print 'Wind field %s already completed - skipping' % windname
+                continue
 
-        count_all += 1
+            member = params['scenario_name'] + '.%s.res.nc' % windname
+            if resume and _recover_aggregated_member(manifest, windname, member,
+                                                     input_checksums[windname],
+                                                     hazard_output_folder,
+                                                     aggregated_members,
+                                                     keep_results,
+                                                     records=records):
+                print 'Wind field %s already added to hazard map - skipping' % windname
+                continue
 
-        # Distribute jobs cyclically to processors
-        if i%P == p:
+            manifest.record(windname, 'queued', input=input_checksums[windname])
+            jobs.append((params, windfield, i, hazard_output_folder, dircomment, results_only,
+                         hazard_params, keep_results, verbose))
 
-            if not file.endswith('.profile'):
-                continue
+        if resume:
+            print 'Resuming ensemble: %i of %i wind fields remaining' % (len(jobs), len(windfields))
 
+        if backend == 'multiprocessing':
+            results = run_in_pool(_run_windfield_job, jobs,
+                                  number_of_processes=number_of_processes,
+                                  initializer=_start_worker_logging,
+                                  initargs=(logdir,))
+        elif P > 1:
+            results = run_pypar_master(jobs)
+        else:
+            results = (_run_windfield_job(job, p) for job in jobs)
+
+        for outcome in results:
+            windname = outcome['member']
             count_local += 1
+            print 'Finished wind field %s (%i of %i)' % (windname, count_local, len(jobs))
+
+            if outcome['error'] is None:
+                manifest.record(windname, 'completed',
+                                input=input_checksums[windname],
+                                result=outcome['result'],
+                                checksum=outcome['checksum'],
+                                aggregated=outcome['aggregated'])
+            else:
+                manifest.record(windname, 'failed',
+                                input=input_checksums[windname],
+                                error=outcome['error'])
+                failures.append((windname, outcome['error']))
+    else:
+        count_local = run_pypar_worker(lambda job: _run_windfield_job(job, p))
 
-            windfield = '%s/%s' % (windfield_directory, file)
-            windname, _ = os.path.splitext(file)
-            header('Computing event %i on processor %i using wind field: %s' % (i, p, windfield))
+    print 'Processor %i done %i windfields' % (p, count_local)
+    for windname, error in failures:
+        print 'WARNING: Wind field %s failed: %s' % (windname, error)
+    print 'Outputs available in directory: %s' % hazard_output_folder
 
+    if backend == 'pypar':
+        pypar.barrier()
 
+    if p == 0:
+        if hazard_params is not None:
+            _merge_worker_hazardmaps(hazard_params, hazard_output_folder,
+                                     manifest, verbose=verbose)
 
-            if dircomment is None:
-                dircomment = params['eruption_comment']
+        print 'Parallel simulation finished %i windfields in %i seconds' % (len(windfields), time.time() - t_start)
 
-            # Override or create parameters derived from native Fall3d wind field
-            params['wind_profile'] = windfield
-            params['wind_altitudes'] = get_layers_from_windfield(windfield) # FIXME: Try to comment this out.
-            params['Meteorological_model'] = 'profile'
+    if backend == 'pypar':
+        pypar.finalize()
 
-            if hazard_output_folder is None:
-                hazard_output_folder = basename + '_hazard_outputs'
 
-            if p == 0:
-                print 'Storing multiple outputs in directory: %s' % hazard_output_folder
 
-            # Run scenario
-            aim = _run_scenario(params,
-                                timestamp_output=True,
-                                dircomment=dircomment + '_run%i_proc%i' % (i, p))
 
-            # Make sure folder is present and can be shared by group
-            makedir(hazard_output_folder)
-            s = 'chmod -R g+w %s' % hazard_output_folder
-            run(s)
+def _run_sample_job(job):
+    """Run one member of a sampled ensemble given as a job tuple
 
-            # Copy result file to output folder
-            result_file = aim.scenario_name + '.res.nc'
-            newname = aim.scenario_name + '.%s.res.nc' % windname # Name after wind file
-            s = 'cp %s/%s %s/%s' % (aim.output_dir, result_file, hazard_output_folder, newname)
-            run(s)
+    See run_sampled_scenarios and _run_windfield.
+    """
 
-            # Create projectionfile in hazard output
-            if i == 0:
-                s = 'cp %s %s/%s' % (aim.projection_file, hazard_output_folder, 'HazardMaps.res.prj')
-                run(s)
+    params, windfield, i, hazard_output_folder, dircomment, membername, verbose = job
+
+    return _run_windfield(params, windfield, i, os.getpid(),
+                          hazard_output_folder, dircomment,
+                          results_only=True,
+                          membername=membername,
+                          verbose=verbose)
+
+
+def run_sampled_scenarios(scenario,
+                          number_of_samples=None,
+                          distributions=None,
+                          method='lhs',
+                          seed=None,
+                          windfield_directory=None,
+                          hazard_output_folder=None,
+                          dircomment=None,
+                          number_of_processes=None,
+                          resume=False,
+                          verbose=True):
+    """Run ensemble of scenarios with randomly sampled parameters
+
+    Input:
+        scenario: Scenario script or dictionary with the fixed parameters
+        number_of_samples: Number of scenarios to run. Default is the
+                           scenario parameter number_of_samples.
+        distributions: Dictionary of parameter names and distributions
+                       (see sampling.py). Default is the scenario parameter
+                       sampling_distributions.
+        method: 'lhs' for Latin hypercube sampling (default) or 'random'
+        seed: Optional seed making the samples reproducible. A seed is
+              needed for resume to pick up the same samples.
+        windfield_directory: Optional directory of .profile wind fields.
+                             If given, each sample uses a wind field chosen
+                             at random from this directory. Otherwise the
+                             wind_profile of the scenario is used.
+        hazard_output_folder: Where results are stored. Default is
+                              <scenario_name>_hazard_outputs
+        number_of_processes: Size of local process pool
+                             (see get_number_of_processes)
+        resume: If True, skip samples recorded as completed in the manifest
+
+    Samples are run in parallel in a local process pool. As with
+    run_multiple_windfields each result is stored in hazard_output_folder
+    as <scenario>.sampleNNNN.res.nc along with HazardMaps.res.prj so the
+    folder can be used directly as model_output_directory for
+    generate_hazardmap. The sampled values are listed in samples.csv and
+    the status of each sample in manifest.jsonl in the same folder.
+
+    Return list of outcomes, one dictionary for each sample run.
+    """
 
-            # Clean up outputs from this scenario
-            print 'P%i: Cleaning up %s' % (p, aim.output_dir)
-            s = '/bin/rm -rf %s' % aim.output_dir
-            run(s)
+    params = get_scenario_parameters(scenario).copy()
 
-    print 'Processor %i done %i windfields' % (p, count_local)
+    if distributions is None:
+        if 'sampling_distributions' not in params:
+            msg = 'Distributions must be given either as an argument or as '
+            msg += 'the parameter sampling_distributions in the scenario'
+            raise Exception(msg)
+        distributions = params['sampling_distributions']
+    distributions = distributions.copy()
+
+    if number_of_samples is None:
+        if 'number_of_samples' not in params:
+            msg = 'Number of samples must be given either as an argument or as '
+            msg += 'the parameter number_of_samples in the scenario'
+            raise Exception(msg)
+        number_of_samples = params['number_of_samples']
+
+    # Sampling parameters are not model parameters
+    for name in ['sampling_distributions', 'number_of_samples']:
+        if name in params:
+            params.pop(name)
+
+    if dircomment is None:
+        dircomment = params['eruption_comment']
+
+    if hazard_output_folder is None:
+        hazard_output_folder = params['scenario_name'] + '_hazard_outputs'
+
+    # Wind fields are sampled along with the other parameters
+    if windfield_directory is not None:
+        windfields = get_windfields(windfield_directory)
+        if len(windfields) == 0:
+            msg = 'No wind fields (*.profile) found in %s' % windfield_directory
+            raise Exception(msg)
+        distributions['wind_profile'] = ('choice', windfields)
+
+    samples = draw_samples(distributions, number_of_samples,
+                           method=method, seed=seed)
+
+    logdir = os.path.join(hazard_output_folder, 'logs')
+    makedir(logdir)
+
+    header('Hazard modelling using %i sampled scenarios (%s)' % (number_of_samples, method))
+    print '*  Sampled parameters:          %s' % ', '.join(sorted(distributions.keys()))
+    print '*  Scenario results stored in:  %s' % hazard_output_folder
+
+    t_start = time.time()
+
+    # Create projectionfile in hazard output
+    basename, _ = os.path.splitext(params['topography_grid'])
+    s = 'cp %s %s/%s' % (basename + '.prj', hazard_output_folder, 'HazardMaps.res.prj')
+    run(s)
+
+    # Record samples
+    names = sorted(samples[0].keys())
+    fid = open(os.path.join(hazard_output_folder, 'samples.csv'), 'w')
+    writer = csv.writer(fid)
+    writer.writerow(['member'] + names)
+    for i, sample in enumerate(samples):
+        writer.writerow(['sample%04i' % i] + [sample[name] for name in names])
+    fid.close()
+
+    manifest = Manifest(os.path.join(hazard_output_folder, manifest_filename))
+    records = manifest.read()
+
+    jobs = []
+    input_checksums = {}
+    for i, sample in enumerate(samples):
+        membername = 'sample%04i' % i
+
+        params_sampled = params.copy()
+        params_sampled.update(sample)
+        windfield = params_sampled['wind_profile']
+
+        input_checksums[membername] = compute_input_checksum(params_sampled, [windfield])
+        if resume and manifest.is_complete(membername,
+                                           input_checksums[membername],
+                                           hazard_output_folder,
+                                           records=records):
+            print 'Sample %s already completed - skipping' % membername
+            continue
+
+        manifest.record(membername, 'queued', input=input_checksums[membername])
+        jobs.append((params_sampled, windfield, i, hazard_output_folder,
+                     dircomment, membername, verbose))
+
+    results = run_in_pool(_run_sample_job, jobs,
+                          number_of_processes=number_of_processes,
+                          initializer=_start_worker_logging,
+                          initargs=(logdir,))
+
+    outcomes = []
+    for outcome in results:
+        membername = outcome['member']
+        outcomes.append(outcome)
+        print 'Finished sample %s (%i of %i)' % (membername, len(outcomes), len(jobs))
+
+        if outcome['error'] is None:
+            manifest.record(membername, 'completed',
+                            input=input_checksums[membername],
+                            result=outcome['result'],
+                            checksum=outcome['checksum'])
+        else:
+            manifest.record(membername, 'failed',
+                            input=input_checksums[membername],
+                            error=outcome['error'])
+            print 'WARNING: Sample %s failed: %s' % (membername, outcome['error'])
+
+    print 'Sampled ensemble of %i scenarios finished in %i seconds' % (len(jobs), time.time() - t_start)
     print 'Outputs available in directory: %s' % hazard_output_folder
 
-    pypar.barrier()
-    if p == 0:
-        print 'Parallel simulation finished %i windfields in %i seconds' % (count_all, time.time() - t_start)
+    return outcomes
+
+
+def get_result_files(model_output_directory):
+    """Get sorted list of Fall3d result files in model_output_directory
+
+    Hazard maps and ensemble summaries are not included.
+    """
+
+    files = []
+    for file in os.listdir(model_output_directory):
+        if file.endswith('.nc') and file not in [hazardmap_filename,
+                                                 summary_filename]:
+            files.append(file)
+    files.sort()
+
+    return files
+
+
+def get_hazard_member_files(params):
+    """Get result files of the ensemble members making up the hazard map
+
+    Input:
+        params: Hazard map parameters
+
+    If the optional parameter catalog_query is given (e.g.
+    'month in 11..3 and hour == 12'), the members are selected from the
+    catalog of results (see aim.catalog) named by the optional parameter
+    catalog_filename, which defaults to catalog.db in model_output_directory.
+    Result files are used where they are, so seasonal or other subsets
+    need no copies. Otherwise all result files in model_output_directory
+    are used.
+
+    Return sorted list of file names. Files found in model_output_directory
+    are named relative to it, whereas files selected from the catalog are
+    given by the absolute paths stored there. Either kind can be passed to
+    os.path.join(model_output_directory, name), which keeps absolute paths.
+    """
+
+    model_output_directory = params['model_output_directory']
+
+    query = params.get('catalog_query')
+    if not query:
+        return get_result_files(model_output_directory)
+
+    filename = os.path.join(model_output_directory,
+                            params.get('catalog_filename', catalog_filename))
+    if not os.path.isfile(filename):
+        msg = 'Catalog %s does not exist. Create it with ' % filename
+        msg += 'aim.catalog.Catalog(filename).index_directory(directory)'
+        raise Exception(msg)
+
+    catalog = Catalog(filename)
+    files = catalog.query(query)
+    catalog.close()
+
+    if len(files) == 0:
+        msg = 'No members in catalog %s satisfy query "%s"' % (filename, query)
+        raise Exception(msg)
+
+    return files
+
+
+def get_projection_member_counts(number_of_members):
+    """Ensemble sizes for which to predict the width of confidence bands
+
+    These are the powers of two from 8 up to eight times the current
+    number of members together with the current number.
+    """
+
+    member_counts = [number_of_members]
+    k = 3
+    while 2**k <= 8*number_of_members:
+        member_counts.append(2**k)
+        k += 1
+
+    member_counts = list(set(member_counts))
+    member_counts.sort()
+
+    return member_counts
+
+
+def get_hazard_weights(params, members, directory):
+    """Get weights of ensemble members from hazard map parameters
+
+    Input:
+        params: Hazard map parameters
+        members: List of names of result files
+        directory: Directory relative to which a weights file is found
+
+    The optional parameter hazard_weights is one of
+        None:    All members have equal weight (default)
+        'month': Each calendar month has a total weight proportional to its
+                 number of days, regardless of how many wind fields were
+                 run for it. The month is taken from the time stamp
+                 YYYYMMDDhh in the name of each member.
+        'hour':  Each hour of the day has equal total weight
+        Name of file listing the weight of each member (see
+        aim.hazard.read_member_weights)
+
+    Return dictionary of weights or None for equal weights.
+    """
+
+    method = params.get('hazard_weights')
+
+    if method is None:
+        return None
+    elif method in weighting_methods:
+        return get_member_weights(members, method)
+    else:
+        filename = os.path.join(directory, method) # Absolute paths are kept
+        if not os.path.isfile(filename):
+            msg = 'Parameter hazard_weights must be one of %s or a weights file. '\
+                % weighting_methods
+            msg += 'File %s does not exist' % filename
+            raise Exception(msg)
+
+        return read_member_weights(filename)
+
+
+def write_hazardmap(hazard_map, params, model_output_directory):
+    """Write hazard map to HazardMaps.res.nc in model_output_directory
 
+    If params has hazard_confidence (e.g. 0.95), the Wilson confidence
+    bands (e.g. PLOAD_1_LOWER and PLOAD_1_UPPER) are written along with
+    the probabilities. HazardMaps.convergence.csv then lists the largest
+    half width of the bands (PLOAD_1_WIDTH) and the largest change of the
+    probabilities (PLOAD_1_CHANGE) recorded as members were added (see
+    HazardMap.record_convergence). The half widths expected for other
+    numbers of members, assuming the current probabilities hold, are
+    listed in HazardMaps.projection.csv to show how many members are
+    needed for a given precision.
+    """
 
-    pypar.finalize()
+    variables = hazard_map.get_variables()
+
+    confidence = params.get('hazard_confidence')
+    if confidence:
+        variables.update(hazard_map.get_confidence_variables(confidence))
+
+        if hazard_map.convergence:
+            names = sorted(hazard_map.convergence[0][1].keys())
+
+            fid = open(os.path.join(model_output_directory,
+                                    'HazardMaps.convergence.csv'), 'w')
+            writer = csv.writer(fid)
+            writer.writerow(['number_of_members'] +
+                            ['%s_WIDTH' % name for name in names] +
+                            ['%s_CHANGE' % name for name in names])
+            for N, widths, changes in hazard_map.convergence:
+                row = [N] + ['%.3f' % widths[name] for name in names]
+                for name in names:
+                    if numpy.isnan(changes[name]):
+                        row.append('')
+                    else:
+                        row.append('%.3f' % changes[name])
+                writer.writerow(row)
+            fid.close()
+
+        member_counts = params.get('projection_member_counts')
+        if member_counts is None:
+            member_counts = get_projection_member_counts(hazard_map.number_of_members)
+        curve = hazard_map.get_projected_widths(member_counts, confidence)
+
+        names = sorted(curve[0][1].keys())
+
+        fid = open(os.path.join(model_output_directory,
+                                'HazardMaps.projection.csv'), 'w')
+        writer = csv.writer(fid)
+        writer.writerow(['number_of_members'] + names)
+        for N, widths in curve:
+            writer.writerow([N] + ['%.3f' % widths[name] for name in names])
+        fid.close()
 
+        print 'Largest half width of %g%% confidence bands with %i members: %.1f percentage points'\
+            % (100*confidence, hazard_map.number_of_members,
+               max(hazard_map.get_projected_widths([hazard_map.number_of_members],
+                                                   confidence)[0][1].values()))
 
+    hazard_map.write(os.path.join(model_output_directory, hazardmap_filename),
+                     variables=variables)
 
 
-def generate_hazardmap(scenario, verbose=True):
+def generate_hazardmap(scenario, engine=None, number_of_processes=None,
+                       verbose=True):
     """Generate hazard map from Fall3d NetCDF outputs
+
+    Input:
+        scenario: Hazard map script or dictionary (see templates/create_hazard_map.py)
+        engine: 'numpy' to compute the hazard map with aim.hazard (default)
+                or 'fortran' to run the Fall3d utility HazardMapping.exe.
+                If None, the optional scenario parameter hazard_engine is used.
+        number_of_processes: Number of local processes reading result files
+                with the numpy engine (see compute_hazardmap). If None,
+                AIM_NUMBER_OF_PROCESSES or the number of processors on this
+                machine is used.
+
+    With the numpy engine, flight level exceedance maps (PFL050_i etc) are
+    computed for all flight levels present in the results if the scenario
+    parameter fl_values is non-empty. The accumulated state is saved as
+    HazardMaps.state.npz so that the map can later be updated with
+    update_hazardmap. If the optional scenario parameter hazard_histogram
+    is True, per cell histograms of the final load are saved with the state
+    so that maps for other thresholds can be made with
+    generate_hazardmap_from_histogram. Histograms of the peak concentration
+    at each flight level are added if hazard_fl_histogram is also True.
+    If the optional scenario parameter hazard_confidence is given (e.g.
+    0.95), confidence bands are added to the hazard map (see
+    write_hazardmap). Members are weighted according to the optional
+    scenario parameter hazard_weights (see get_hazard_weights) and may be
+    selected from a catalog with the optional scenario parameter
+    catalog_query (see get_hazard_member_files).
     """
 
     # Get params from model script
     params = get_scenario_parameters(scenario)
 
+    if engine is None:
+        engine = params.get('hazard_engine', 'numpy')
+
+    if engine not in ['numpy', 'fortran']:
+        msg = 'Hazard map engine must be either numpy or fortran. I got %s' % engine
+        raise Exception(msg)
+
     model_output_directory = params['model_output_directory']
 
     # Clean up
-    s = 'cd %s; /bin/rm -rf HazardMaps.res.nc' % model_output_directory
+    s = 'cd %s; /bin/rm -rf %s' % (model_output_directory, hazardmap_filename)
     run(s)
 
+    # Get all model output files
+    files = get_hazard_member_files(params)
+
+    if engine == 'numpy':
+        print 'Generating hazard map from %i files' % len(files)
+        hazard_map = compute_hazardmap([os.path.join(model_output_directory, file) for file in files],
+                                       params['load_values'],
+                                       fl_values=params['fl_values'],
+                                       histogram=params.get('hazard_histogram', False),
+                                       fl_histogram=params.get('hazard_fl_histogram', False),
+                                       confidence=params.get('hazard_confidence'),
+                                       weights=get_hazard_weights(params,
+                                                                  [os.path.basename(file) for file in files],
+                                                                  model_output_directory),
+                                       statefilename=os.path.join(model_output_directory,
+                                                                  hazardmap_state_filename),
+                                       number_of_processes=number_of_processes,
+                                       verbose=verbose)
+        write_hazardmap(hazard_map, params, model_output_directory)
+    else:
+        _run_fortran_hazardmap(params, files)
+
+    print 'Hazard map done in directory: %s' % model_output_directory
+
+    contour_hazardmap(scenario, verbose=verbose)
+
+
+def update_hazardmap(scenario, remove=None, verbose=True):
+    """Update hazard map with new Fall3d NetCDF outputs
+
+    Input:
+        scenario: Hazard map script or dictionary (see templates/create_hazard_map.py)
+        remove: Optional list of result files (names in model_output_directory)
+                to take out of the hazard map. They must still be present
+                and unchanged as their contributions are read again and
+                subtracted.
+
+    Result files in model_output_directory that are not yet part of the
+    hazard map, and have not been removed from it, are added to the state
+    saved by a previous call to generate_hazardmap or update_hazardmap, so
+    only new and removed members are read. If no state exists, or it was
+    computed with different thresholds, or the weights of existing members
+    have changed (see get_hazard_weights), the hazard map is generated
+    from scratch. With the optional scenario parameter catalog_query, new
+    members are those in the catalog satisfying the query (see
+    get_hazard_member_files).
+    """
+
+    # Get params from model script
+    params = get_scenario_parameters(scenario)
+
+    model_output_directory = params['model_output_directory']
+    statefilename = os.path.join(model_output_directory,
+                                 hazardmap_state_filename)
+
+    if not os.path.isfile(statefilename):
+        if verbose:
+            print 'No hazard map state found in %s' % model_output_directory
+        generate_hazardmap(scenario, engine='numpy', verbose=verbose)
+        return
+
+    hazard_map = load_hazardmap_state(statefilename)
+
+    fl_values = params['fl_values']
+    if fl_values is None:
+        fl_values = []
+    if (list(hazard_map.load_values) != list(params['load_values']) or
+        list(hazard_map.fl_values) != list(fl_values)):
+        if verbose:
+            print 'Thresholds have changed since hazard map state was saved'
+        generate_hazardmap(scenario, engine='numpy', verbose=verbose)
+        return
+
+    confidence = params.get('hazard_confidence')
+    if hazard_map.confidence != confidence:
+        # Convergence recorded at another confidence level no longer applies
+        hazard_map.confidence = confidence
+        hazard_map.convergence = []
+
+    if remove is None:
+        remove = []
+
+    for file in remove:
+        if verbose:
+            print 'Removing %s' % file
+        hazard_map.remove(os.path.join(model_output_directory,
+                                       os.path.basename(file)))
+
+    # Get model output files not yet in hazard map
+    files = []
+    paths = {}
+    for file in get_hazard_member_files(params):
+        member = os.path.basename(file)
+        paths[member] = os.path.join(model_output_directory, file)
+        if member not in hazard_map.members and member not in hazard_map.removed:
+            files.append(file)
+
+    # Weights may depend on the whole ensemble, e.g. members per month
+    weights = get_hazard_weights(params,
+                                 hazard_map.members + [os.path.basename(file) for file in files],
+                                 model_output_directory)
+    for member in hazard_map.members:
+        if not numpy.allclose(get_weight(weights, member),
+                              hazard_map.weights[member]):
+            if verbose:
+                print 'Weights of members have changed since hazard map state was saved'
+            generate_hazardmap(scenario, engine='numpy', verbose=verbose)
+            return
+
+    # Members may have been aggregated without keeping their results
+    missing = []
+    for member in hazard_map.members:
+        if not os.path.isfile(paths.get(member, os.path.join(model_output_directory, member))):
+            missing.append(member)
+    if missing:
+        print 'WARNING: %i members of the hazard map have no result file in %s. '\
+            'They are kept in the hazard map' % (len(missing), model_output_directory)
+
+    print 'Adding %i files to hazard map of %i members' % (len(files),
+                                                          hazard_map.number_of_members)
+    for i, file in enumerate(files):
+        if verbose:
+            print 'Reading %s (%i of %i)' % (file, i+1, len(files))
+        hazard_map.add(os.path.join(model_output_directory, file),
+                       weight=get_weight(weights, file))
+
+    write_hazardmap(hazard_map, params, model_output_directory)
+    hazard_map.save_state(statefilename)
+
+    print 'Hazard map done in directory: %s' % model_output_directory
+
+    contour_hazardmap(scenario, verbose=verbose)
+
+
+def generate_hazardmap_from_histogram(scenario, verbose=True):
+    """Generate hazard map for new thresholds without reading the results
+
+    Input:
+        scenario: Hazard map script or dictionary (see templates/create_hazard_map.py)
+
+    Exceedance probabilities for load_values and fl_values in the scenario
+    are estimated from the histograms saved in HazardMaps.state.npz by
+    generate_hazardmap with hazard_histogram = True. The error in each cell
+    is at most the fraction of members in the histogram bin containing the
+    threshold. Isochrones are not available from histograms, and
+    concentrations only if the histograms were saved with
+    hazard_fl_histogram = True.
+
+    The result is written to HazardMaps.res.nc and contoured.
+    """
+
+    # Get params from model script
+    params = get_scenario_parameters(scenario)
+
+    model_output_directory = params['model_output_directory']
+    statefilename = os.path.join(model_output_directory,
+                                 hazardmap_state_filename)
+
+    if not os.path.isfile(statefilename):
+        msg = 'Hazard map state %s does not exist. ' % statefilename
+        msg += 'Run generate_hazardmap with hazard_histogram = True first'
+        raise Exception(msg)
+
+    hazard_map = load_hazardmap_state(statefilename)
+
+    fl_values = params['fl_values']
+    if fl_values and not hazard_map.use_fl_histogram:
+        print 'WARNING: No flight level histograms in %s - fl_values ignored' % statefilename
+        fl_values = []
+
+    variables = hazard_map.get_histogram_variables(params['load_values'],
+                                                   fl_values)
+    hazard_map.write(os.path.join(model_output_directory, hazardmap_filename),
+                     variables=variables)
+
+    print 'Hazard map of %i members from histograms done in directory: %s'\
+        % (hazard_map.number_of_members, model_output_directory)
+
+    contour_hazardmap(scenario, verbose=verbose)
+
+
+def _run_fortran_hazardmap(params, files):
+    """Generate hazard map using HazardMapping.exe from Fall3d
+    """
+
+    model_output_directory = params['model_output_directory']
 
     # Convert UTM to latitude and longitude
     if params['vent_hemisphere'].upper() == 'S':
@@ -777,13 +2075,6 @@ def generate_hazardmap(scenario, verbose=True):
                        params['vent_zone'],
                        is_southern_hemisphere)
 
-    # Get all model output files
-    files = []
-    for file in os.listdir(model_output_directory):
-        if file.endswith('.nc'):
-            files.append(file)
-
-
     # Generate input file
     fid = open('%s/HazardMaps.inp' % model_output_directory, 'w')
     fid.write('COORDINATES\n')
@@ -812,10 +2103,6 @@ def generate_hazardmap(scenario, verbose=True):
     print 'Generating hazard map for geographic vent location (%f, %f)' % (lon, lat)
     run_hazardmap(model_output_directory, verbose=False)
 
-    print 'Hazard map done in directory: %s' % model_output_directory
-
-    contour_hazardmap(scenario, verbose=verbose)
-
 
 def contour_hazardmap(scenario, verbose=True):
     """Contouring hazard map from Fall3d NetCDF outputs located in directory given by the variable
@@ -826,7 +2113,7 @@ def contour_hazardmap(scenario, verbose=True):
     """
 
 
-    filename = 'HazardMaps.res.nc' # Hardwired name as per Fall3d
+    filename = hazardmap_filename # Hardwired name as per Fall3d
 
     from Scientific.IO.NetCDF import NetCDFFile
 
@@ -864,6 +2151,11 @@ def contour_hazardmap(scenario, verbose=True):
             contours = params['ISOCHRON_contours']
             units = params['ISOCHRON_units']
             attribute_name = var
+        elif var.startswith('PFL'):
+            # Flight level exceedance is a percentage like PLOAD
+            contours = params.get('PFL_contours', params['PLOAD_contours'])
+            units = params.get('PFL_units', params['PLOAD_units'])
+            attribute_name = var
         else:
             if verbose: print 'WARNING: Undefined variable %s' % var
             continue
@@ -881,9 +2173,11 @@ def contour_hazardmap(scenario, verbose=True):
         fid.close()
 
 
+        extrema = {}
         ascii_filename=nc2asc(absolutefilename,
                               subdataset=attribute_name,
-                              projection=WKT_projection)
+                              projection=WKT_projection,
+                              extrema=extrema)
 
         for filename in os.listdir(model_output_directory):
 
@@ -893,6 +2187,7 @@ def contour_hazardmap(scenario, verbose=True):
                 _generate_contours(filename, contours, units, attribute_name,
                                    output_dir=model_output_directory,
                                    WKT_projection=True,
+                                   extrema=extrema.get(filename),
                                    verbose=verbose)
 
 
@@ -900,3 +2195,121 @@ def contour_hazardmap(scenario, verbose=True):
     if verbose:
         print 'Contouring of hazard map done in directory: %s' % model_output_directory
 
+
+def generate_summary_statistics(scenario, verbose=True):
+    """Generate ensemble mean, percentile and maximum maps from Fall3d NetCDF outputs
+
+    Input:
+        scenario: Hazard map script or dictionary (see templates/create_hazard_map.py)
+
+    Statistics of the final LOAD and THICKNESS of all result files in
+    model_output_directory are written to EnsembleSummary.res.nc in the
+    same directory (see aim.summary). The optional scenario parameters
+    summary_fields and summary_quantiles override the defaults in
+    aim.summary. Members may be selected from a catalog with the optional
+    scenario parameter catalog_query (see get_hazard_member_files).
+
+    Each variable is converted to an ASCII grid and contoured using
+    load_contours or thickness_contours if given in the scenario and
+    automatic contours otherwise.
+    """
+
+    # Get params from model script
+    params = get_scenario_parameters(scenario)
+
+    model_output_directory = params['model_output_directory']
+    files = get_hazard_member_files(params)
+
+    print 'Generating ensemble summary from %i files' % len(files)
+    absolutefilename = os.path.join(model_output_directory, summary_filename)
+    summary = compute_summary([os.path.join(model_output_directory, file) for file in files],
+                              fields=params.get('summary_fields'),
+                              quantiles=params.get('summary_quantiles'),
+                              outputfilename=absolutefilename,
+                              verbose=verbose)
+
+    # Use projection of hazard map
+    prjfilename = os.path.join(model_output_directory, 'HazardMaps.res.prj')
+    if not os.path.exists(prjfilename):
+        msg = 'Projection file %s must be present for contouring to work.\n' % prjfilename
+        msg += 'You can copy the projection file from one of the individual scenarios used to produce the hazard map'
+        raise Exception(msg)
+
+    fid = open(prjfilename)
+    WKT_projection = fid.read()
+    fid.close()
+
+    variables = summary.get_variables().keys()
+    variables.sort()
+    for var in variables:
+        field = var.split('_')[0]
+        contours = params.get(field.lower() + '_contours', True)
+        units = summary.units[field]
+
+        extrema = {}
+        nc2asc(absolutefilename, subdataset=var, projection=WKT_projection,
+               extrema=extrema)
+
+        asciifilename = '%s.%s.asc' % (summary_filename[:-len('.res.nc')],
+                                       var.lower())
+        _generate_contours(asciifilename, contours, units, var,
+                           output_dir=model_output_directory,
+                           WKT_projection=True,
+                           extrema=extrema.get(asciifilename),
+                           verbose=verbose)
+
+    print 'Ensemble summary done in directory: %s' % model_output_directory
+
+
+def generate_site_hazard(scenario, sites=None, verbose=True):
+    """Generate hazard curves at points of interest from Fall3d NetCDF outputs
+
+    Input:
+        scenario: Hazard map script or dictionary (see templates/create_hazard_map.py)
+        sites: CSV file with named sites (see aim.sites.read_sites). If None,
+               the scenario parameter hazard_sites is used. Relative names
+               are taken relative to model_output_directory.
+
+    For each site, the exceedance curve of load_values, the distribution
+    of arrival times of each load value and, if fl_values are given, the
+    exceedance of fl_values at each flight level are computed in one pass
+    over the members (see aim.sites) and written to HazardSites.load.csv,
+    HazardSites.arrival.csv and HazardSites.fl.csv in model_output_directory.
+    Sites in latitude and longitude are converted to the UTM zone vent_zone.
+
+    The optional scenario parameters site_interpolation ('nearest' or
+    'bilinear', the default) and arrival_times (hours since the first
+    output) control the sampling. Members are selected and weighted as for
+    generate_hazardmap.
+    """
+
+    # Get params from model script
+    params = get_scenario_parameters(scenario)
+
+    model_output_directory = params['model_output_directory']
+
+    if sites is None:
+        sites = params.get('hazard_sites')
+    if sites is None:
+        msg = 'Sites must be given as argument or as scenario parameter hazard_sites'
+        raise Exception(msg)
+    sites = os.path.join(model_output_directory, sites) # Absolute paths are kept
+
+    files = get_hazard_member_files(params)
+    weights = get_hazard_weights(params, [os.path.basename(file) for file in files],
+                                 model_output_directory)
+
+    compute_site_hazard([os.path.join(model_output_directory, file) for file in files],
+                        sites,
+                        params['load_values'],
+                        fl_values=params.get('fl_values'),
+                        arrival_times=params.get('arrival_times'),
+                        method=params.get('site_interpolation', 'bilinear'),
+                        weights=weights,
+                        zone=params.get('vent_zone'),
+                        southern_hemisphere=params.get('vent_hemisphere', 'N').upper() == 'S',
+                        outputbasename=os.path.join(model_output_directory,
+                                                    site_hazard_basename),
+                        verbose=verbose)
+
+    print 'Site hazard curves done in directory: %s' % model_output_directory
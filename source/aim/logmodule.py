@@ -22,6 +22,11 @@ class StreamLogger(object):
             self.log.info('[%s] %s' % (timestamp, tmp))
             self.data = ''
 
+    def flush(self):
+        # Needed by e.g. multiprocessing which flushes sys.stdout
+        if self.echo:
+            self.stream.flush()
+
 
 
 def start_logging(filename, echo=True, verbose=True):
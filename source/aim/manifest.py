@@ -0,0 +1,152 @@
+"""Completion manifest for hazard ensembles
+
+The manifest records the status of each member of an ensemble (e.g. one
+Fall3d run for each wind field) so that an interrupted ensemble can be
+resumed without re-running members that have already completed.
+
+The manifest is an append-only text file with one JSON record per line,
+for example
+
+{"member": "ncep_2009091306", "status": "completed", "input": "9f1c...", "result": "merapi.ncep_2009091306.res.nc", "checksum": "0be4...", "time": "2010-12-07T114308"}
+
+Each record is written with a single call and flushed to disk so a crash
+can at most leave one truncated line at the end, which is ignored when
+the manifest is read back. The last record for a member determines its
+status.
+"""
+
+import os
+import json
+import hashlib
+
+from utilities import get_timestamp
+
+manifest_filename = 'manifest.jsonl'
+
+
+def compute_checksum(filename, blocksize=2**20):
+    """Compute MD5 checksum of file contents
+    """
+
+    m = hashlib.md5()
+
+    fid = open(filename, 'rb')
+    while True:
+        block = fid.read(blocksize)
+        if not block:
+            break
+        m.update(block)
+    fid.close()
+
+    return m.hexdigest()
+
+
+def compute_input_checksum(params, filenames):
+    """Compute MD5 checksum identifying the inputs of an ensemble member
+
+    Input:
+        params: Dictionary of model parameters
+        filenames: List of input files (e.g. the wind profile)
+    """
+
+    m = hashlib.md5()
+
+    keys = params.keys()
+    keys.sort()
+    for key in keys:
+        m.update('%s=%s\n' % (key, repr(params[key])))
+
+    for filename in filenames:
+        m.update(compute_checksum(filename))
+
+    return m.hexdigest()
+
+
+class Manifest:
+
+    def __init__(self, filename):
+        """Open manifest with given filename. It is created if needed.
+        """
+
+        self.filename = filename
+
+    def record(self, member, status, **fields):
+        """Append record for member with given status
+
+        Status is one of 'queued', 'completed' or 'failed'. Additional
+        keyword arguments are stored along with the record.
+        """
+
+        entry = {'member': member,
+                 'status': status,
+                 'time': get_timestamp()}
+        entry.update(fields)
+
+        line = json.dumps(entry, sort_keys=True) + '\n'
+
+        # Start on a new line if a previous write was interrupted
+        if os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0:
+            fid = open(self.filename, 'rb')
+            fid.seek(-1, os.SEEK_END)
+            if fid.read(1) != '\n':
+                line = '\n' + line
+            fid.close()
+
+        fid = open(self.filename, 'a')
+        fid.write(line)
+        fid.flush()
+        os.fsync(fid.fileno())
+        fid.close()
+
+    def read(self):
+        """Return dictionary with the last record for each member
+        """
+
+        records = {}
+
+        if not os.path.isfile(self.filename):
+            return records
+
+        fid = open(self.filename)
+        for line in fid.readlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Truncated record from an interrupted write
+                continue
+
+            records[entry['member']] = entry
+        fid.close()
+
+        return records
+
+    def is_complete(self, member, input_checksum, directory, records=None):
+        """Determine if member has completed with a valid result
+
+        A member is complete if its last record says so, it was computed
+        from the same inputs and its result file in directory is present
+        with the recorded checksum. Members whose result was added to a
+        hazard map and then deleted are complete without a result file.
+        """
+
+        if records is None:
+            records = self.read()
+
+        if member not in records:
+            return False
+
+        entry = records[member]
+        if entry['status'] != 'completed':
+            return False
+
+        if entry.get('input') != input_checksum:
+            return False
+
+        if entry.get('result') is None:
+            return entry.get('aggregated', False)
+
+        result_file = os.path.join(directory, entry['result'])
+        if not os.path.isfile(result_file):
+            return False
+
+        return compute_checksum(result_file) == entry['checksum']
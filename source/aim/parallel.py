@@ -0,0 +1,216 @@
+"""Parallel execution backends used by AIM
+
+Independent model runs (e.g. one for each wind field in a hazard ensemble)
+can be farmed out using one of the following backends:
+
+    serial:          Run all jobs one after the other in this process
+    multiprocessing: Run jobs in a pool of local worker processes
+    pypar:           Run jobs across MPI processes using pypar
+
+The backend can be chosen explicitly by the caller or through the
+environment variable AIM_PARALLEL_BACKEND. The number of local worker
+processes can likewise be set through AIM_NUMBER_OF_PROCESSES.
+"""
+
+import os
+import multiprocessing
+import multiprocessing.pool
+
+backends = ['serial', 'multiprocessing', 'pypar']
+
+
+def get_backend(backend=None):
+    """Determine which parallel backend to use
+
+    Input:
+        backend: Name of backend or None.
+
+    If backend is None, the environment variable AIM_PARALLEL_BACKEND is
+    used if set. Otherwise pypar is used if it can be imported and the
+    serial backend if not.
+    """
+
+    if backend is None:
+        backend = os.environ.get('AIM_PARALLEL_BACKEND')
+
+    if backend is None:
+        try:
+            import pypar
+        except:
+            backend = 'serial'
+        else:
+            backend = 'pypar'
+
+    backend = backend.lower()
+    if backend not in backends:
+        msg = 'Unknown parallel backend "%s". Options are %s' % (backend, backends)
+        raise Exception(msg)
+
+    return backend
+
+
+def get_number_of_processes(number_of_processes=None):
+    """Determine number of local worker processes
+
+    If number_of_processes is None, the environment variable
+    AIM_NUMBER_OF_PROCESSES is used if set. Otherwise the number of
+    processors on this machine is used.
+    """
+
+    if number_of_processes is None:
+        number_of_processes = os.environ.get('AIM_NUMBER_OF_PROCESSES')
+
+    if number_of_processes is None:
+        number_of_processes = multiprocessing.cpu_count()
+
+    try:
+        number_of_processes = int(number_of_processes)
+    except:
+        msg = 'Number of processes must be an integer. I got %s' % str(number_of_processes)
+        raise Exception(msg)
+
+    if number_of_processes < 1:
+        msg = 'Number of processes must be at least 1. I got %i' % number_of_processes
+        raise Exception(msg)
+
+    return number_of_processes
+
+
+def run_in_pool(function, jobs,
+                number_of_processes=None,
+                initializer=None,
+                initargs=()):
+    """Apply function to each job using a pool of local processes
+
+    Input:
+        function: Module level function taking one job as argument
+        jobs: Sequence of jobs. Each job must be picklable.
+        number_of_processes: Size of pool (see get_number_of_processes)
+        initializer: Optional function called in each worker at startup
+        initargs: Arguments for initializer
+
+    Results are yielded in the order jobs finish. Jobs are handed out
+    one at a time so that a worker picks up the next job as soon as it
+    becomes idle.
+    """
+
+    number_of_processes = get_number_of_processes(number_of_processes)
+
+    pool = multiprocessing.Pool(processes=number_of_processes,
+                                initializer=initializer,
+                                initargs=initargs)
+    try:
+        for result in pool.imap_unordered(function, jobs, chunksize=1):
+            yield result
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+
+def run_in_threads(function, jobs, number_of_threads=None):
+    """Apply function to each job using a pool of threads in this process
+
+    Input:
+        function: Function taking one job as argument
+        jobs: Sequence of jobs
+        number_of_threads: Size of pool (see get_number_of_processes)
+
+    This suits jobs that spend their time in subprocesses or I/O, such as
+    the GDAL tools used for contouring, where threads avoid the cost of
+    pickling and forking. Results are yielded in the order jobs finish.
+    """
+
+    number_of_threads = get_number_of_processes(number_of_threads)
+
+    pool = multiprocessing.pool.ThreadPool(processes=number_of_threads)
+    try:
+        for result in pool.imap_unordered(function, jobs, chunksize=1):
+            yield result
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+
+
+#------------------------------
+# Master/worker scheduling (MPI)
+#------------------------------
+
+WORKTAG = 1
+DIETAG = 2
+
+
+def run_pypar_master(jobs):
+    """Hand out jobs to pypar workers as they become idle
+
+    Input:
+        jobs: Sequence of picklable jobs
+
+    This must be called on processor 0 while all other processors call
+    run_pypar_worker. Each worker is given a new job as soon as it
+    returns the result of its previous one so that long jobs don't leave
+    other processors idle.
+
+    Results are yielded in the order jobs finish.
+    """
+
+    import pypar
+
+    jobs = list(jobs)
+    P = pypar.size()
+
+    # Give every worker its first job (or tell it to stop)
+    next_job = 0
+    active = 0
+    for worker in range(1, P):
+        if next_job < len(jobs):
+            pypar.send(jobs[next_job], worker, tag=WORKTAG)
+            next_job += 1
+            active += 1
+        else:
+            pypar.send(None, worker, tag=DIETAG)
+
+    # Refill workers as they finish
+    while active > 0:
+        result, status = pypar.receive(pypar.any_source,
+                                       tag=pypar.any_tag,
+                                       return_status=True)
+        worker = status.source
+
+        if next_job < len(jobs):
+            pypar.send(jobs[next_job], worker, tag=WORKTAG)
+            next_job += 1
+        else:
+            pypar.send(None, worker, tag=DIETAG)
+            active -= 1
+
+        yield result
+
+
+def run_pypar_worker(function):
+    """Apply function to jobs received from run_pypar_master until told to stop
+
+    Return number of jobs done by this worker.
+    """
+
+    import pypar
+
+    count = 0
+    while True:
+        job, status = pypar.receive(0, tag=pypar.any_tag,
+                                    return_status=True)
+        if status.tag == DIETAG:
+            break
+
+        result = function(job)
+        pypar.send(result, 0, tag=WORKTAG)
+        count += 1
+
+    return count
@@ -0,0 +1,282 @@
+"""Running external programs with timeouts and cancellation
+
+The Fall3d utilities and GDAL tools are run as child processes with their
+standard output and error going straight to log files, so the logs can be
+followed while a program is running. Each command runs in its own process
+group so that it can be killed together with anything it has spawned if
+it exceeds its wall clock limit or is cancelled.
+
+Many commands can be driven concurrently from one Python process with
+run_commands, which polls the running processes instead of dedicating a
+thread to each.
+"""
+
+import os
+import time
+import signal
+import subprocess
+
+
+class Command:
+
+    def __init__(self, cmd, stdout=None, stderr=None, timeout=None,
+                 follow=None, grace_period=5):
+        """Command to be run through the shell
+
+        Input:
+            cmd: Command line
+            stdout: Optional file to which standard output is written
+            stderr: Optional file to which standard error is written
+            timeout: Optional wall clock limit in seconds
+            follow: Optional file (e.g. a log file written by the program)
+                    whose new lines are printed while the command runs
+            grace_period: Seconds between SIGTERM and SIGKILL when the
+                          command is killed
+        """
+
+        self.cmd = cmd
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timeout = timeout
+        self.follow = follow
+        self.grace_period = grace_period
+
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        self.t_start = None
+        self.follow_position = 0
+
+    def start(self):
+        """Start command without waiting for it to finish
+        """
+
+        fids = []
+        for filename in [self.stdout, self.stderr]:
+            if filename:
+                fids.append(open(filename, 'w'))
+            else:
+                fids.append(None)
+
+        self.t_start = time.time()
+        try:
+            # New process group so that the whole command can be killed
+            self.process = subprocess.Popen(self.cmd, shell=True,
+                                            stdout=fids[0],
+                                            stderr=fids[1],
+                                            preexec_fn=os.setpgrp)
+        finally:
+            # The child has its own copies
+            for fid in fids:
+                if fid is not None:
+                    fid.close()
+
+    def poll(self):
+        """Check command, enforcing its timeout
+
+        Return exit code or None if command is still running.
+        """
+
+        if self.returncode is not None:
+            return self.returncode
+
+        self.print_new_lines()
+
+        returncode = self.process.poll()
+        if returncode is None and self.timeout is not None:
+            if time.time() - self.t_start > self.timeout:
+                self.timed_out = True
+                self.kill()
+                returncode = self.process.returncode
+
+        if returncode is not None:
+            self.print_new_lines()
+            self.returncode = returncode
+
+        return self.returncode
+
+    def print_new_lines(self):
+        """Print lines added to followed file since last call
+        """
+
+        if self.follow is None or not os.path.isfile(self.follow):
+            return
+
+        fid = open(self.follow)
+        fid.seek(self.follow_position)
+        data = fid.read()
+        fid.close()
+
+        # Only complete lines
+        i = data.rfind('\n')
+        if i >= 0:
+            for line in data[:i].split('\n'):
+                if line.strip():
+                    print '  ' + line.rstrip()
+            self.follow_position += i + 1
+
+    def kill(self, grace_period=None):
+        """Terminate command and everything it has started
+
+        Processes still running grace_period seconds after SIGTERM are
+        killed with SIGKILL. Default is the grace period of the command.
+        """
+
+        if self.process is None or self.process.poll() is not None:
+            return
+
+        if grace_period is None:
+            grace_period = self.grace_period
+
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(self.process.pid, sig)
+            except OSError:
+                # Already gone
+                pass
+
+            t_kill = time.time()
+            while self.process.poll() is None:
+                if time.time() - t_kill > grace_period:
+                    break
+                time.sleep(0.01)
+
+            if self.process.poll() is not None:
+                break
+
+        self.process.wait()
+
+    def cancel(self):
+        """Cancel command if running
+        """
+
+        self.cancelled = True
+        self.kill()
+        if self.process is not None:
+            self.returncode = self.process.returncode
+
+    def wait(self, max_poll_interval=0.5):
+        """Wait for command to finish or time out and return exit code
+
+        Without timeout or followed file this simply blocks until the
+        command exits. Otherwise the command is polled, first every 0.01
+        seconds and then less often up to max_poll_interval, so short
+        commands return promptly.
+
+        The command is killed if the waiting is interrupted (e.g. by
+        Control-C).
+        """
+
+        try:
+            if self.timeout is None and self.follow is None:
+                self.process.wait()
+                self.poll()
+            else:
+                poll_interval = 0.01
+                while self.poll() is None:
+                    time.sleep(poll_interval)
+                    poll_interval = min(2*poll_interval, max_poll_interval)
+        except:
+            self.cancel()
+            raise
+
+        return self.returncode
+
+    def describe_failure(self):
+        """Explain why command did not succeed
+        """
+
+        if self.timed_out:
+            msg = 'Command "%s" exceeded time limit of %i seconds and was killed. '\
+                % (self.cmd, self.timeout)
+        elif self.cancelled:
+            msg = 'Command "%s" was cancelled. ' % self.cmd
+        else:
+            msg = 'Command "%s" failed with errorcode %i. ' % (self.cmd,
+                                                              self.returncode)
+
+        if self.stdout and self.stderr:
+            msg += 'See logfiles %s and %s for details' % (self.stdout,
+                                                           self.stderr)
+
+        return msg
+
+
+def run_commands(commands, max_concurrent=None, timeout=None,
+                 max_poll_interval=0.5, cancel=None, verbose=True):
+    """Run many commands concurrently from one process
+
+    Input:
+        commands: Sequence of Command instances. Each keeps its own
+                  timeout.
+        max_concurrent: Maximal number of commands running at the same
+                        time. Default is no limit.
+        timeout: Optional wall clock limit in seconds for all commands
+                 together. Commands still running or waiting when it is
+                 exceeded are cancelled.
+        max_poll_interval: Longest time between checks of the running
+                           commands. Checks start every 0.01 seconds and
+                           become less frequent while nothing finishes.
+        cancel: Optional function returning True when all remaining
+                commands should be cancelled
+        verbose: Print commands as they are started and when they fail
+
+    Return list of commands in the order they finished. Each has
+    attributes returncode, timed_out and cancelled.
+    """
+
+    waiting = list(commands)
+    waiting.reverse() # Pop from the end
+    running = []
+    finished = []
+
+    t_start = time.time()
+    poll_interval = 0.01
+    try:
+        while waiting or running:
+            if ((cancel is not None and cancel()) or
+                (timeout is not None and time.time() - t_start > timeout)):
+                for command in running:
+                    command.cancel()
+                    finished.append(command)
+                running = []
+
+                for command in waiting:
+                    command.cancelled = True
+                    finished.append(command)
+                waiting = []
+                break
+
+            while waiting and (max_concurrent is None or
+                               len(running) < max_concurrent):
+                command = waiting.pop()
+                if verbose:
+                    print command.cmd
+                command.start()
+                running.append(command)
+
+            still_running = []
+            for command in running:
+                if command.poll() is None:
+                    still_running.append(command)
+                else:
+                    if verbose and command.returncode != 0:
+                        print 'WARNING: %s' % command.describe_failure()
+                    finished.append(command)
+
+            if len(still_running) < len(running):
+                poll_interval = 0.01
+            else:
+                poll_interval = min(2*poll_interval, max_poll_interval)
+            running = still_running
+
+            if running:
+                time.sleep(poll_interval)
+    except:
+        # Don't leave orphans behind if interrupted
+        for command in running:
+            command.cancel()
+        raise
+
+    return finished
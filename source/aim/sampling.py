@@ -0,0 +1,201 @@
+"""Random and Latin hypercube sampling of scenario parameters
+
+Distributions are specified as tuples (or lists) with the name of the
+distribution followed by its parameters:
+
+    ('uniform', low, high)
+    ('loguniform', low, high)        Uniform in log space, low > 0
+    ('normal', mean, std)
+    ('lognormal', mean, std)         mean and std of the natural logarithm
+    ('triangular', low, mode, high)
+    ('choice', [value1, value2, ...]) Equally likely discrete values
+
+for example
+
+sampling_distributions = {'height_above_vent': ('uniform', 5000, 20000),
+                          'mass_eruption_rate': ('loguniform', 1e6, 1e9),
+                          'mean_grainsize': ('normal', 2.5, 0.5),
+                          'source_type': ('choice', ['plume', 'suzuki'])}
+
+With Latin hypercube sampling the range of each parameter is divided into
+as many strata of equal probability as there are samples and each stratum
+is sampled exactly once. This covers the parameter space far better than
+a full factorial sweep with the same number of runs.
+"""
+
+import numpy
+
+sampling_methods = ['lhs', 'random']
+distribution_names = ['uniform', 'loguniform', 'normal', 'lognormal',
+                      'triangular', 'choice']
+
+
+def normal_ppf(u):
+    """Inverse of the standard normal cumulative distribution function
+
+    Rational approximation by P. J. Acklam with relative error less
+    than 1.15e-9.
+    """
+
+    a = [-3.969683028665376e+01, 2.209460984245205e+02,
+         -2.759285104469687e+02, 1.383577518672690e+02,
+         -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02,
+         -1.556989798598866e+02, 6.680131188771972e+01,
+         -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01,
+         -2.400758277161838e+00, -2.549732539343734e+00,
+         4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01,
+         2.445134137142996e+00, 3.754408661907416e+00]
+
+    u = numpy.asarray(u, dtype='d')
+    x = numpy.zeros(u.shape, dtype='d')
+
+    p_low = 0.02425
+    p_high = 1 - p_low
+
+    # Lower tail
+    I = u < p_low
+    q = numpy.sqrt(-2*numpy.log(u[I]))
+    x[I] = ((((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) /
+            ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1))
+
+    # Central region
+    I = (u >= p_low) & (u <= p_high)
+    q = u[I] - 0.5
+    r = q*q
+    x[I] = ((((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q /
+            (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1))
+
+    # Upper tail
+    I = u > p_high
+    q = numpy.sqrt(-2*numpy.log(1 - u[I]))
+    x[I] = -((((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) /
+             ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1))
+
+    return x
+
+
+def check_distribution(name, distribution):
+    """Verify that distribution for parameter name is well formed
+    """
+
+    msg = 'Distribution for %s must be a tuple or list starting ' % name
+    msg += 'with one of %s. I got %s' % (distribution_names, str(distribution))
+    if type(distribution) not in [tuple, list] or len(distribution) == 0:
+        raise Exception(msg)
+
+    kind = distribution[0]
+    if kind not in distribution_names:
+        raise Exception(msg)
+
+    number_of_arguments = {'uniform': 2, 'loguniform': 2, 'normal': 2,
+                           'lognormal': 2, 'triangular': 3, 'choice': 1}
+    if len(distribution) != number_of_arguments[kind] + 1:
+        msg = 'Distribution %s for %s must have %i argument(s). I got %s'\
+            % (kind, name, number_of_arguments[kind], str(distribution))
+        raise Exception(msg)
+
+    if kind in ['uniform', 'loguniform', 'triangular']:
+        if distribution[1] >= distribution[-1]:
+            msg = 'Lower bound of distribution for %s must be less than '\
+                'upper bound. I got %s' % (name, str(distribution))
+            raise Exception(msg)
+
+    if kind == 'loguniform' and distribution[1] <= 0:
+        msg = 'Bounds of loguniform distribution for %s must be positive. '\
+            'I got %s' % (name, str(distribution))
+        raise Exception(msg)
+
+    if kind == 'triangular':
+        low, mode, high = distribution[1:]
+        if not low <= mode <= high:
+            msg = 'Mode of triangular distribution for %s must lie between '\
+                'bounds. I got %s' % (name, str(distribution))
+            raise Exception(msg)
+
+    if kind == 'choice' and len(distribution[1]) == 0:
+        msg = 'Distribution choice for %s must have at least one value' % name
+        raise Exception(msg)
+
+
+def transform_uniform(u, distribution):
+    """Map probabilities u in [0, 1) to values of given distribution
+    """
+
+    kind = distribution[0]
+
+    if kind == 'uniform':
+        low, high = distribution[1:]
+        return low + u*(high - low)
+    elif kind == 'loguniform':
+        low, high = numpy.log(distribution[1:])
+        return numpy.exp(low + u*(high - low))
+    elif kind == 'normal':
+        mean, std = distribution[1:]
+        return mean + std*normal_ppf(u)
+    elif kind == 'lognormal':
+        mean, std = distribution[1:]
+        return numpy.exp(mean + std*normal_ppf(u))
+    elif kind == 'triangular':
+        low, mode, high = distribution[1:]
+        c = float(mode - low)/(high - low)
+        return numpy.where(u < c,
+                           low + numpy.sqrt(u*(high - low)*(mode - low)),
+                           high - numpy.sqrt((1 - u)*(high - low)*(high - mode)))
+    elif kind == 'choice':
+        values = distribution[1]
+        indices = numpy.minimum((u*len(values)).astype('i'), len(values) - 1)
+        return [values[i] for i in indices]
+
+
+def draw_samples(distributions, number_of_samples, method='lhs', seed=None):
+    """Draw samples of scenario parameters
+
+    Input:
+        distributions: Dictionary of parameter names and distributions
+                       (see module documentation)
+        number_of_samples: Number of samples to draw
+        method: 'lhs' for Latin hypercube sampling (default) or
+                'random' for plain Monte Carlo sampling
+        seed: Optional seed for the random number generator so that
+              samples can be reproduced
+
+    Return list of dictionaries each mapping parameter names to values.
+    """
+
+    if method not in sampling_methods:
+        msg = 'Unknown sampling method "%s". Options are %s' % (method,
+                                                               sampling_methods)
+        raise Exception(msg)
+
+    if number_of_samples < 1:
+        msg = 'Number of samples must be at least 1. I got %s' % str(number_of_samples)
+        raise Exception(msg)
+
+    names = distributions.keys()
+    names.sort() # Make samples reproducible for a given seed
+
+    for name in names:
+        check_distribution(name, distributions[name])
+
+    random_state = numpy.random.RandomState(seed)
+
+    samples = [{} for i in range(number_of_samples)]
+    for name in names:
+        if method == 'lhs':
+            # One point in each of number_of_samples strata, randomly paired
+            strata = random_state.permutation(number_of_samples)
+            u = (strata + random_state.random_sample(number_of_samples))/number_of_samples
+        else:
+            u = random_state.random_sample(number_of_samples)
+
+        values = transform_uniform(u, distributions[name])
+        for i in range(number_of_samples):
+            value = values[i]
+            if isinstance(value, numpy.generic):
+                value = value.item() # Plain Python number for scenario scripts
+            samples[i][name] = value
+
+    return samples
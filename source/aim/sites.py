@@ -0,0 +1,478 @@
+"""Hazard curves at points of interest from ensembles of Fall3d results
+
+Sites such as towns, airports or hospitals are read from a CSV file with
+a header naming the columns
+
+    name, latitude, longitude    or    name, easting, northing
+
+Their positions on the Fall3d grid are computed once, either as the
+nearest cell or as the four surrounding cell centres and their bilinear
+weights. Each result file is then read once, one time slice at a time
+and only within the bounding box of the sites, and the following are
+accumulated for every site and threshold:
+
+    Exceedance curve: Percentage of members where the ground load at the
+                      last time step is at least load_values[i]
+    Arrival times:    Percentage of members where the ground load has
+                      reached load_values[i] by each of arrival_times
+                      (hours since the first output) and the average first
+                      arrival time over the members where it does
+    Flight levels:    Percentage of members where the concentration at
+                      flight level FLxxx is at least fl_values[i] at some
+                      time step
+
+These follow the definitions of PLOAD, ISOCHRO and PFL in aim.hazard, so
+the curve of a site at a cell centre matches the hazard map there. The
+cost of a site is that of indexing four values per time slice, so
+thousands of sites take little more than one pass over the results.
+"""
+
+import csv
+import numpy
+
+from Scientific.IO.NetCDF import NetCDFFile
+from coordinate_transforms import redfearn, UTMtoLL
+from hazard import read_grid, check_grid, get_weight, flight_levels
+
+site_hazard_basename = 'HazardSites'
+interpolation_methods = ['nearest', 'bilinear']
+
+# Accepted names of site coordinate columns (west-east, south-north)
+site_columns = {'LON-LAT': [['longitude', 'lon'], ['latitude', 'lat']],
+                'UTM': [['easting', 'x'], ['northing', 'y']]}
+
+
+def read_sites(filename):
+    """Read named points of interest from CSV file
+
+    The first line names the columns. The site names are in the column
+    'name' (or the first column) and the coordinates in the columns
+    'latitude' and 'longitude' (or 'lat' and 'lon') in decimal degrees
+    or 'easting' and 'northing' (or 'x' and 'y') in UTM.
+
+    Return tuple (names, x, y, coordinates) where coordinates is either
+    'LON-LAT' or 'UTM' and x, y are the west-east and south-north
+    coordinates.
+    """
+
+    fid = open(filename)
+    reader = csv.reader(fid)
+    header = [column.strip().lower() for column in reader.next()]
+    rows = [row for row in reader if len(row) > 0 and not row[0].startswith('#')]
+    fid.close()
+
+    if 'name' in header:
+        name_column = header.index('name')
+    else:
+        name_column = 0
+
+    for coordinates in ['LON-LAT', 'UTM']:
+        columns = []
+        for names in site_columns[coordinates]:
+            for name in names:
+                if name in header:
+                    columns.append(header.index(name))
+                    break
+        if len(columns) == 2:
+            break
+    else:
+        msg = 'Sites file %s must have columns latitude and longitude ' % filename
+        msg += 'or easting and northing. I got %s' % header
+        raise Exception(msg)
+
+    names = []
+    x = []
+    y = []
+    for row in rows:
+        names.append(row[name_column].strip())
+        try:
+            x.append(float(row[columns[0]]))
+            y.append(float(row[columns[1]]))
+        except (ValueError, IndexError):
+            msg = 'Invalid coordinates for site %s in file %s' % (row[name_column],
+                                                                 filename)
+            raise Exception(msg)
+
+    return names, numpy.array(x, dtype='d'), numpy.array(y, dtype='d'), coordinates
+
+
+def project_sites(x, y, coordinates, grid_coordinates,
+                  zone=None, southern_hemisphere=False):
+    """Convert site coordinates to the coordinate system of the grid
+
+    Input:
+        x, y: West-east and south-north coordinates of sites
+        coordinates: Coordinate system of sites ('LON-LAT' or 'UTM')
+        grid_coordinates: Coordinate system of Fall3d grid
+        zone: UTM zone of the grid or the sites (e.g. vent_zone)
+        southern_hemisphere: True if UTM sites are south of the equator
+    """
+
+    if coordinates == grid_coordinates:
+        return x, y
+
+    if zone is None:
+        msg = 'UTM zone must be given to convert sites from %s to %s'\
+            % (coordinates, grid_coordinates)
+        raise Exception(msg)
+
+    px = numpy.zeros(len(x), dtype='d')
+    py = numpy.zeros(len(y), dtype='d')
+    for k in range(len(x)):
+        if coordinates == 'LON-LAT':
+            _, px[k], py[k] = redfearn(y[k], x[k], zone=zone)
+        else:
+            py[k], px[k] = UTMtoLL(y[k], x[k], zone, southern_hemisphere)
+
+    return px, py
+
+
+def get_interpolation(grid, nx, ny, sitex, sitey, method='bilinear'):
+    """Precompute cells and weights for sampling a grid at sites
+
+    Input:
+        grid: Fall3d grid (see aim.hazard.read_grid) with nx by ny cells
+              laid out as in the ASCII grids written by nc2asc
+        sitex, sitey: Site coordinates in the coordinate system of the grid
+        method: 'nearest' for the value of the nearest cell or 'bilinear'
+                for bilinear interpolation between cell centres. Sites
+                within half a cell of the boundary take the values of the
+                boundary cells.
+
+    Return tuple (rows, cols, weights, inside) where rows, cols and
+    weights have one row of four cell indices and weights per site and
+    inside flags the sites within the grid. Rows and columns of sites
+    outside the grid are those of the nearest cells and their weights
+    are zero.
+    """
+
+    if method not in interpolation_methods:
+        msg = 'Interpolation method must be one of %s. I got %s'\
+            % (interpolation_methods, method)
+        raise Exception(msg)
+
+    if grid['COORDINATES'] == 'UTM':
+        xmin, ymin, xmax, ymax = [grid[name] for name in ['XMIN', 'YMIN', 'XMAX', 'YMAX']]
+    else:
+        xmin, ymin, xmax, ymax = [grid[name] for name in ['LONMIN', 'LATMIN', 'LONMAX', 'LATMAX']]
+
+    # Fractional cell indices with cell centres at whole numbers
+    fx = (sitex - xmin)/(xmax - xmin)*nx - 0.5
+    fy = (sitey - ymin)/(ymax - ymin)*ny - 0.5
+    inside = (fx >= -0.5) & (fx <= nx - 0.5) & (fy >= -0.5) & (fy <= ny - 0.5)
+
+    fx = numpy.clip(fx, 0, nx - 1)
+    fy = numpy.clip(fy, 0, ny - 1)
+
+    nsites = len(sitex)
+    rows = numpy.zeros((nsites, 4), dtype='i')
+    cols = numpy.zeros((nsites, 4), dtype='i')
+    weights = numpy.zeros((nsites, 4), dtype='d')
+
+    if method == 'nearest':
+        rows[:] = numpy.round(fy).astype('i')[:, numpy.newaxis]
+        cols[:] = numpy.round(fx).astype('i')[:, numpy.newaxis]
+        weights[:, 0] = 1
+    else:
+        i0 = numpy.minimum(numpy.floor(fx).astype('i'), max(nx - 2, 0))
+        j0 = numpy.minimum(numpy.floor(fy).astype('i'), max(ny - 2, 0))
+        i1 = numpy.minimum(i0 + 1, nx - 1)
+        j1 = numpy.minimum(j0 + 1, ny - 1)
+        wx = fx - i0
+        wy = fy - j0
+
+        rows[:, 0], cols[:, 0], weights[:, 0] = j0, i0, (1 - wx)*(1 - wy)
+        rows[:, 1], cols[:, 1], weights[:, 1] = j0, i1, wx*(1 - wy)
+        rows[:, 2], cols[:, 2], weights[:, 2] = j1, i0, (1 - wx)*wy
+        rows[:, 3], cols[:, 3], weights[:, 3] = j1, i1, wx*wy
+
+    weights[~inside] = 0
+
+    return rows, cols, weights, inside
+
+
+class SiteHazard:
+
+    def __init__(self, names, x, y, coordinates, load_values,
+                 fl_values=None, arrival_times=None, method='bilinear',
+                 zone=None, southern_hemisphere=False):
+        """Create empty hazard curves for sites
+
+        Input:
+            names, x, y, coordinates: Sites (see read_sites)
+            load_values: List of ground load thresholds (kg/m^2)
+            fl_values: List of concentration thresholds (g/m^3) at the
+                       flight levels present in the first result file
+            arrival_times: Hours since first output at which to give the
+                           probability of each load having been reached.
+                           Default is the output times of the first file.
+            method: Interpolation method (see get_interpolation)
+            zone, southern_hemisphere: UTM zone and hemisphere used to
+                       convert sites to the grid (see project_sites)
+        """
+
+        self.names = list(names)
+        self.site_x = numpy.array(x, dtype='d')
+        self.site_y = numpy.array(y, dtype='d')
+        self.coordinates = coordinates
+        self.method = method
+        self.zone = zone
+        self.southern_hemisphere = southern_hemisphere
+
+        self.load_values = numpy.array(load_values, dtype='d')
+        if fl_values is None:
+            self.fl_values = numpy.zeros(0, dtype='d')
+        else:
+            self.fl_values = numpy.array(fl_values, dtype='d')
+
+        self.arrival_times = arrival_times
+
+        # Set when first file is read
+        self.grid = None
+        self.number_of_members = 0
+        self.total_weight = 0.0
+
+    def initialise(self, infile, times):
+        """Locate sites on grid and allocate counters from first result file
+        """
+
+        self.grid, self.x, self.y = read_grid(infile)
+
+        if len(self.fl_values) > 0:
+            self.flight_levels = [fl for fl in flight_levels
+                                  if 'C_' + fl in infile.variables]
+        else:
+            self.flight_levels = []
+
+        if self.arrival_times is None:
+            self.arrival_times = times - times[0]
+        self.arrival_times = numpy.array(self.arrival_times, dtype='d')
+
+        # Interpolation is computed once for all members
+        x, y = project_sites(self.site_x, self.site_y, self.coordinates,
+                             self.grid['COORDINATES'], zone=self.zone,
+                             southern_hemisphere=self.southern_hemisphere)
+        rows, cols, self.weights, self.inside = get_interpolation(self.grid,
+                                                                  len(self.x), len(self.y),
+                                                                  x, y, method=self.method)
+
+        # Only the bounding box of the sites is read
+        self.window = (rows.min(), rows.max() + 1, cols.min(), cols.max() + 1)
+        self.rows = rows - self.window[0]
+        self.cols = cols - self.window[2]
+
+        nsites = len(self.names)
+        nload = len(self.load_values)
+        nfl = len(self.fl_values)
+
+        # Counts are sums of member weights
+        self.pload = numpy.zeros((nsites, nload), dtype='d')
+        self.arrival_count = numpy.zeros((nsites, nload, len(self.arrival_times)), dtype='d')
+        self.arrival_sum = numpy.zeros((nsites, nload), dtype='d')
+        self.reached = numpy.zeros((nsites, nload), dtype='d')
+        self.pfl = {}
+        for fl in self.flight_levels:
+            self.pfl[fl] = numpy.zeros((nsites, nfl), dtype='d')
+
+    def sample(self, variable, it):
+        """Get values of variable at sites at time step it
+        """
+
+        j0, j1, i0, i1 = self.window
+        field = numpy.array(variable[it, j0:j1, i0:i1], dtype='d')
+
+        return numpy.sum(self.weights*field[self.rows, self.cols], axis=1)
+
+    def add(self, filename, weight=1.0):
+        """Add Fall3d result file to the hazard curves with given weight
+        """
+
+        infile = NetCDFFile(filename)
+
+        load = infile.variables['LOAD']
+        nt = load.shape[0]
+
+        if 'time' in infile.variables:
+            times = numpy.array(infile.variables['time'][:], dtype='d')
+        else:
+            times = numpy.arange(nt, dtype='d')
+
+        if self.grid is None:
+            self.initialise(infile, times)
+        else:
+            check_grid(infile, filename, self.grid, self.x, self.y)
+
+        for fl in self.flight_levels:
+            if 'C_' + fl not in infile.variables:
+                msg = 'Variable C_%s was not found in file %s' % (fl, filename)
+                raise Exception(msg)
+
+        nsites = len(self.names)
+        arrival = -numpy.ones((nsites, len(self.load_values)), dtype='d')
+        found = {}
+        for fl in self.flight_levels:
+            found[fl] = numpy.zeros((nsites, len(self.fl_values)), dtype=bool)
+
+        for it in range(nt):
+            exceeded = self.sample(load, it)[:, numpy.newaxis] >= self.load_values
+
+            first = exceeded & (arrival == -1)
+            arrival[first] = times[it] - times[0]
+
+            for fl in self.flight_levels:
+                concentration = self.sample(infile.variables['C_' + fl], it)
+                found[fl] |= concentration[:, numpy.newaxis] >= self.fl_values
+
+        infile.close()
+
+        # Sites outside the grid are never reached
+        exceeded &= self.inside[:, numpy.newaxis]
+        reached = (arrival > -1) & self.inside[:, numpy.newaxis]
+
+        self.pload += weight*exceeded
+        self.arrival_sum[reached] += weight*arrival[reached]
+        self.reached += weight*reached
+        self.arrival_count += weight*(reached[:, :, numpy.newaxis] &
+                                      (arrival[:, :, numpy.newaxis] <= self.arrival_times))
+        for fl in self.flight_levels:
+            self.pfl[fl] += weight*(found[fl] & self.inside[:, numpy.newaxis])
+
+        self.number_of_members += 1
+        self.total_weight += weight
+
+    def get_curves(self):
+        """Return exceedance percentages of load values, one row per site
+        """
+
+        return 100*self.pload/self.total_weight
+
+    def get_arrival(self):
+        """Return arrival time distributions
+
+        Return tuple (probability, mean) where probability[k, i, m] is the
+        percentage of members where load_values[i] is reached at site k
+        by arrival_times[m] and mean[k, i] is the average first arrival
+        time over the members where it is reached (-1 where it never is).
+        """
+
+        probability = 100*self.arrival_count/self.total_weight
+        mean = -numpy.ones(self.reached.shape, dtype='d')
+        reached = self.reached > 0
+        mean[reached] = self.arrival_sum[reached]/self.reached[reached]
+
+        return probability, mean
+
+    def get_fl_curves(self):
+        """Return dictionary of flight level exceedance percentages
+        """
+
+        curves = {}
+        for fl in self.flight_levels:
+            curves[fl] = 100*self.pfl[fl]/self.total_weight
+
+        return curves
+
+    def write(self, basename):
+        """Write hazard curves to CSV files
+
+        Input:
+            basename: Path and start of file names, e.g.
+                      <model_output_directory>/HazardSites
+
+        The exceedance curves are written to <basename>.load.csv, the
+        arrival time distributions to <basename>.arrival.csv and, if
+        computed, the flight level exceedance to <basename>.fl.csv.
+        Sites outside the grid are flagged in the column inside.
+
+        Return list of files written.
+        """
+
+        if self.number_of_members == 0:
+            msg = 'Site hazard curves have no members'
+            raise Exception(msg)
+
+        xname, yname = [names[0] for names in site_columns[self.coordinates]]
+        filenames = []
+
+        filename = basename + '.load.csv'
+        fid = open(filename, 'w')
+        writer = csv.writer(fid)
+        writer.writerow(['name', xname, yname, 'inside'] +
+                        ['P(LOAD>=%g)' % value for value in self.load_values])
+        for k, values in enumerate(self.get_curves()):
+            writer.writerow([self.names[k], self.site_x[k], self.site_y[k],
+                             int(self.inside[k])] + ['%.3f' % value for value in values])
+        fid.close()
+        filenames.append(filename)
+
+        filename = basename + '.arrival.csv'
+        probability, mean = self.get_arrival()
+        fid = open(filename, 'w')
+        writer = csv.writer(fid)
+        writer.writerow(['name', 'load', 'mean_arrival'] +
+                        ['P(t<=%g)' % t for t in self.arrival_times])
+        for k, name in enumerate(self.names):
+            for i, value in enumerate(self.load_values):
+                writer.writerow([name, '%g' % value, '%.3f' % mean[k, i]] +
+                                ['%.3f' % p for p in probability[k, i]])
+        fid.close()
+        filenames.append(filename)
+
+        if self.flight_levels:
+            filename = basename + '.fl.csv'
+            curves = self.get_fl_curves()
+            fid = open(filename, 'w')
+            writer = csv.writer(fid)
+            writer.writerow(['name', 'flight_level'] +
+                            ['P(C>=%g)' % value for value in self.fl_values])
+            for k, name in enumerate(self.names):
+                for fl in self.flight_levels:
+                    writer.writerow([name, fl] + ['%.3f' % p for p in curves[fl][k]])
+            fid.close()
+            filenames.append(filename)
+
+        return filenames
+
+
+def compute_site_hazard(filenames, sitesfilename, load_values, fl_values=None,
+                        arrival_times=None, method='bilinear', weights=None,
+                        zone=None, southern_hemisphere=False,
+                        outputbasename=None, verbose=True):
+    """Compute hazard curves at sites from list of Fall3d result files
+
+    Input:
+        filenames: List of Fall3d NetCDF result files
+        sitesfilename: CSV file with sites (see read_sites)
+        load_values, fl_values, arrival_times, method, zone,
+        southern_hemisphere: See SiteHazard
+        weights: Optional dictionary of member weights (see
+                 aim.hazard.get_member_weights). Default is equal weights.
+        outputbasename: Optional path and start of CSV files to write the
+                        result to (see SiteHazard.write)
+
+    Return SiteHazard instance.
+    """
+
+    names, x, y, coordinates = read_sites(sitesfilename)
+    if verbose:
+        print 'Computing hazard curves for %i sites from %i files' % (len(names),
+                                                                     len(filenames))
+
+    site_hazard = SiteHazard(names, x, y, coordinates, load_values,
+                             fl_values=fl_values, arrival_times=arrival_times,
+                             method=method, zone=zone,
+                             southern_hemisphere=southern_hemisphere)
+
+    for i, filename in enumerate(filenames):
+        if verbose:
+            print 'Reading %s (%i of %i)' % (filename, i+1, len(filenames))
+        site_hazard.add(filename, weight=get_weight(weights, filename))
+
+    outside = len(names) - site_hazard.inside.sum()
+    if outside > 0:
+        print 'WARNING: %i of %i sites are outside the grid' % (outside, len(names))
+
+    if outputbasename is not None:
+        site_hazard.write(outputbasename)
+
+    return site_hazard
@@ -0,0 +1,281 @@
+"""Dependency graph of the stages making up an AIM scenario run
+
+Each stage corresponds to a method of class AIM and declares what it
+depends on:
+
+    files:    Input files (templates filled in from the AIM instance)
+    sections: Sections of the Fall3d input file
+    params:   Model parameters
+    depends:  Upstream stages whose outputs are used
+    outputs:  Files produced (templates filled in from the AIM instance)
+    products: Name of AIM method listing files produced whose names are
+              only known at run time, e.g. one grid per time step
+
+A fingerprint is computed for each stage from these inputs and the
+fingerprints of its upstream stages and stored in the output directory
+once the stage has completed. When a scenario is re-run in the same
+output directory only stages whose fingerprint has changed, or whose
+outputs are missing, are executed - much like make. Changing a contour
+level, for instance, reruns the post processing but not Fall3d.
+"""
+
+import os
+import json
+import hashlib
+
+from cache import get_input_file_section
+from manifest import compute_checksum
+
+fingerprint_extension = '.stages.json'
+
+stages = [{'name': 'topography',
+           'method': 'generate_topography',
+           'files': ['%(topography_grid)s', '%(projection_file)s',
+                     '%(scenario_name)s.top'], # Native Fall3d topography
+           'params': ['X_coordinate_minimum', 'X_coordinate_maximum',
+                      'Y_coordinate_minimum', 'Y_coordinate_maximum'],
+           'outputs': ['%(topography)s']},
+          {'name': 'granum',
+           'method': 'set_granum',
+           'sections': ['GRANULOMETRY'],
+           'outputs': ['%(grainfile)s']},
+          {'name': 'database',
+           'method': 'set_database',
+           'files': ['%(wind_profile)s'],
+           'sections': ['TIME_UTC', 'GRID'],
+           'depends': ['topography'],
+           'outputs': ['%(databasefile)s']},
+          {'name': 'source',
+           'method': 'set_source',
+           'sections': ['TIME_UTC', 'GRID', 'SOURCE'],
+           'depends': ['granum', 'database'],
+           'outputs': ['%(sourcefile)s']},
+          {'name': 'fall3d',
+           'method': 'run_fall3d',
+           'files': ['%(inputfile)s'],
+           'depends': ['granum', 'database', 'source'],
+           'outputs': ['%(resultfile)s.nc']},
+          {'name': 'postprocess',
+           'method': 'postprocess',
+           'files': ['%(projection_file)s'],
+           'params': ['load_contours', 'thickness_contours',
+                      'thickness_units', 'ascii_subdatasets',
+                      'ascii_number_format'],
+           'depends': ['fall3d'],
+           'products': 'get_postprocess_outputs'}]
+
+# Scenario parameters (in lower case) that enter the GRANULOMETRY section
+# of the Fall3d input file. They are the only inputs to SetGrn.
+granulometry_parameters = ['grainsize_distribution',
+                           'number_of_grainsize_classes', 'mean_grainsize',
+                           'sorting', 'minimum_grainsize', 'maximum_grainsize',
+                           'density_minimum', 'density_maximum',
+                           'sphericity_minimum', 'sphericity_maximum']
+
+# Scenario parameters (in lower case) that only enter the Fall3d input
+# file in the SOURCE, FALL3D and POSTPROCESS sections or are only used for
+# post processing. They do not affect the SetGrn and SetDbs stages.
+downstream_parameters = ['vent_height', 'source_type', 'mass_eruption_rate',
+                         'height_above_vent', 'a', 'l', 'height_or_mfr',
+                         'mfr_minimum', 'mfr_maximum', 'exit_velocity',
+                         'exit_temperature', 'exit_volatile_fraction',
+                         'terminal_velocity_model',
+                         'vertical_turbulence_model',
+                         'horizontal_turbulence_model',
+                         'vertical_diffusion_coefficient',
+                         'horizontal_diffusion_coefficient', 'value_of_cs',
+                         'load_contours', 'thickness_contours',
+                         'thickness_units', 'ascii_subdatasets',
+                         'ascii_number_format']
+
+
+def get_upstream_key(params, names, stage):
+    """Identify the inputs to SetGrn or SetDbs among given parameters
+
+    Input:
+        params: Dictionary of scenario parameters
+        names: Names of parameters to consider (e.g. those being varied)
+        stage: Either 'granum' or 'database'
+
+    Scenarios with the same key for stage 'granum' share the grain size
+    file and scenarios with the same key for stage 'database' share the
+    meteorological database. Parameters that are neither granulometry nor
+    downstream parameters are taken to affect the database.
+    """
+
+    if stage not in ['granum', 'database']:
+        msg = 'Stage must be either granum or database. I got %s' % stage
+        raise Exception(msg)
+
+    key = []
+    for name in names:
+        if name.lower() in granulometry_parameters:
+            if stage == 'granum':
+                key.append((name, repr(params[name])))
+        elif name.lower() not in downstream_parameters:
+            if stage == 'database':
+                key.append((name, repr(params[name])))
+
+    return tuple(key)
+
+
+def get_sweep_rounds(combinations, names):
+    """Assign combinations of a parameter sweep to rounds
+
+    Input:
+        combinations: List of dictionaries of scenario parameters
+        names: Names of parameters being varied
+
+    Combinations needing a grain size file or a meteorological database
+    that no earlier combination needs are put in the earliest round where
+    no other combination needs the same files. The remaining combinations
+    are put in a final round after all others.
+
+    Return list with the round number of each combination.
+    """
+
+    rounds = []
+    round_keys = []
+    known_keys = set()
+    for params in combinations:
+        keys = set([(stage, get_upstream_key(params, names, stage))
+                    for stage in ['granum', 'database']])
+        if keys.issubset(known_keys):
+            # Uses only files made in earlier rounds
+            rounds.append(None)
+            continue
+        known_keys.update(keys)
+
+        r = 0
+        while r < len(round_keys) and round_keys[r] & keys:
+            r += 1
+        if r == len(round_keys):
+            round_keys.append(set())
+        round_keys[r].update(keys)
+        rounds.append(r)
+
+    last = len(round_keys)
+    return [last if r is None else r for r in rounds]
+
+
+def compute_fingerprint(aim, stage, fingerprints):
+    """Compute fingerprint of stage
+
+    Input:
+        aim: AIM instance for which the stage is run
+        stage: Dictionary describing the stage (see stages)
+        fingerprints: Dictionary of fingerprints of upstream stages
+    """
+
+    m = hashlib.md5()
+    m.update('%s:%s\n' % (stage['name'], stage['method']))
+
+    for template in stage.get('files', []):
+        filename = template % aim.__dict__
+        if os.path.isfile(filename):
+            checksum = compute_checksum(filename)
+        else:
+            checksum = 'missing'
+        m.update('file %s=%s\n' % (filename, checksum))
+
+    for section in stage.get('sections', []):
+        m.update('section %s=%s\n' % (section,
+                                      get_input_file_section(aim.inputfile,
+                                                             section)))
+
+    for name in stage.get('params', []):
+        m.update('param %s=%s\n' % (name, repr(aim.params.get(name))))
+
+    for name in stage.get('depends', []):
+        m.update('stage %s=%s\n' % (name, fingerprints[name]))
+
+    return m.hexdigest()
+
+
+def read_fingerprints(filename):
+    """Read fingerprints of previously completed stages
+    """
+
+    if not os.path.isfile(filename):
+        return {}
+
+    fid = open(filename)
+    try:
+        fingerprints = json.load(fid)
+    except ValueError:
+        # Unreadable record - treat all stages as out of date
+        fingerprints = {}
+    fid.close()
+
+    return fingerprints
+
+
+def write_fingerprints(filename, fingerprints):
+    """Write fingerprints of completed stages atomically
+    """
+
+    tmpname = filename + '.tmp'
+    fid = open(tmpname, 'w')
+    json.dump(fingerprints, fid, indent=2, sort_keys=True)
+    fid.close()
+    os.rename(tmpname, filename)
+
+
+def run_stages(aim, names=None, verbose=True):
+    """Run out of date stages for AIM instance
+
+    Input:
+        aim: AIM instance. The Fall3d input file must have been written.
+        names: Optional list of stage names to consider. Default is all.
+        verbose: Print which stages are run and which are skipped
+
+    Return list of names of stages that were run.
+    """
+
+    if names is None:
+        names = [stage['name'] for stage in stages]
+
+    filename = aim.basepath + fingerprint_extension
+    previous = read_fingerprints(filename)
+    completed = previous.copy()
+
+    fingerprints = {}
+    executed = []
+    for stage in stages:
+        name = stage['name']
+        if name not in names:
+            continue
+
+        for upstream in stage.get('depends', []):
+            if upstream not in fingerprints:
+                msg = 'Stage %s depends on stage %s ' % (name, upstream)
+                msg += 'which has not been run'
+                raise Exception(msg)
+
+        fingerprint = compute_fingerprint(aim, stage, fingerprints)
+        fingerprints[name] = fingerprint
+
+        outputs = [template % aim.__dict__
+                   for template in stage.get('outputs', [])]
+        if 'products' in stage:
+            outputs += getattr(aim, stage['products'])()
+        missing = [x for x in outputs if not os.path.isfile(x)]
+
+        if previous.get(name) == fingerprint and len(missing) == 0:
+            if verbose:
+                print 'Stage %s is up to date' % name
+            continue
+
+        # Invalidate record until the stage has completed
+        if name in completed:
+            del completed[name]
+            write_fingerprints(filename, completed)
+
+        method = getattr(aim, stage['method'])
+        method(verbose=verbose)
+
+        completed[name] = fingerprint
+        write_fingerprints(filename, completed)
+        executed.append(name)
+
+    return executed
@@ -0,0 +1,283 @@
+"""Summary statistics of ensembles of Fall3d results
+
+For each cell, the following statistics of the final ground load and
+deposit thickness are computed across the members of an ensemble:
+
+    <FIELD>_MEAN:  Mean
+    <FIELD>_STD:   Standard deviation
+    <FIELD>_MAX:   Maximum
+    <FIELD>_Pxx:   xx'th percentile, e.g. LOAD_P50 for the median
+
+Each result file is read once and only the last time step is used. Mean
+and standard deviation are running moments (Welford's method) and the
+percentiles are estimated with the P^2 algorithm of Jain and Chlamtac
+(1985), which keeps five markers per cell. Memory use is therefore
+independent of the number of members.
+
+The result is written in the same format as HazardMaps.res.nc so the
+variables can be converted with nc2asc and contoured.
+"""
+
+import numpy
+
+from Scientific.IO.NetCDF import NetCDFFile
+from hazard import read_grid, check_grid, write_grid_variables
+
+summary_filename = 'EnsembleSummary.res.nc'
+summary_fields = ['LOAD', 'THICKNESS']
+summary_quantiles = [0.5, 0.9]
+
+
+class P2Quantile:
+
+    def __init__(self, p, shape):
+        """Create streaming estimator of the p-quantile in each cell
+
+        Input:
+            p: Probability between 0 and 1, e.g. 0.9 for the 90th percentile
+            shape: Grid shape
+        """
+
+        if not 0 < p < 1:
+            msg = 'Quantile must be between 0 and 1. I got %s' % str(p)
+            raise Exception(msg)
+
+        self.p = p
+        self.count = 0
+
+        # Marker heights and (zero based) positions
+        self.q = numpy.zeros((5,) + tuple(shape), dtype='d')
+        self.n = numpy.zeros((5,) + tuple(shape), dtype='d')
+        for i in range(5):
+            self.n[i] = i
+
+        # Desired positions and their increments
+        self.desired = numpy.array([0, 2*p, 4*p, 2 + 2*p, 4], dtype='d')
+        self.increments = numpy.array([0, p/2, p, (1 + p)/2, 1], dtype='d')
+
+    def add(self, x):
+        """Add one observation for each cell
+        """
+
+        x = numpy.asarray(x, dtype='d')
+        q = self.q
+        n = self.n
+
+        if self.count < 5:
+            # Store the first five observations as they are
+            q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                q.sort(axis=0)
+            return
+
+        # Extend range if needed and find cell k with q[k] <= x < q[k+1]
+        q[0] = numpy.minimum(q[0], x)
+        q[4] = numpy.maximum(q[4], x)
+        k = (q[1] <= x).astype('i') + (q[2] <= x) + (q[3] <= x)
+
+        for i in range(1, 5):
+            n[i] += i > k
+        self.desired += self.increments
+
+        # Adjust middle markers that are off their desired positions
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            up = (d >= 1) & (n[i+1] - n[i] > 1)
+            down = (d <= -1) & (n[i-1] - n[i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+
+            s = numpy.where(up, 1.0, -1.0)
+
+            # Piecewise parabolic prediction
+            parabolic = q[i] + s/(n[i+1] - n[i-1])*((n[i] - n[i-1] + s)*(q[i+1] - q[i])/(n[i+1] - n[i]) +
+                                                    (n[i+1] - n[i] - s)*(q[i] - q[i-1])/(n[i] - n[i-1]))
+
+            # Linear prediction where parabolic one is out of order
+            qj = numpy.where(up, q[i+1], q[i-1])
+            nj = numpy.where(up, n[i+1], n[i-1])
+            linear = q[i] + s*(qj - q[i])/(nj - n[i])
+
+            ordered = (q[i-1] < parabolic) & (parabolic < q[i+1])
+            q[i] = numpy.where(move, numpy.where(ordered, parabolic, linear), q[i])
+            n[i] = numpy.where(move, n[i] + s, n[i])
+
+        self.count += 1
+
+    def get(self):
+        """Return estimated quantile in each cell
+
+        With fewer than five observations the quantile is interpolated
+        from the sorted observations.
+        """
+
+        if self.count == 0:
+            msg = 'No observations'
+            raise Exception(msg)
+
+        if self.count >= 5:
+            return self.q[2].copy()
+
+        values = numpy.sort(self.q[:self.count], axis=0)
+        position = self.p*(self.count - 1)
+        lower = int(numpy.floor(position))
+        upper = min(lower + 1, self.count - 1)
+        fraction = position - lower
+
+        return values[lower] + fraction*(values[upper] - values[lower])
+
+
+class EnsembleSummary:
+
+    def __init__(self, fields=None, quantiles=None):
+        """Create empty ensemble summary
+
+        Input:
+            fields: List of Fall3d result variables to summarise. Default
+                    is those of summary_fields present in the first file.
+            quantiles: List of probabilities for which to estimate
+                       percentiles. Default is summary_quantiles.
+        """
+
+        if quantiles is None:
+            quantiles = summary_quantiles
+
+        self.fields = fields
+        self.quantiles = list(quantiles)
+
+        # Set when first file is read
+        self.grid = None
+        self.number_of_members = 0
+
+    def initialise(self, infile):
+        """Record grid and allocate accumulators from first result file
+        """
+
+        self.grid, self.x, self.y = read_grid(infile)
+        shape = (len(self.y), len(self.x))
+
+        if self.fields is None:
+            self.fields = [field for field in summary_fields
+                           if field in infile.variables]
+
+        self.units = {}
+        self.mean = {}
+        self.m2 = {}
+        self.maximum = {}
+        self.sketches = {}
+        for field in self.fields:
+            if field not in infile.variables:
+                msg = 'Variable %s was not found in Fall3d result' % field
+                raise Exception(msg)
+
+            self.units[field] = getattr(infile.variables[field], 'units', '')
+            self.mean[field] = numpy.zeros(shape, dtype='d')
+            self.m2[field] = numpy.zeros(shape, dtype='d')
+            self.maximum[field] = numpy.zeros(shape, dtype='d')
+            self.sketches[field] = [P2Quantile(p, shape) for p in self.quantiles]
+
+    def add(self, filename):
+        """Add last time step of Fall3d result file to summary
+        """
+
+        infile = NetCDFFile(filename)
+
+        if self.grid is None:
+            self.initialise(infile)
+        else:
+            check_grid(infile, filename, self.grid, self.x, self.y)
+
+        self.number_of_members += 1
+        N = self.number_of_members
+
+        for field in self.fields:
+            if field not in infile.variables:
+                msg = 'Variable %s was not found in file %s' % (field, filename)
+                raise Exception(msg)
+
+            variable = infile.variables[field]
+            data = numpy.array(variable[variable.shape[0] - 1], dtype='d')
+
+            delta = data - self.mean[field]
+            self.mean[field] += delta/N
+            self.m2[field] += delta*(data - self.mean[field])
+
+            if N == 1:
+                self.maximum[field][:] = data
+            else:
+                self.maximum[field] = numpy.maximum(self.maximum[field], data)
+
+            for sketch in self.sketches[field]:
+                sketch.add(data)
+
+        infile.close()
+
+    def get_variables(self):
+        """Return dictionary of summary variables as 2D arrays
+
+        Each entry is a tuple (data, description, units, value) where
+        value is the probability of a percentile and None otherwise.
+        """
+
+        if self.number_of_members == 0:
+            msg = 'Ensemble summary has no members'
+            raise Exception(msg)
+
+        N = self.number_of_members
+
+        variables = {}
+        for field in self.fields:
+            units = self.units[field]
+            name = field.lower()
+
+            variables[field + '_MEAN'] = (self.mean[field],
+                                          'Ensemble mean of %s' % name,
+                                          units, None)
+            variables[field + '_STD'] = (numpy.sqrt(self.m2[field]/N),
+                                         'Ensemble standard deviation of %s' % name,
+                                         units, None)
+            variables[field + '_MAX'] = (self.maximum[field],
+                                         'Ensemble maximum of %s' % name,
+                                         units, None)
+
+            for p, sketch in zip(self.quantiles, self.sketches[field]):
+                percentile = 100*p
+                variables[field + '_P%g' % percentile] = (sketch.get(),
+                                                          'Ensemble %g percentile of %s' % (percentile, name),
+                                                          units, p)
+
+        return variables
+
+    def write(self, filename):
+        """Write summary to NetCDF file in the format of HazardMaps.res.nc
+        """
+
+        write_grid_variables(filename, self.get_variables(),
+                             self.grid, self.x, self.y)
+
+
+def compute_summary(filenames, fields=None, quantiles=None,
+                    outputfilename=None, verbose=True):
+    """Compute summary statistics from list of Fall3d result files
+
+    Input:
+        filenames: List of Fall3d NetCDF result files
+        fields, quantiles: See EnsembleSummary
+        outputfilename: Optional name of NetCDF file to write the result to
+
+    Return EnsembleSummary instance.
+    """
+
+    summary = EnsembleSummary(fields=fields, quantiles=quantiles)
+
+    for i, filename in enumerate(filenames):
+        if verbose:
+            print 'Reading %s (%i of %i)' % (filename, i+1, len(filenames))
+        summary.add(filename)
+
+    if outputfilename is not None:
+        summary.write(outputfilename)
+
+    return summary
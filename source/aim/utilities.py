@@ -6,17 +6,31 @@ import os, sys
 from math import sqrt, pi, sin, cos, acos
 from subprocess import Popen, PIPE
 from config import update_marker, tephra_output_dir, fall3d_distro
+from process import Command
 import numpy
 import logging
 import time
 import string
+import threading
+import Queue
 from Scientific.IO.NetCDF import NetCDFFile
 
 
 def run(cmd,
         stdout=None,
         stderr=None,
+        timeout=None,
+        follow=None,
         verbose=True):
+    """Run shell command and raise exception if it fails
+
+    Optional arguments:
+        stdout, stderr: Files to which output is written
+        timeout: Wall clock limit in seconds after which the command
+                 (and anything it has started) is killed
+        follow: File (e.g. log file) whose lines are printed as they
+                are written while the command runs
+    """
 
     s = cmd
     if stdout:
@@ -27,12 +41,14 @@ def run(cmd,
 
     if verbose:
         print s
-    err = os.system(s)
+
+    command = Command(cmd, stdout=stdout, stderr=stderr,
+                      timeout=timeout, follow=follow)
+    command.start()
+    err = command.wait()
 
     if err != 0:
-        msg = 'Command "%s" failed with errorcode %i. ' % (cmd, err)
-        if stdout and stderr: msg += 'See logfiles %s and %s for details' % (stdout, stderr)
-        raise Exception(msg)
+        raise Exception(command.describe_failure())
 
     return err
 
@@ -228,9 +244,12 @@ def check_presence_of_required_parameters(params):
 
 
 
-def build_output_dir(tephra_output_dir='tephra', type_name='scenarios', scenario_name='none', dircomment='', store_locally=True, timestamp_output=True):
+def build_output_dir(tephra_output_dir='tephra', type_name='scenarios', scenario_name='none', dircomment='', store_locally=True, timestamp_output=True, clean=True):
     """Build output datastructure like
          $TEPHRADATA/<scenario>/<user>/<scenario>_user_timestamp
+
+    If timestamp_output is False, any previous output in the directory
+    is removed unless clean is False.
     """
 
     if store_locally:
@@ -263,7 +282,7 @@ def build_output_dir(tephra_output_dir='tephra', type_name='scenarios', scenario
 
     output_dir = os.path.join(output_dir, scenario_dir)
 
-    if not timestamp_output:
+    if not timestamp_output and clean:
         try:
             os.listdir(output_dir)
         except:
@@ -597,8 +616,20 @@ def calculate_extrema(filename, verbose=False):
     return min_val, max_val
 
 
-def _write_ascii(header, data, asciifilename, projection):
+def _write_ascii(header, data, asciifilename, projection,
+                 number_format='%f', block_size=2**16):
     """Internal function to write ASCII data from NetCDF. Used by nc2asc.
+
+    Input:
+        number_format: Format of each value, e.g. '%.3f' or the compact '%g'.
+                       The default '%f' gives six decimals.
+        block_size: Approximate number of values formatted per write
+
+    Whole blocks of rows are formatted by one string operation, so the
+    cost per value is that of the C formatting code.
+
+    Return tuple (min, max) of the values as written, or None if there
+    are none, so that contouring does not need to read the grid back.
     """
 
     rows = data.shape[0]
@@ -609,10 +640,14 @@ def _write_ascii(header, data, asciifilename, projection):
     outfile = open(asciifilename, 'w')
     outfile.write(header)
 
-    for j in range(rows)[::-1]: # Rows are upside down
-        for i in range(cols):
-            outfile.write('%f ' % data[j, i])
-        outfile.write('\n')
+    # Rows are upside down
+    data = numpy.asarray(data)[::-1, :]
+
+    rows_per_block = max(1, block_size/max(cols, 1))
+    row_format = (number_format + ' ')*cols + '\n'
+    for j in range(0, rows, rows_per_block):
+        block = data[j:j + rows_per_block]
+        outfile.write((row_format*block.shape[0]) % tuple(block.ravel().tolist()))
 
     outfile.close()
 
@@ -622,43 +657,166 @@ def _write_ascii(header, data, asciifilename, projection):
         fid.write(projection)
         fid.close()
 
+    # Extrema of the formatted values are those of the rounded data
+    if data.size > 0 and not numpy.isnan(data).all():
+        return (float(number_format % numpy.nanmin(data)),
+                float(number_format % numpy.nanmax(data)))
+    else:
+        return None
+
+
+
+def read_time_slices(infile, names, chunk_size=1, prefetch=True,
+                     time_range=None):
+    """Iterate over time slices of variables in open NetCDF file
+
+    Input:
+        infile: Open NetCDF file
+        names: Names of variables with dimensions (time, y, x)
+        chunk_size: Number of time steps read at once
+        prefetch: If True, the next chunk is read in a background thread
+                  while the current one is being processed
+        time_range: Optional tuple (first, stop) limiting the time steps
+                    to first, first+1, ..., stop-1
+
+    Yield tuples (k, slices) where slices is a dictionary of the 2D
+    arrays of each variable at time step k. At most three chunks are held
+    in memory at a time, so memory use is proportional to chunk_size grids
+    rather than to the number of time steps.
+    """
+
+    first = 0
+    stop = infile.variables[names[0]].shape[0]
+    if time_range is not None:
+        first = max(first, time_range[0])
+        stop = min(stop, time_range[1])
+    starts = range(first, stop, chunk_size)
+
+    def read(start):
+        chunk = {}
+        for name in names:
+            chunk[name] = numpy.array(infile.variables[name][start:min(start + chunk_size, stop)])
+        return start, chunk
+
+    if not prefetch or len(starts) < 2:
+        for start in starts:
+            _, chunk = read(start)
+            for i in range(chunk[names[0]].shape[0]):
+                slices = {}
+                for name in names:
+                    slices[name] = chunk[name][i]
+                yield start + i, slices
+        return
+
+    queue = Queue.Queue(maxsize=1)
+    done = threading.Event()
+
+    def put(item):
+        # Give up if iteration is abandoned
+        while not done.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            else:
+                return
+
+    def reader():
+        try:
+            for start in starts:
+                if done.is_set():
+                    return
+                put(read(start))
+        except Exception, e:
+            put(e)
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        for _ in starts:
+            item = queue.get()
+            if isinstance(item, Exception):
+                raise item
+
+            start, chunk = item
+            for i in range(chunk[names[0]].shape[0]):
+                slices = {}
+                for name in names:
+                    slices[name] = chunk[name][i]
+                yield start + i, slices
+    finally:
+        # Make sure the file is no longer read when iteration ends
+        done.set()
+        thread.join()
 
 
 def nc2asc(ncfilename,
            subdataset,
            projection=None,
-           verbose=False):
-    """Extract given subdataset from ncfile name and create one ASCII file for each band.
+           verbose=False,
+           number_format='%f',
+           chunk_size=1,
+           prefetch=True,
+           time_range=None,
+           extrema=None):
+    """Extract given subdataset(s) from ncfile name and create one ASCII file for each band.
 
     This function is reading the NetCDF file using the Python Library Scientific.IO.NetCDF
 
-    Time is assumed to be in whole hours.
+    Input:
+        subdataset: Name of variable or list of names, e.g. ['LOAD', 'THICKNESS']
+
+    The file is opened and its header computed once, and all variables are
+    written for each time slice in a single pass over the time axis.
+    Time slices are read chunk_size at a time, with the next chunk read
+    while the current one is written if prefetch is True (see
+    read_time_slices), so the whole variable is never held in memory.
+    If time_range is given as (first, stop), only those time steps are
+    written so that the steps of one file can be split across processes.
+
+    Time is assumed to be in whole hours. Values are written with
+    number_format (see _write_ascii).
+
+    If a dictionary is given as extrema, the (min, max) of each ASCII file
+    written is stored in it under the basename of the file for use by
+    generate_contours.
+
+    Return list of ASCII files written.
     """
 
 
+    if isinstance(subdataset, basestring):
+        subdatasets = [subdataset]
+    else:
+        subdatasets = list(subdataset)
+
     basename, _ = os.path.splitext(ncfilename) # Get rid of .nc
     basename, _ = os.path.splitext(basename)   # Get rid of .res
 
     if verbose:
-        print 'Converting layer %s in file %s to ASCII files' % (subdataset,
-                                                                 ncfilename)
+        print 'Converting layers %s in file %s to ASCII files' % (', '.join(subdatasets),
+                                                                  ncfilename)
 
 
     infile = NetCDFFile(ncfilename)
 
     layers = infile.variables.keys()
 
+    cols = infile.dimensions['x']
+    rows = infile.dimensions['y']
 
+    for subdataset in subdatasets:
+        msg = 'Subdataset %s was not found in file %s. Options are %s.' % (subdataset, ncfilename, layers)
+        assert subdataset in layers, msg
 
+        shape = infile.variables[subdataset].shape
+        msg = 'Data must have 3 dimensions: Time, X and Y. I got shape: %s' % str(shape)
+        assert len(shape) == 3, msg
 
-    msg = 'Subdataset %s was not found in file %s. Options are %s.' % (subdataset, ncfilename, layers)
-    assert subdataset in layers, msg
-
-
-    A = infile.variables[subdataset].getValue()
-    msg = 'Data must have 3 dimensions: Time, X and Y. I got shape: %s' % str(A.shape)
-    assert len(A.shape) == 3, msg
-
+        assert shape[1] == rows
+        assert shape[2] == cols
 
     if 'time' in infile.variables:
         units = infile.variables['time'].units
@@ -666,13 +824,8 @@ def nc2asc(ncfilename,
         assert units == 'h', msg
 
         times = infile.variables['time'].getValue()
-        assert A.shape[0] == len(times)
-
-    cols = infile.dimensions['x']
-    rows = infile.dimensions['y']
-
-    assert A.shape[1] == rows
-    assert A.shape[2] == cols
+        for subdataset in subdatasets:
+            assert infile.variables[subdataset].shape[0] == len(times)
 
     # Header information
     xmin = float(infile.XMIN)
@@ -691,21 +844,38 @@ def nc2asc(ncfilename,
     header += 'cellsize %.1f\n' % cellsize
     header += 'NODATA_value -9999\n'
 
+    asciifilenames = []
     if 'time' in infile.variables:
         # Loop through time slices and name files by hour.
-        for k, t in enumerate(times):
-            hour = str(int(t)).zfill(2) + 'h'
-
-            asciifilename = basename + '.' + hour + '.' + subdataset.lower() + '.asc'
-            _write_ascii(header, A[k,:,:], asciifilename, projection)
+        for k, slices in read_time_slices(infile, subdatasets,
+                                          chunk_size=chunk_size,
+                                          prefetch=prefetch,
+                                          time_range=time_range):
+            hour = str(int(times[k])).zfill(2) + 'h'
+
+            for subdataset in subdatasets:
+                asciifilename = basename + '.' + hour + '.' + subdataset.lower() + '.asc'
+                grid_extrema = _write_ascii(header, slices[subdataset], asciifilename,
+                                            projection, number_format=number_format)
+                asciifilenames.append(asciifilename)
+                if extrema is not None and grid_extrema is not None:
+                    extrema[os.path.basename(asciifilename)] = grid_extrema
     else:
         # Write the one ASCII file
-        asciifilename = basename + '.' + subdataset.lower() + '.asc'
-        _write_ascii(header, A[0,:,:], asciifilename, projection)
+        for subdataset in subdatasets:
+            asciifilename = basename + '.' + subdataset.lower() + '.asc'
+            grid_extrema = _write_ascii(header, infile.variables[subdataset][0],
+                                        asciifilename, projection,
+                                        number_format=number_format)
+            asciifilenames.append(asciifilename)
+            if extrema is not None and grid_extrema is not None:
+                extrema[os.path.basename(asciifilename)] = grid_extrema
 
 
     infile.close()
 
+    return asciifilenames
+
 
 
 
@@ -1263,10 +1433,14 @@ def get_wind_direction(x, filename=None):
 
 def generate_contours(filename, contours, units, attribute_name,
                       output_dir='.', meteorological_model=None, WKT_projection=None,
-                      verbose=True):
+                      extrema=None, verbose=True):
     """Contour ASCII grid into shp and kml files
 
     The function uses model parameters Load_contours, Thickness_contours and Thickness_units.
+
+    The range of the data is taken from extrema (min, max) if given, e.g.
+    as recorded by nc2asc when the grid was written, and otherwise by
+    reading the grid.
     """
 
 
@@ -1285,7 +1459,9 @@ def generate_contours(filename, contours, units, attribute_name,
     prjfile = basename + '.prj'
 
     # Get range of data
-    min, max = calculate_extrema(pathname)
+    if extrema is None:
+        extrema = calculate_extrema(pathname)
+    min, max = extrema
     # Establish if interval is constant
     if contours is False:
         if verbose: print '  No contouring requested'
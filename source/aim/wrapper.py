@@ -2,6 +2,7 @@
 """
 
 import os, string
+import multiprocessing
 
 from config import tephra_output_dir
 from utilities import run, write_line, makedir, header, tail
@@ -13,14 +14,124 @@ from utilities import list_to_string, run_with_errorcheck
 from utilities import generate_contours as _generate_contours
 from utilities import build_output_dir
 
+from cache import get_input_file_section, compute_key
+from cache import fetch_from_cache, store_in_cache
+from manifest import compute_checksum
+
 from parameter_checking import derive_implied_parameters
 from parameter_checking import check_parameter_ranges
 
 from access_forecast_data import get_profile_from_web
+from parallel import run_in_pool, run_in_threads
+
+from Scientific.IO.NetCDF import NetCDFFile
 
 
 from osgeo import osr # GDAL libraries
 
+# Variables of Fall3d results converted to ASCII grids by default
+ascii_subdatasets = ['LOAD', 'THICKNESS', 'C_FL050', 'C_FL100', 'C_FL150',
+                     'C_FL200', 'C_FL250', 'C_FL300']
+
+
+def _nc2asc_job(job):
+    """Convert range of time steps of NetCDF file. Used by convert_ncgrids_to_asciigrids.
+
+    Return dictionary of extrema of the ASCII grids written (see nc2asc).
+    """
+
+    ncfilename, subdatasets, time_range, projection, number_format, chunk_size = job
+
+    extrema = {}
+    nc2asc(ncfilename,
+           subdataset=subdatasets,
+           projection=projection,
+           number_format=number_format,
+           chunk_size=chunk_size,
+           time_range=time_range,
+           extrema=extrema)
+
+    return extrema
+
+
+def _contour_job(job):
+    """Contour one ASCII grid. Used by generate_contours.
+    """
+
+    filename, contours, units, attribute_name, kwargs = job
+    _generate_contours(filename, contours, units, attribute_name, **kwargs)
+    return filename
+
+
+def get_time_ranges(ncfilename, subdatasets, number_of_ranges):
+    """Split time steps of NetCDF file into contiguous ranges
+
+    Return list of tuples (first, stop), at most number_of_ranges long.
+    """
+
+    infile = NetCDFFile(ncfilename)
+    if 'time' in infile.variables:
+        nt = infile.variables[subdatasets[0]].shape[0]
+    else:
+        nt = 1
+    infile.close()
+
+    number_of_ranges = max(1, min(number_of_ranges, nt))
+    bounds = [nt*i/number_of_ranges for i in range(number_of_ranges + 1)]
+
+    return zip(bounds[:-1], bounds[1:])
+
+
+def convert_ncgrids(output_dir, subdatasets, projection=None,
+                    number_format='%f', chunk_size=1, workers=1,
+                    verbose=True):
+    """Convert variables of all Fall3d results in output_dir to ASCII grids
+
+    Input:
+        output_dir: Directory with .res.nc files
+        subdatasets: Names of variables to convert
+        projection, number_format, chunk_size: See nc2asc
+        workers: Number of parallel workers. With more than one, the time
+                 steps of each file are split into ranges converted by a
+                 pool of processes, or by a pool of threads when called
+                 from a pool worker (e.g. an ensemble member) as daemonic
+                 processes cannot have children.
+
+    Return dictionary of (min, max) of each ASCII grid keyed by its
+    basename, to be passed on to generate_contours.
+    """
+
+    jobs = []
+    for filename in os.listdir(output_dir):
+        if filename.endswith('.res.nc'):
+            if verbose: print '  ', filename
+            ncfilename = os.path.join(output_dir, filename)
+
+            if workers > 1:
+                time_ranges = get_time_ranges(ncfilename, subdatasets, workers)
+            else:
+                time_ranges = [None]
+
+            for time_range in time_ranges:
+                jobs.append((ncfilename, subdatasets, time_range,
+                             projection, number_format, chunk_size))
+
+    if workers > 1 and len(jobs) > 1:
+        if multiprocessing.current_process().daemon:
+            results = run_in_threads(_nc2asc_job, jobs,
+                                     number_of_threads=workers)
+        else:
+            results = run_in_pool(_nc2asc_job, jobs,
+                                  number_of_processes=workers)
+    else:
+        results = (_nc2asc_job(job) for job in jobs)
+
+    extrema = {}
+    for grid_extrema in results:
+        extrema.update(grid_extrema)
+
+    return extrema
+
 class AIM:
 
     def __init__(self, params,
@@ -28,6 +139,7 @@ class AIM:
                  store_locally=False,
                  dircomment=None,
                  output_dir=None,
+                 resultfile=None,
                  echo=True,
                  verbose=True):
         """Create AIM instance, common file names
@@ -40,6 +152,9 @@ class AIM:
                                 are stored
                        If False, use environment variable TEPHRADATA for output.
         dircomment (string or None): Optional comment added to output dir
+        resultfile (string or None): Optional name of Fall3d result file
+                   (without the .nc that Fall3d adds). Default is
+                   <output_dir>/<scenario_name>.res
         echo (True or False): Optionally print output to screen as well as log file. Default True.
         verbose: (True, False) determine if diagnostic output is to be printed
         """
@@ -101,6 +216,9 @@ class AIM:
         self.WKT_projection = None # Default - no projection
         self.projection = None # Default - no projection
 
+        # Extrema of ASCII grids recorded when they are written
+        self.grid_extrema = {}
+
         # Take note of projection file if present
         try:
             infile = open(self.projection_file)
@@ -213,7 +331,10 @@ class AIM:
         self.databasefile = self.basepath + '.dbs.nc'
 
         # Output result file (Fall3d adds another .nc to this)
-        self.resultfile = self.basepath + '.res'
+        if resultfile is None:
+            self.resultfile = self.basepath + '.res'
+        else:
+            self.resultfile = resultfile
 
         # Output Surfer grid file
         self.grdfile = self.basepath + '.grd'
@@ -247,40 +368,66 @@ class AIM:
     #---------------------------
     def runscript(self, cmd, name, logfile, lines=5, verbose=False):
         """Run Fall3d script and report
+
+        The optional scenario parameter stage_timeouts is a dictionary of
+        wall clock limits in seconds for each script (e.g. 'Fall3d') with
+        'default' applying to scripts not listed. A script running longer
+        is killed and an exception raised.
+
+        If the optional scenario parameter follow_logs is True, the log
+        file is printed as it is written. Otherwise its last lines are
+        printed when the script has finished.
         """
 
+        timeouts = self.params.get('stage_timeouts', {})
+        timeout = timeouts.get(name, timeouts.get('default'))
+
+        follow = None
         if verbose:
             print 'Logfile: %s' % logfile
             #print 'Shortcut: %s' % os.path.join(self.symlink, os.path.split(logfile)[-1])
 
+            if self.params.get('follow_logs', False):
+                follow = logfile
+
 
         stdout = self.logbasepath + '.%s.stdout' % name
         stderr = self.logbasepath + '.%s.stderr' % name
-        err=run(cmd,
+        try:
+            run(cmd,
                 stdout=stdout,
                 stderr=stderr,
+                timeout=timeout,
+                follow=follow,
                 verbose=False)
-
-
-        if verbose:
-            print 'Logfile ended as follows:'
-            tail(logfile, lines)
-
-        if err:
-            msg = 'Script %s ended abnormally. Log files are:\n' % cmd
+        except Exception, e:
+            msg = 'Script %s ended abnormally: %s\nLog files are:\n' % (cmd, e)
             msg += '  %s\n' % logfile
             msg += '  %s\n' % stdout
             msg += '  %s\n' % stderr
             raise Exception(msg)
 
 
+        if verbose and follow is None:
+            print 'Logfile ended as follows:'
+            tail(logfile, lines)
+
+
     def set_granum(self, verbose=True):
         """Create grainsize profile
 
         Requires
         - input file
+
+        The result is cached under a key computed from the GRANULOMETRY
+        section of the input file (see cache.py) so SetGrn only runs once
+        for each distinct grain size distribution.
         """
 
+        # Never write through a hard link to a cache entry
+        if os.path.exists(self.grainfile):
+            os.remove(self.grainfile)
+
         grainfilename = self.scenario_name + '.grn'
         if grainfilename in os.listdir('.'):
             print 'Grainfile found - will not run SetGrn'
@@ -292,6 +439,15 @@ class AIM:
         executable = os.path.join(self.utilities_dir,
                                   'SetGrn', 'SetGrn.PUB.exe')
 
+        # The grain size file depends only on the granulometry
+        key = compute_key(executable,
+                          get_input_file_section(self.inputfile,
+                                                 'GRANULOMETRY'))
+        if fetch_from_cache('SetGrn', key, self.grainfile, extension='.grn'):
+            if verbose:
+                print 'Grainfile found in cache - will not run SetGrn'
+            return
+
         logfile = self.logbasepath + '.SetGrn.log'
 
         if verbose:
@@ -303,6 +459,8 @@ class AIM:
         self.runscript(cmd, 'SetGrn', logfile, lines=4,
                        verbose=verbose)
 
+        store_in_cache('SetGrn', key, self.grainfile, extension='.grn')
+
 
     def set_database(self, verbose=True):
         """Create meteorological database
@@ -311,8 +469,16 @@ class AIM:
         - input file
         - topography
         - wind profile
+
+        The result is cached under a key computed from the wind profile,
+        the topography and the TIME_UTC and GRID sections of the input
+        file (see cache.py) so parameter sweeps only run SetDbs once for
+        each distinct meteorological setup.
         """
 
+        # Never write through a hard link to a cache entry
+        if os.path.exists(self.databasefile):
+            os.remove(self.databasefile)
 
         dbsfilename = self.scenario_name + '.dbs.nc'
         if dbsfilename in os.listdir('.'):
@@ -325,6 +491,18 @@ class AIM:
         executable = os.path.join(self.utilities_dir,
                                   'SetDbs', 'SetDbs.PUB.exe')
 
+        # The database depends only on wind, topography, time and grid
+        key = compute_key(executable, self.meteorological_model,
+                          compute_checksum(self.wind_profile),
+                          compute_checksum(self.topography),
+                          get_input_file_section(self.inputfile, 'TIME_UTC'),
+                          get_input_file_section(self.inputfile, 'GRID'))
+        if fetch_from_cache('SetDbs', key, self.databasefile,
+                            extension='.dbs.nc'):
+            if verbose:
+                print 'DBS file found in cache - will not run SetDbs'
+            return
+
         logfile = self.logbasepath + '.SetDbs.log'
 
         if verbose:
@@ -340,6 +518,8 @@ class AIM:
         self.runscript(cmd, 'SetDbs', logfile, lines=5,
                        verbose=verbose)
 
+        store_in_cache('SetDbs', key, self.databasefile, extension='.dbs.nc')
+
 
     def set_source(self, verbose=True):
         """Create eruptive source file
@@ -473,7 +653,7 @@ class AIM:
 
 
 
-    def convert_ncgrids_to_asciigrids(self, verbose=True):
+    def convert_ncgrids_to_asciigrids(self, workers=None, verbose=True):
         """Convert (selected) NC data layers to ASC files
 
         One ASCII file is generated for each timestep (assumed to be in hours).
@@ -482,31 +662,62 @@ class AIM:
         * They can be ingested by ESRI and other GIS tools.
         * They have an associated projection file that allows georeferencing.
         * They form the inputs for the contouring
+
+        Values are written with the optional parameter ascii_number_format,
+        e.g. '%.3f' or '%g' for compact files. The default is '%f'.
+
+        The variables converted are given by the optional parameter
+        ascii_subdatasets (default ascii_subdatasets). Each result file is
+        read in one pass for all of them, so variables that are not needed,
+        e.g. unused flight levels, are never read or written. The optional
+        parameter netcdf_chunk_size sets the number of time steps read at
+        once (default 1), which bounds the memory used.
+
+        With more than one worker (argument workers or optional parameter
+        postprocess_workers, default 1) the time steps of each file are
+        split into ranges converted in parallel (see convert_ncgrids).
         """
 
         if verbose:
             header('Converting NetCDF data to ASCII grids')
 
+        if workers is None:
+            workers = self.params.get('postprocess_workers', 1)
 
-        for filename in os.listdir(self.output_dir):
-            if filename.endswith('.res.nc'):
-                if verbose: print '  ', filename
-                for subdataset in ['LOAD', 'THICKNESS', 'C_FL050', 'C_FL100', 'C_FL150', 'C_FL200', 'C_FL250', 'C_FL300']:
-                    nc2asc(os.path.join(self.output_dir, filename),
-                           subdataset=subdataset,
-                           projection=self.WKT_projection)
+        extrema = convert_ncgrids(self.output_dir,
+                                  self.params.get('ascii_subdatasets', ascii_subdatasets),
+                                  projection=self.WKT_projection,
+                                  number_format=self.params.get('ascii_number_format', '%f'),
+                                  chunk_size=self.params.get('netcdf_chunk_size', 1),
+                                  workers=workers,
+                                  verbose=verbose)
+        self.grid_extrema.update(extrema)
 
 
-    def generate_contours(self, verbose=True):
+    def generate_contours(self, workers=None, verbose=True):
         """Contour ASCII grids into shp and kml files
 
         The function uses model parameters Load_contours, Thickness_contours and Thickness_units.
+
+        With more than one worker (argument workers or optional parameter
+        postprocess_workers, default 1) grids are contoured by a pool of
+        threads, each running its own GDAL processes.
+
+        The range of each grid is taken from the extrema recorded by
+        convert_ncgrids_to_asciigrids where available.
         """
 
 
         if verbose:
             header('Contouring ASCII grids to SHP and KML files')
 
+        if workers is None:
+            workers = self.params.get('postprocess_workers', 1)
+
+        # Log directory used by all contouring jobs
+        makedir(os.path.join(self.output_dir, 'logs'))
+
+        jobs = []
         for filename in os.listdir(self.output_dir):
             if filename.endswith('.asc'):
 
@@ -530,12 +741,68 @@ class AIM:
                     contours = True # Default is fixed number of contours
 
 
-                _generate_contours(filename, contours, units, attribute_name,
-                                   output_dir=self.output_dir,
-                                   meteorological_model=self.meteorological_model,
-                                   WKT_projection=self.WKT_projection,
-                                   verbose=verbose)
+                jobs.append((filename, contours, units, attribute_name,
+                             {'output_dir': self.output_dir,
+                              'meteorological_model': self.meteorological_model,
+                              'WKT_projection': self.WKT_projection,
+                              'extrema': self.grid_extrema.get(filename),
+                              'verbose': verbose}))
+
+        if workers > 1:
+            for filename in run_in_threads(_contour_job, jobs,
+                                           number_of_threads=workers):
+                pass
+        else:
+            for job in jobs:
+                _contour_job(job)
+
+
+
+    def postprocess(self, verbose=True):
+        """Generate ASCII grids and contours from Fall3d result and
+        organise them by time
+        """
+
+        self.convert_ncgrids_to_asciigrids(verbose=verbose)
+        #self.convert_surfergrids_to_asciigrids()
+        self.generate_contours(verbose=verbose)
+
+        self.organise_output()
+
+
+    def get_postprocess_outputs(self):
+        """List ASCII grids written by postprocess in the hour directories
+
+        The grids are derived from the time steps of the Fall3d result
+        and the variables to be converted. Return empty list if there is
+        no result yet.
+        """
+
+        ncfilename = self.resultfile + '.nc'
+        if not os.path.isfile(ncfilename):
+            return []
+
+        infile = NetCDFFile(ncfilename)
+        if 'time' in infile.variables:
+            hours = [str(int(t)).zfill(2) + 'h' for t in infile.variables['time'][:]]
+        else:
+            hours = None
+        infile.close()
+
+        basename, _ = os.path.splitext(os.path.basename(self.resultfile))
+
+        outputs = []
+        for subdataset in self.params.get('ascii_subdatasets', ascii_subdatasets):
+            if hours is None:
+                outputs.append(os.path.join(self.output_dir, '%s.%s.asc' % (basename,
+                                                                             subdataset.lower())))
+            else:
+                for hour in hours:
+                    outputs.append(os.path.join(self.output_dir, hour,
+                                                '%s.%s.%s.asc' % (basename, hour,
+                                                                  subdataset.lower())))
 
+        return outputs
 
 
     def Xgenerate_contours(self, interval=1, verbose=True):
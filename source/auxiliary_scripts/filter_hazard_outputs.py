@@ -1,6 +1,11 @@
 """Filter AIM multiple scenarios for use with hazard mapping by time interval
 
 This is used to produce seasonal hazard maps
+
+Note: This copies every selected result file. Seasonal hazard maps can
+instead be made without copies by indexing the results with
+aim.catalog.Catalog and setting e.g. catalog_query = 'month in 11..3'
+in the hazard map script (see aim.interface.get_hazard_member_files).
 """
 
 import string, os
@@ -14,6 +14,10 @@ To run in parallel (e.g. 4 nodes, 4 processors):
 
 mpirun -x FALL3DHOME -x PYTHONPATH -npernode 4 -host node1,node2,node3,node4 python volcano_multiple_wind.py
 
+To run in parallel on one machine without MPI (e.g. 32 local processes):
+
+AIM_PARALLEL_BACKEND=multiprocessing AIM_NUMBER_OF_PROCESSES=32 python volcano_multiple_wind.py
+
 """
 
 # Short eruption comment to appear in output directory.
@@ -0,0 +1,150 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.cache import *
+from aim.manifest import compute_checksum
+
+
+def write_file(filename, text):
+    fid = open(filename, 'w')
+    fid.write(text)
+    fid.close()
+
+
+class Test_cache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['AIMCACHE'] = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """test_round_trip - Test that a stored file is fetched under the same key only
+        """
+
+        inputfile = os.path.join(self.tmpdir, 'merapi.inp')
+        write_file(inputfile, 'TIME_UTC\n   YEAR = 2010\nGRANULOMETRY\n'
+                              '   NUMBER_OF_CLASSES = 6\n   FMIN = -2\n'
+                              'SOURCE\n   SOURCE_TYPE = plume\n')
+        section = get_input_file_section(inputfile, 'GRANULOMETRY')
+        assert section == 'NUMBER_OF_CLASSES = 6\nFMIN = -2'
+
+        source = os.path.join(self.tmpdir, 'merapi.grn')
+        write_file(source, 'grain sizes')
+
+        key = compute_key('SetGrn.exe', section)
+        target = os.path.join(self.tmpdir, 'other.grn')
+        assert not fetch_from_cache('SetGrn', key, target, extension='.grn')
+        assert not os.path.exists(target)
+
+        store_in_cache('SetGrn', key, source, extension='.grn')
+        assert fetch_from_cache('SetGrn', key, target, extension='.grn')
+        assert open(target).read() == 'grain sizes'
+
+        # Existing target is replaced
+        os.remove(target)
+        write_file(target, 'old')
+        assert fetch_from_cache('SetGrn', key, target, extension='.grn')
+        assert open(target).read() == 'grain sizes'
+
+        # Different granulometry gives a different key
+        other_key = compute_key('SetGrn.exe', section.replace('6', '7'))
+        assert other_key != key
+        assert not fetch_from_cache('SetGrn', other_key, target, extension='.grn')
+
+        # Items are separated in the key
+        assert compute_key('ab', 'c') != compute_key('a', 'bc')
+
+        # Categories are kept apart
+        assert not fetch_from_cache('SetDbs', key, target, extension='.grn')
+
+    def test_checksum_mismatch(self):
+        """test_checksum_mismatch - Test that a corrupted cache entry is discarded
+        """
+
+        source = os.path.join(self.tmpdir, 'merapi.grn')
+        write_file(source, 'grain sizes')
+        store_in_cache('SetGrn', 'key', source, extension='.grn')
+
+        filename = get_cached_filename('SetGrn', 'key', '.grn')
+        assert os.path.isfile(filename + checksum_extension)
+        assert read_cached_checksum(filename) == compute_checksum(source)
+
+        # Entry written to through a hard link (e.g. by root)
+        os.chmod(filename, 0644)
+        write_file(filename, 'grain')
+
+        target = os.path.join(self.tmpdir, 'other.grn')
+        assert not fetch_from_cache('SetGrn', 'key', target, extension='.grn')
+        assert not os.path.exists(target)
+        assert not os.path.exists(filename)
+        assert not os.path.exists(filename + checksum_extension)
+
+        # Entry can be stored again
+        store_in_cache('SetGrn', 'key', source, extension='.grn')
+        assert fetch_from_cache('SetGrn', 'key', target, extension='.grn')
+        assert open(target).read() == 'grain sizes'
+
+    def test_eviction(self):
+        """test_eviction - Test that least recently used entries are evicted first
+        """
+
+        source = os.path.join(self.tmpdir, 'merapi.grn')
+        write_file(source, 'x'*100)
+
+        filenames = []
+        for i in range(4):
+            store_in_cache('SetGrn', 'key%i' % i, source)
+            filename = get_cached_filename('SetGrn', 'key%i' % i)
+            os.utime(filename, (1000 + i, 1000 + i))
+            filenames.append(filename)
+
+        # Fetching refreshes the oldest entry
+        target = os.path.join(self.tmpdir, 'other.grn')
+        assert fetch_from_cache('SetGrn', 'key0', target)
+
+        # Entry and checksum of 100 + 33 bytes each, room for two
+        evict_from_cache(max_size=300)
+        assert os.path.isfile(filenames[0])
+        assert not os.path.exists(filenames[1])
+        assert not os.path.exists(filenames[1] + checksum_extension)
+        assert not os.path.exists(filenames[2])
+        assert os.path.isfile(filenames[3])
+        assert os.path.isfile(filenames[3] + checksum_extension)
+
+        # Cache within limit is left alone
+        evict_from_cache(max_size=300)
+        assert os.path.isfile(filenames[0])
+        assert os.path.isfile(filenames[3])
+
+        evict_from_cache(max_size=0)
+        assert not os.path.exists(filenames[0])
+        assert not os.path.exists(filenames[3])
+
+    def test_disabled(self):
+        """test_disabled - Test that nothing is stored when caching is off
+        """
+
+        os.environ['AIMCACHE'] = 'off'
+        assert get_cache_dir() is None
+
+        source = os.path.join(self.tmpdir, 'merapi.grn')
+        write_file(source, 'grain sizes')
+        store_in_cache('SetGrn', 'key', source)
+        assert not fetch_from_cache('SetGrn', 'key', source + '.copy')
+        assert not os.path.exists(os.path.join(self.tmpdir, 'cache'))
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_cache, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.catalog import *
+from aim.manifest import Manifest, manifest_filename
+
+
+class Test_catalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalog = Catalog(os.path.join(self.tmpdir, catalog_filename))
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_query(self):
+        """test_query - Test selection of members by time and parameters
+        """
+
+        for i, timestamp in enumerate(['2007011506', '2007041512',
+                                       '2007111512', '2008021500']):
+            filename = os.path.join(self.tmpdir, 'merapi.ncep_%s.res.nc' % timestamp)
+            self.catalog.add(filename, parameters={'height_above_vent': 5000*(i+1),
+                                                   'grainsize_distribution': 'bimodal'})
+
+        def months(query):
+            return [int(os.path.basename(path)[16:18])
+                    for path in self.catalog.query(query)]
+
+        assert months(None) == [1, 4, 11, 2]
+        assert months('month in 11..3') == [1, 11, 2]
+        assert months('month in 3..11') == [4, 11]
+        assert months('month in 1, 4') == [1, 4]
+        assert months('month in 11..3 and hour == 12') == [11]
+        assert months('height_above_vent > 10000') == [11, 2]
+        assert months('height_above_vent <= 10000 and month != 4') == [1]
+        assert months('grainsize_distribution == bimodal and year == 2008') == [2]
+        assert months('grainsize_distribution == unimodal') == []
+
+        parameters = self.catalog.get_parameters(self.catalog.query('month == 4')[0])
+        assert parameters['height_above_vent'] == 10000
+        assert parameters['grainsize_distribution'] == 'bimodal'
+
+        try:
+            self.catalog.query('month ~ 4')
+        except Exception:
+            pass
+        else:
+            msg = 'Invalid condition should have raised exception'
+            raise Exception(msg)
+
+    def test_index_directory(self):
+        """test_index_directory - Test indexing of sampled ensemble
+        """
+
+        fid = open(os.path.join(self.tmpdir, 'samples.csv'), 'w')
+        fid.write('member,height_above_vent,wind_profile\n')
+        fid.write('sample0000,8000,/data/merapi.ncep_2007011506.profile\n')
+        fid.write('sample0001,12000,/data/merapi.ncep_2007071500.profile\n')
+        fid.close()
+
+        manifest = Manifest(os.path.join(self.tmpdir, manifest_filename))
+        for i in range(2):
+            member = 'sample%04i' % i
+            result = 'merapi.%s.res.nc' % member
+            open(os.path.join(self.tmpdir, result), 'w').close()
+            manifest.record(member, 'completed', result=result)
+
+        assert self.catalog.index_directory(self.tmpdir, verbose=False) == 2
+
+        files = self.catalog.query('month in 6..8 and height_above_vent > 10000')
+        assert files == [os.path.join(self.tmpdir, 'merapi.sample0001.res.nc')]
+
+        os.remove(files[0])
+        assert self.catalog.remove_missing() == 1
+        assert len(self.catalog.query()) == 1
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_catalog, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
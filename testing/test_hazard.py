@@ -0,0 +1,491 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.hazard import *
+from Scientific.IO.NetCDF import NetCDFFile
+from numpy import allclose, array, zeros, arange, isnan
+
+
+def write_result(filename, load, concentration=None):
+    """Write minimal Fall3d result file with given LOAD (time, y, x)
+    """
+
+    nt, ny, nx = load.shape
+
+    fid = NetCDFFile(filename, 'w')
+    fid.createDimension('x', nx)
+    fid.createDimension('y', ny)
+    fid.createDimension('time', nt)
+
+    var = fid.createVariable('x', 'f', ('x',))
+    var[:] = arange(nx).astype('f')
+    var = fid.createVariable('y', 'f', ('y',))
+    var[:] = arange(ny).astype('f')
+    var = fid.createVariable('time', 'f', ('time',))
+    var[:] = (arange(nt) + 1).astype('f')
+    var.units = 'h'
+
+    var = fid.createVariable('LOAD', 'f', ('time', 'y', 'x'))
+    var[:] = load.astype('f')
+
+    if concentration is not None:
+        var = fid.createVariable('C_FL050', 'f', ('time', 'y', 'x'))
+        var[:] = concentration.astype('f')
+
+    fid.COORDINATES = 'UTM'
+    fid.XMIN = 0.0
+    fid.XMAX = float(nx)
+    fid.YMIN = 0.0
+    fid.YMAX = float(ny)
+    fid.close()
+
+
+class Test_hazard(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hazardmap(self):
+        """test_hazardmap - Test exceedance and isochrones against hand computed values
+        """
+
+        # Two members, three time steps, grid of one row and two columns
+        load1 = array([[[0, 1]], [[2, 1]], [[3, 1]]])
+        load2 = array([[[0, 0]], [[0, 5]], [[0, 5]]])
+        conc1 = zeros((3, 1, 2))
+        conc1[1, 0, 0] = 1.0 # Exceeds at one time step only
+        conc2 = zeros((3, 1, 2))
+
+        filenames = []
+        for i, (load, conc) in enumerate([(load1, conc1), (load2, conc2)]):
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load, conc)
+            filenames.append(filename)
+
+        outputfilename = os.path.join(self.tmpdir, hazardmap_filename)
+        compute_hazardmap(filenames, [1, 4], fl_values=[0.5],
+                          outputfilename=outputfilename, verbose=False)
+
+        fid = NetCDFFile(outputfilename)
+        assert allclose(fid.variables['PLOAD_1'][:], [[[50, 100]]])
+        assert allclose(fid.variables['PLOAD_2'][:], [[[0, 50]]])
+
+        # Load 1 reached after 1 hour in member 1 and after 0 and 1 hours
+        # in the second cell
+        assert allclose(fid.variables['ISOCHRO_1'][:], [[[1, 0.5]]])
+        assert allclose(fid.variables['ISOCHRO_2'][:], [[[-1, 1]]])
+
+        assert allclose(fid.variables['PFL050_1'][:], [[[50, 0]]])
+        assert float(fid.variables['PLOAD_2'].value) == 4
+        assert float(fid.XMAX) == 2.0
+        fid.close()
+
+    def test_update_hazardmap_state(self):
+        """test_update_hazardmap_state - Test adding and removing members via saved state
+        """
+
+        filenames = []
+        for i in range(3):
+            load = arange(12).reshape((3, 2, 2))*(i+1)
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load)
+            filenames.append(filename)
+
+        statefilename = os.path.join(self.tmpdir, hazardmap_state_filename)
+        compute_hazardmap(filenames[:2], [2, 10],
+                          statefilename=statefilename, verbose=False)
+
+        hazard_map = load_hazardmap_state(statefilename)
+        assert hazard_map.members == ['member0.res.nc', 'member1.res.nc']
+        hazard_map.add(filenames[2])
+        hazard_map.remove(filenames[0])
+        hazard_map.save_state(statefilename)
+
+        hazard_map = load_hazardmap_state(statefilename)
+        assert hazard_map.removed == ['member0.res.nc']
+
+        reference = compute_hazardmap(filenames[1:], [2, 10], verbose=False)
+        variables = hazard_map.get_variables()
+        for name, value in reference.get_variables().items():
+            assert allclose(variables[name][0], value[0])
+
+    def test_merge_hazardmaps(self):
+        """test_merge_hazardmaps - Test that merged partial maps equal the full map
+        """
+
+        filenames = []
+        for i in range(4):
+            load = arange(12).reshape((3, 2, 2))*(i+1)
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load)
+            filenames.append(filename)
+
+        statefilenames = []
+        for i in range(2):
+            statefilename = os.path.join(self.tmpdir, 'P%i.state.npz' % i)
+            compute_hazardmap(filenames[i::2], [2, 10],
+                              statefilename=statefilename, verbose=False)
+            statefilenames.append(statefilename)
+
+        hazard_map = merge_hazardmap_states(statefilenames)
+        assert hazard_map.number_of_members == 4
+
+        reference = compute_hazardmap(filenames, [2, 10], verbose=False)
+        variables = hazard_map.get_variables()
+        for name, value in reference.get_variables().items():
+            assert allclose(variables[name][0], value[0])
+
+        # Members must not be counted twice
+        try:
+            hazard_map.merge(reference)
+        except Exception:
+            pass
+        else:
+            msg = 'Merging hazard maps with common members should have failed'
+            raise Exception(msg)
+
+    def test_parallel_hazardmap(self):
+        """test_parallel_hazardmap - Test that a pool of processes gives the serial result
+        """
+
+        filenames = []
+        for i in range(5):
+            load = arange(12).reshape((3, 2, 2))*(i+1)
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load, concentration=load/10.0)
+            filenames.append(filename)
+
+        reference = compute_hazardmap(filenames, [2, 10], fl_values=[0.5],
+                                      verbose=False)
+        hazard_map = compute_hazardmap(filenames, [2, 10], fl_values=[0.5],
+                                       number_of_processes=3, verbose=False)
+
+        assert sorted(hazard_map.members) == sorted(reference.members)
+        variables = hazard_map.get_variables()
+        for name, value in reference.get_variables().items():
+            assert allclose(variables[name][0], value[0])
+
+    def test_histogram(self):
+        """test_histogram - Test exceedance for new thresholds from histograms
+        """
+
+        filenames = []
+        for i in range(4):
+            load = arange(12).reshape((3, 2, 2))*(i+1)
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load, concentration=load/1000.0)
+            filenames.append(filename)
+
+        statefilename = os.path.join(self.tmpdir, hazardmap_state_filename)
+        compute_hazardmap(filenames, [1], histogram=True, fl_histogram=True,
+                          statefilename=statefilename, verbose=False)
+        hazard_map = load_hazardmap_state(statefilename)
+
+        # Unweighted counts are small integers
+        assert hazard_map.histogram.load.dtype == 'u2'
+        assert hazard_map.histogram.flight_levels == ['FL050']
+
+        # Thresholds on bin edges are exact
+        load_values = [1, 10, 100]
+        fl_values = [0.001, 0.01]
+        reference = compute_hazardmap(filenames, load_values,
+                                      fl_values=fl_values, verbose=False)
+        variables = hazard_map.get_histogram_variables(load_values, fl_values)
+        for name, value in reference.get_variables().items():
+            if not name.startswith('ISOCHRO'):
+                assert allclose(variables[name][0], value[0])
+
+        # Other thresholds are within one bin
+        variables = hazard_map.get_histogram_variables([15])
+        reference = compute_hazardmap(filenames, [12.58925, 15, 15.84893],
+                                      verbose=False).get_variables()
+        assert (variables['PLOAD_1'][0] <= reference['PLOAD_1'][0]).all()
+        assert (variables['PLOAD_1'][0] >= reference['PLOAD_3'][0]).all()
+
+        # Histograms follow removal of members
+        hazard_map.remove(filenames[0])
+        reference = compute_hazardmap(filenames[1:], [10], verbose=False)
+        variables = hazard_map.get_histogram_variables([10])
+        assert allclose(variables['PLOAD_1'][0],
+                        reference.get_variables()['PLOAD_1'][0])
+
+        # Flight level histograms are optional
+        hazard_map = compute_hazardmap(filenames, [1], histogram=True,
+                                       verbose=False)
+        assert hazard_map.histogram.flight_levels == []
+        assert hazard_map.histogram.fl == {}
+
+        # Partial histograms from a pool are merged
+        reference = compute_hazardmap(filenames, [1], histogram=True,
+                                      fl_histogram=True, verbose=False)
+        hazard_map = compute_hazardmap(filenames, [1], histogram=True,
+                                       fl_histogram=True,
+                                       number_of_processes=2, verbose=False)
+        assert hazard_map.histogram.load.dtype == 'u2'
+        assert allclose(hazard_map.histogram.load, reference.histogram.load)
+        assert allclose(hazard_map.histogram.fl['FL050'],
+                        reference.histogram.fl['FL050'])
+
+        # Counts are widened for fractional weights and many members
+        weights = {'member0.res.nc': 0.5, 'member1.res.nc': 1,
+                   'member2.res.nc': 1, 'member3.res.nc': 1}
+        hazard_map = compute_hazardmap(filenames, [1], histogram=True,
+                                       weights=weights, verbose=False)
+        assert hazard_map.histogram.load.dtype == 'f'
+        assert allclose(hazard_map.histogram.get_total(), 3.5)
+
+        histogram = HazardHistogram((1, 1), [])
+        histogram.accumulate(zeros((1, 1)), {}, weight=70000)
+        assert histogram.load.dtype == 'u4'
+        assert histogram.load[0, 0, 0] == 70000
+
+    def test_wilson_interval(self):
+        """test_wilson_interval - Test confidence bands against tabulated values
+        """
+
+        lower, upper = wilson_interval([0, 5, 10], 10, confidence=0.95)
+        assert allclose(lower, [0, 0.2366, 0.7225], atol=1.0e-4)
+        assert allclose(upper, [0.2775, 0.7634, 1], atol=1.0e-4)
+
+        # Bands narrow as members are added
+        load = arange(12).reshape((3, 2, 2))
+        filename = os.path.join(self.tmpdir, 'member.res.nc')
+        write_result(filename, load)
+        hazard_map = compute_hazardmap([filename], [5], verbose=False)
+
+        probability = hazard_map.get_variables()['PLOAD_1'][0]
+        variables = hazard_map.get_confidence_variables(0.9)
+        assert (variables['PLOAD_1_LOWER'][0] <= probability).all()
+        assert (variables['PLOAD_1_UPPER'][0] >= probability).all()
+
+        curve = hazard_map.get_projected_widths([10, 100, 1000])
+        widths = [widths['PLOAD_1'] for N, widths in curve]
+        assert widths[0] > widths[1] > widths[2]
+
+    def test_convergence(self):
+        """test_convergence - Test that convergence is recorded from the running estimate
+        """
+
+        filenames = []
+        for i in range(4):
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, arange(12).reshape((3, 2, 2))*(i+1))
+            filenames.append(filename)
+
+        # Nothing recorded without a confidence level
+        hazard_map = compute_hazardmap(filenames, [20], verbose=False)
+        assert hazard_map.convergence == []
+
+        statefilename = os.path.join(self.tmpdir, 'state.npz')
+        hazard_map = compute_hazardmap(filenames, [20], confidence=0.9,
+                                       statefilename=statefilename,
+                                       verbose=False)
+        assert [row[0] for row in hazard_map.convergence] == [1, 2, 3, 4]
+
+        # Estimates with the members so far, not the final probabilities
+        for N, widths, changes in hazard_map.convergence:
+            partial = compute_hazardmap(filenames[:N], [20], verbose=False)
+            counts = partial.get_counts()['PLOAD_1'][0]
+            lower, upper = wilson_interval(counts, N, 0.9)
+            assert allclose(widths['PLOAD_1'], 100*(upper - lower).max()/2)
+
+        N, widths, changes = hazard_map.convergence[0]
+        assert isnan(changes['PLOAD_1'])
+
+        # Member 1 exceeds 20 in half of the cells and member 0 nowhere
+        N, widths, changes = hazard_map.convergence[1]
+        assert allclose(changes['PLOAD_1'], 50)
+
+        # Saved with state
+        loaded = load_hazardmap_state(statefilename)
+        assert loaded.confidence == 0.9
+        assert len(loaded.convergence) == 4
+        for row, loaded_row in zip(hazard_map.convergence, loaded.convergence):
+            assert row[0] == loaded_row[0]
+            assert allclose(row[1]['PLOAD_1'], loaded_row[1]['PLOAD_1'])
+
+        # Merging records the merged block
+        other = compute_hazardmap(filenames[:1], [20], confidence=0.9,
+                                  verbose=False)
+        more = compute_hazardmap(filenames[1:], [20], confidence=0.9,
+                                 verbose=False)
+        other.merge(more)
+        assert [row[0] for row in other.convergence] == [1, 4]
+        assert allclose(other.convergence[-1][1]['PLOAD_1'],
+                        hazard_map.convergence[-1][1]['PLOAD_1'])
+
+        # Partitions read in a pool end with the same estimate
+        pooled = compute_hazardmap(filenames, [20], confidence=0.9,
+                                   number_of_processes=2, verbose=False)
+        assert pooled.convergence[-1][0] == 4
+        assert allclose(pooled.convergence[-1][1]['PLOAD_1'],
+                        hazard_map.convergence[-1][1]['PLOAD_1'])
+
+    def test_weighted_hazardmap(self):
+        """test_weighted_hazardmap - Test weights from time stamps of members
+        """
+
+        members = ['merapi.ncep_2007011506.res.nc',
+                   'merapi.ncep_2007012506.res.nc',
+                   'merapi.ncep_2008021500.res.nc']
+        weights = get_member_weights(members, 'month')
+
+        # January and February get weight in proportion to their days
+        assert allclose(weights[members[0]], weights[members[1]])
+        assert allclose(2*weights[members[0]]/weights[members[2]], 31/28.0)
+        assert allclose(sum(weights.values()), 3)
+
+        filenames = []
+        for i, member in enumerate(members):
+            load = zeros((1, 1, 2))
+            load[0, 0, 0] = 10*(i == 2)
+            filename = os.path.join(self.tmpdir, member)
+            write_result(filename, load)
+            filenames.append(filename)
+
+        hazard_map = compute_hazardmap(filenames, [1], weights=weights,
+                                       verbose=False)
+        probability = hazard_map.get_variables()['PLOAD_1'][0]
+        assert allclose(probability, [[100*28/59.0, 0]])
+        assert hazard_map.get_effective_number_of_members() < 3
+
+        # Removing a member takes out its weight
+        hazard_map.remove(filenames[2])
+        assert allclose(hazard_map.get_variables()['PLOAD_1'][0], 0)
+
+        try:
+            get_member_weights(['member_without_time.res.nc'], 'month')
+        except Exception:
+            pass
+        else:
+            msg = 'Member without time stamp should have raised exception'
+            raise Exception(msg)
+
+    def test_resume_after_aggregation(self):
+        """test_resume_after_aggregation - Test resume of member aggregated before the manifest was updated
+        """
+
+        from aim.interface import _aggregate_member, _recover_aggregated_member
+        from aim.interface import _merge_worker_hazardmaps, _worker_hazardmaps
+        from aim.interface import get_aggregated_members
+        from aim.manifest import Manifest, compute_checksum
+
+        hazard_params = {'load_values': [2, 10], 'fl_values': []}
+        partial_dir = os.path.join(self.tmpdir, 'partial')
+        os.mkdir(partial_dir)
+        manifest = Manifest(os.path.join(self.tmpdir, 'manifest.jsonl'))
+
+        for i in range(2):
+            windname = 'wind%i' % i
+            member = 'scenario.%s.res.nc' % windname
+            tmpname = os.path.join(partial_dir, member)
+            write_result(tmpname, arange(12).reshape((3, 2, 2))*(i+1))
+
+            manifest.record(windname, 'queued', input='abc')
+            _aggregate_member(hazard_params, tmpname, member, self.tmpdir, 0)
+
+            if i == 0:
+                resultfile = os.path.join(self.tmpdir, member)
+                os.rename(tmpname, resultfile)
+                manifest.record(windname, 'completed', input='abc',
+                                result=member,
+                                checksum=compute_checksum(resultfile),
+                                aggregated=True)
+
+        # Interrupted before the second member was recorded as completed
+        _worker_hazardmaps.clear()
+
+        records = manifest.read()
+        aggregated_members = get_aggregated_members(self.tmpdir)
+        assert sorted(aggregated_members) == ['scenario.wind0.res.nc',
+                                              'scenario.wind1.res.nc']
+
+        assert not _recover_aggregated_member(manifest, 'wind0', 'scenario.wind0.res.nc',
+                                              'abc', self.tmpdir, aggregated_members,
+                                              True, records=records)
+        assert not _recover_aggregated_member(manifest, 'wind1', 'scenario.wind1.res.nc',
+                                              'changed', self.tmpdir, aggregated_members,
+                                              True, records=records)
+        assert _recover_aggregated_member(manifest, 'wind1', 'scenario.wind1.res.nc',
+                                          'abc', self.tmpdir, aggregated_members,
+                                          True, records=records)
+
+        assert manifest.is_complete('wind1', 'abc', self.tmpdir)
+        assert os.path.isfile(os.path.join(self.tmpdir, 'scenario.wind1.res.nc'))
+        assert not os.path.isfile(os.path.join(partial_dir, 'scenario.wind1.res.nc'))
+
+        # Each member is counted once
+        _merge_worker_hazardmaps(hazard_params, self.tmpdir, manifest,
+                                 verbose=False)
+        hazard_map = load_hazardmap_state(os.path.join(self.tmpdir,
+                                                       hazardmap_state_filename))
+        assert sorted(hazard_map.members) == sorted(aggregated_members)
+
+    def test_failure_after_aggregation(self):
+        """test_failure_after_aggregation - Test that a member already in the hazard map state is not run again
+        """
+
+        from aim.interface import _store_member_result, _recover_aggregated_member
+        from aim.interface import _worker_hazardmaps, get_aggregated_members
+        from aim.manifest import Manifest
+
+        hazard_params = {'load_values': [2, 10], 'fl_values': []}
+        partial_dir = os.path.join(self.tmpdir, 'partial')
+        os.mkdir(partial_dir)
+        manifest = Manifest(os.path.join(self.tmpdir, 'manifest.jsonl'))
+
+        member = 'scenario.wind0.res.nc'
+        tmpname = os.path.join(partial_dir, member)
+        write_result(tmpname, arange(12).reshape((3, 2, 2)))
+
+        # Result cannot be moved into place
+        os.mkdir(os.path.join(self.tmpdir, member))
+
+        outcome = {'member': 'wind0', 'error': None, 'result': None,
+                   'checksum': None, 'aggregated': False}
+        _store_member_result(hazard_params, tmpname, member, self.tmpdir, 0,
+                             True, outcome)
+        _worker_hazardmaps.clear()
+
+        assert outcome['error'] is None
+        assert outcome['aggregated']
+        assert outcome['result'] is None
+        assert get_aggregated_members(self.tmpdir) == [member]
+
+        manifest.record('wind0', 'completed', input='abc',
+                        result=outcome['result'],
+                        checksum=outcome['checksum'],
+                        aggregated=outcome['aggregated'])
+        assert manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+        # Failure before aggregation is raised
+        outcome = {'member': 'wind1', 'error': None, 'result': None,
+                   'checksum': None, 'aggregated': False}
+        self.assertRaises(Exception, _store_member_result, hazard_params,
+                          os.path.join(partial_dir, 'missing.res.nc'),
+                          'scenario.wind1.res.nc', self.tmpdir, 1, True,
+                          outcome)
+        _worker_hazardmaps.clear()
+        assert not outcome['aggregated']
+        assert get_aggregated_members(self.tmpdir) == [member]
+
+        # Member recorded as failed by an earlier version is recovered
+        manifest.record('wind0', 'failed', input='abc', error='Oops')
+        records = manifest.read()
+        assert _recover_aggregated_member(manifest, 'wind0', member, 'abc',
+                                          self.tmpdir, [member], False,
+                                          records=records)
+        assert manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_hazard, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,117 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.manifest import *
+
+
+class Test_manifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = Manifest(os.path.join(self.tmpdir, manifest_filename))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_result(self, name, text):
+        fid = open(os.path.join(self.tmpdir, name), 'w')
+        fid.write(text)
+        fid.close()
+        return compute_checksum(os.path.join(self.tmpdir, name))
+
+    def test_truncated_record(self):
+        """test_truncated_record - Test recovery from a write interrupted by a crash
+        """
+
+        self.manifest.record('wind0', 'queued', input='abc')
+        self.manifest.record('wind0', 'completed', input='abc',
+                             result='wind0.res.nc', checksum='123')
+        self.manifest.record('wind1', 'queued', input='def')
+
+        # Crash half way through the next record
+        fid = open(self.manifest.filename, 'a')
+        fid.write('{"member": "wind1", "status": "compl')
+        fid.close()
+
+        records = self.manifest.read()
+        assert sorted(records.keys()) == ['wind0', 'wind1']
+        assert records['wind0']['status'] == 'completed'
+        assert records['wind0']['result'] == 'wind0.res.nc'
+        assert records['wind1']['status'] == 'queued'
+
+        # Next record starts on a new line
+        self.manifest.record('wind1', 'failed', input='def', error='Oops')
+        records = self.manifest.read()
+        assert records['wind1']['status'] == 'failed'
+        assert records['wind1']['error'] == 'Oops'
+
+        lines = open(self.manifest.filename).readlines()
+        assert len(lines) == 5
+        assert lines[-2].endswith('"compl\n')
+
+    def test_is_complete(self):
+        """test_is_complete - Test which members are taken as completed on resume
+        """
+
+        # Unknown member
+        assert not self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+        # Queued or failed members are not complete
+        self.manifest.record('wind0', 'queued', input='abc')
+        assert not self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+        self.manifest.record('wind0', 'failed', input='abc', error='Oops')
+        assert not self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+        # Completed with intact result
+        checksum = self.write_result('wind0.res.nc', 'result')
+        self.manifest.record('wind0', 'completed', input='abc',
+                             result='wind0.res.nc', checksum=checksum)
+        assert self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+        # Records read once can be reused
+        records = self.manifest.read()
+        assert self.manifest.is_complete('wind0', 'abc', self.tmpdir,
+                                         records=records)
+
+        # Changed inputs
+        assert not self.manifest.is_complete('wind0', 'xyz', self.tmpdir)
+
+        # Corrupted or missing result
+        self.write_result('wind0.res.nc', 'truncated')
+        assert not self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+        os.remove(os.path.join(self.tmpdir, 'wind0.res.nc'))
+        assert not self.manifest.is_complete('wind0', 'abc', self.tmpdir)
+
+        # Result deleted after it was added to a hazard map
+        self.manifest.record('wind1', 'completed', input='def', result=None,
+                             checksum=None, aggregated=True)
+        assert self.manifest.is_complete('wind1', 'def', self.tmpdir)
+        self.manifest.record('wind2', 'completed', input='def', result=None,
+                             checksum=None, aggregated=False)
+        assert not self.manifest.is_complete('wind2', 'def', self.tmpdir)
+
+    def test_input_checksum(self):
+        """test_input_checksum - Test that inputs are identified by parameters and file contents
+        """
+
+        filename = os.path.join(self.tmpdir, 'wind.profile')
+        self.write_result('wind.profile', 'wind')
+
+        params = {'height': 1000, 'mass': 1.0e9}
+        checksum = compute_input_checksum(params, [filename])
+        assert checksum == compute_input_checksum(params.copy(), [filename])
+        assert checksum != compute_input_checksum({'height': 1000, 'mass': 2.0e9},
+                                                  [filename])
+
+        self.write_result('wind.profile', 'other wind')
+        assert checksum != compute_input_checksum(params, [filename])
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_manifest, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,179 @@
+import unittest
+import os
+import sys
+import time
+import signal
+import tempfile
+import shutil
+import StringIO
+
+from aim.process import *
+
+
+class Test_process(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_output_to_file(self):
+        """test_output_to_file - Test that output goes to the given files
+        """
+
+        stdout = os.path.join(self.tmpdir, 'out.log')
+        stderr = os.path.join(self.tmpdir, 'err.log')
+        command = Command('echo hello; echo oops 1>&2; exit 3',
+                          stdout=stdout, stderr=stderr)
+        command.start()
+        assert command.wait() == 3
+        assert not command.timed_out
+        assert not command.cancelled
+
+        assert open(stdout).read() == 'hello\n'
+        assert open(stderr).read() == 'oops\n'
+        assert 'errorcode 3' in command.describe_failure()
+
+    def test_timeout(self):
+        """test_timeout - Test that a command exceeding its time limit is killed
+        """
+
+        t_start = time.time()
+        command = Command('sleep 10', timeout=0.2)
+        command.start()
+        returncode = command.wait()
+
+        assert time.time() - t_start < 5
+        assert command.timed_out
+        assert returncode == -signal.SIGTERM
+        assert 'exceeded time limit' in command.describe_failure()
+
+    def test_kill_after_grace_period(self):
+        """test_kill_after_grace_period - Test SIGKILL of command ignoring SIGTERM
+        """
+
+        # Children inherit the ignored SIGTERM
+        t_start = time.time()
+        command = Command('trap "" TERM; sleep 10', timeout=0.2,
+                          grace_period=0.5)
+        command.start()
+        returncode = command.wait()
+
+        assert time.time() - t_start >= 0.7
+        assert time.time() - t_start < 5
+        assert command.timed_out
+        assert returncode == -signal.SIGKILL
+
+    def test_cancel(self):
+        """test_cancel - Test cancellation of running command
+        """
+
+        command = Command('sleep 10')
+        command.start()
+        assert command.poll() is None
+
+        t_start = time.time()
+        command.cancel()
+        assert time.time() - t_start < 5
+        assert command.cancelled
+        assert not command.timed_out
+        assert command.returncode == -signal.SIGTERM
+        assert command.poll() == -signal.SIGTERM
+        assert 'cancelled' in command.describe_failure()
+
+    def test_follow(self):
+        """test_follow - Test that complete lines of a followed file are printed
+        """
+
+        logfile = os.path.join(self.tmpdir, 'program.log')
+        cmd = 'echo first > %s; printf "second\\nthi" >> %s; sleep 0.2; ' % (logfile, logfile)
+        cmd += 'echo rd >> %s' % logfile
+        command = Command(cmd, follow=logfile)
+
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            command.start()
+            command.wait()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+        assert command.returncode == 0
+        assert output.split('\n') == ['  first', '  second', '  third', '']
+
+    def test_run_commands(self):
+        """test_run_commands - Test concurrent commands with bounded concurrency
+        """
+
+        commands = []
+        for i in range(4):
+            stdout = os.path.join(self.tmpdir, 'out%i.log' % i)
+            commands.append(Command('sleep 0.3; echo %i' % i, stdout=stdout))
+        commands.append(Command('exit 2'))
+
+        t_start = time.time()
+        finished = run_commands(commands, max_concurrent=5, verbose=False)
+
+        # Running one after the other would take 1.2 seconds
+        assert time.time() - t_start < 1.0
+        assert len(finished) == 5
+        assert finished[0].returncode == 2
+        for i, command in enumerate(commands[:4]):
+            assert command.returncode == 0
+            assert open(command.stdout).read() == '%i\n' % i
+
+        # At most two at a time
+        commands = [Command('sleep 0.3') for i in range(4)]
+        t_start = time.time()
+        run_commands(commands, max_concurrent=2, verbose=False)
+        assert time.time() - t_start >= 0.6
+
+    def test_run_commands_timeout(self):
+        """test_run_commands_timeout - Test cancellation of all commands after overall time limit
+        """
+
+        commands = [Command('true'),
+                    Command('sleep 10'),
+                    Command('sleep 10')]
+
+        t_start = time.time()
+        finished = run_commands(commands, max_concurrent=1, timeout=0.5,
+                                verbose=False)
+
+        assert time.time() - t_start < 5
+        assert len(finished) == 3
+        assert commands[0].returncode == 0
+        assert not commands[0].cancelled
+        for command in commands[1:]:
+            assert command.cancelled
+
+        # The last command was never started
+        assert commands[2].process is None
+
+    def test_run_commands_cancel(self):
+        """test_run_commands_cancel - Test cooperative cancellation of commands
+        """
+
+        commands = [Command('sleep 10') for i in range(3)]
+
+        t_cancel = time.time() + 0.3
+        def cancel():
+            return time.time() > t_cancel
+
+        finished = run_commands(commands, cancel=cancel, verbose=False)
+
+        assert time.time() - t_cancel < 5
+        assert len(finished) == 3
+        for command in commands:
+            assert command.cancelled
+            assert command.returncode == -signal.SIGTERM
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_process, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
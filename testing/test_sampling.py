@@ -0,0 +1,80 @@
+import unittest
+
+from aim.sampling import *
+from numpy import allclose, array, sort, arange, log, floor
+
+
+class Test_sampling(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_normal_ppf(self):
+        """test_normal_ppf - Test inverse of normal distribution
+        """
+
+        x = normal_ppf([0.5, 0.975, 0.025, 0.841344746, 0.001])
+        assert allclose(x, [0, 1.959964, -1.959964, 1.0, -3.090232], atol=1.0e-6)
+
+    def test_latin_hypercube(self):
+        """test_latin_hypercube - Test that every stratum is sampled once
+        """
+
+        N = 20
+        distributions = {'height_above_vent': ('uniform', 1000, 3000),
+                         'mass_eruption_rate': ('loguniform', 1e6, 1e10)}
+        samples = draw_samples(distributions, N, method='lhs', seed=13)
+        assert len(samples) == N
+
+        h = array([x['height_above_vent'] for x in samples])
+        strata = sort(floor((h - 1000)/2000*N))
+        assert allclose(strata, arange(N))
+
+        m = array([x['mass_eruption_rate'] for x in samples])
+        strata = sort(floor((log(m) - log(1e6))/(log(1e10) - log(1e6))*N))
+        assert allclose(strata, arange(N))
+
+    def test_reproducible(self):
+        """test_reproducible - Test that seed reproduces samples
+        """
+
+        distributions = {'mean_grainsize': ('normal', 2.5, 0.5),
+                         'source_type': ('choice', ['plume', 'suzuki']),
+                         'eruption_duration': ('triangular', 1, 3, 10)}
+
+        for method in sampling_methods:
+            samples1 = draw_samples(distributions, 10, method=method, seed=1)
+            samples2 = draw_samples(distributions, 10, method=method, seed=1)
+            assert samples1 == samples2
+
+            for sample in samples1:
+                assert sample['source_type'] in ['plume', 'suzuki']
+                assert 1 <= sample['eruption_duration'] <= 10
+
+    def test_bad_distributions(self):
+        """test_bad_distributions - Test that malformed input is caught
+        """
+
+        for distribution in [('gaussian', 0, 1),
+                             ('uniform', 3, 1),
+                             ('uniform', 1),
+                             ('loguniform', 0, 1),
+                             ('choice', [])]:
+            try:
+                draw_samples({'x': distribution}, 5)
+            except Exception:
+                pass
+            else:
+                msg = 'Distribution %s should have raised exception' % str(distribution)
+                raise Exception(msg)
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_sampling, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -0,0 +1,88 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.sites import *
+from aim.hazard import compute_hazardmap
+from test_hazard import write_result
+from numpy import allclose, arange, array
+
+
+class Test_sites(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        # Cells are one unit wide with centres at 0.5, 1.5, ...
+        self.sitesfilename = os.path.join(self.tmpdir, 'sites.csv')
+        fid = open(self.sitesfilename, 'w')
+        fid.write('name,easting,northing\n')
+        fid.write('town,1.5,0.5\n')
+        fid.write('airport,2.0,1.0\n')
+        fid.write('hospital,10.0,10.0\n')
+        fid.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_site_hazard(self):
+        """test_site_hazard - Test site curves against hazard map and interpolation
+        """
+
+        filenames = []
+        for i in range(4):
+            load = arange(36).reshape((3, 3, 4))*(i+1)
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load, concentration=load/100.0)
+            filenames.append(filename)
+
+        load_values = [5, 20, 60]
+        site_hazard = compute_site_hazard(filenames, self.sitesfilename,
+                                          load_values, fl_values=[0.5],
+                                          verbose=False)
+        assert list(site_hazard.inside) == [True, True, False]
+
+        # Site at cell centre matches the hazard map
+        variables = compute_hazardmap(filenames, load_values, fl_values=[0.5],
+                                      verbose=False).get_variables()
+        curves = site_hazard.get_curves()
+        probability, mean = site_hazard.get_arrival()
+        for i in range(len(load_values)):
+            assert allclose(curves[0, i], variables['PLOAD_%i' % (i+1)][0][0, 1])
+            assert allclose(mean[0, i], variables['ISOCHRO_%i' % (i+1)][0][0, 1])
+        assert allclose(site_hazard.get_fl_curves()['FL050'][0, 0],
+                        variables['PFL050_1'][0][0, 1])
+
+        # Final load at airport is the mean of four cells, 27.5*(i+1)
+        assert allclose(curves[1], [100, 100, 50])
+        assert allclose(curves[2], 0)
+        assert allclose(mean[2], -1)
+
+        # Load 20 is reached after one hour in three members
+        assert allclose(probability[1, 1], [0, 75, 100])
+
+        names = site_hazard.write(os.path.join(self.tmpdir, site_hazard_basename))
+        assert len(names) == 3
+        assert len(open(names[1]).readlines()) == 1 + 3*len(load_values)
+
+    def test_nearest(self):
+        """test_nearest - Test that nearest cell sampling picks the containing cell
+        """
+
+        grid = {'COORDINATES': 'UTM', 'XMIN': 0.0, 'YMIN': 0.0,
+                'XMAX': 4.0, 'YMAX': 3.0}
+        rows, cols, weights, inside = get_interpolation(grid, 4, 3, array([1.4, 3.9]),
+                                                        array([2.6, 0.1]),
+                                                        method='nearest')
+        assert list(rows[:, 0]) == [2, 0]
+        assert list(cols[:, 0]) == [1, 3]
+        assert allclose(weights.sum(axis=1), 1)
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_sites, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
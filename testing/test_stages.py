@@ -0,0 +1,208 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.stages import *
+
+
+input_file = """TIME_UTC
+   YEAR = 2010
+GRID
+   LON-LAT
+   LONMIN = 110.0
+GRANULOMETRY
+   NUMBER_OF_CLASSES = 6
+SOURCE
+   SOURCE_TYPE = plume
+FALL3D
+   TERMINAL_VELOCITY_MODEL = 1
+"""
+
+
+def write_file(filename, text):
+    fid = open(filename, 'w')
+    fid.write(text)
+    fid.close()
+
+
+class FakeAIM:
+    """Stand in for class AIM recording which stages are run
+    """
+
+    def __init__(self, directory):
+        self.scenario_name = 'fake'
+        self.output_dir = directory
+        self.basepath = os.path.join(directory, self.scenario_name)
+        self.params = {'X_coordinate_minimum': 0,
+                       'X_coordinate_maximum': 1000,
+                       'Y_coordinate_minimum': 0,
+                       'Y_coordinate_maximum': 1000,
+                       'load_contours': [1, 10]}
+
+        self.topography_grid = os.path.join(directory, 'topography.txt')
+        self.projection_file = os.path.join(directory, 'topography.prj')
+        self.wind_profile = os.path.join(directory, 'wind.profile')
+        self.inputfile = self.basepath + '.inp'
+        for filename in [self.topography_grid, self.projection_file,
+                         self.wind_profile]:
+            write_file(filename, os.path.basename(filename))
+        write_file(self.inputfile, input_file)
+
+        self.topography = self.basepath + '.top'
+        self.grainfile = self.basepath + '.grn'
+        self.databasefile = self.basepath + '.dbs.nc'
+        self.sourcefile = self.basepath + '.src'
+        self.resultfile = self.basepath + '.res'
+
+    def get_postprocess_outputs(self):
+        return [self.basepath + '.01h.load.asc']
+
+    def generate_topography(self, verbose=True):
+        write_file(self.topography, 'top')
+
+    def set_granum(self, verbose=True):
+        write_file(self.grainfile, 'grn')
+
+    def set_database(self, verbose=True):
+        write_file(self.databasefile, 'dbs')
+
+    def set_source(self, verbose=True):
+        write_file(self.sourcefile, 'src')
+
+    def run_fall3d(self, verbose=True):
+        write_file(self.resultfile + '.nc', 'res')
+
+    def postprocess(self, verbose=True):
+        write_file(self.basepath + '.01h.load.asc', 'asc')
+
+
+class Test_stages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run_stages(self):
+        """test_run_stages - Test that only stages with changed inputs or missing outputs are run
+        """
+
+        all_stages = [stage['name'] for stage in stages]
+
+        aim = FakeAIM(self.tmpdir)
+        assert run_stages(aim, verbose=False) == all_stages
+        assert run_stages(aim, verbose=False) == []
+
+        # Post processing parameter
+        aim.params['load_contours'] = [1, 10, 100]
+        assert run_stages(aim, verbose=False) == ['postprocess']
+
+        # Topography and everything depending on it
+        aim.params['X_coordinate_minimum'] = 10
+        assert run_stages(aim, verbose=False) == ['topography', 'database',
+                                                  'source', 'fall3d',
+                                                  'postprocess']
+
+        write_file(aim.projection_file, 'changed projection')
+        assert run_stages(aim, verbose=False) == ['topography', 'database',
+                                                  'source', 'fall3d',
+                                                  'postprocess']
+
+        # Grain sizes
+        write_file(aim.inputfile, input_file.replace('6', '7'))
+        assert run_stages(aim, verbose=False) == ['granum', 'source',
+                                                  'fall3d', 'postprocess']
+        assert run_stages(aim, verbose=False) == []
+
+        # Deleted outputs are made again
+        os.remove(aim.grainfile)
+        assert run_stages(aim, verbose=False) == ['granum']
+
+        os.remove(aim.basepath + '.01h.load.asc')
+        assert run_stages(aim, verbose=False) == ['postprocess']
+
+        # Subset of stages
+        os.remove(aim.resultfile + '.nc')
+        names = all_stages[:-1]
+        assert run_stages(aim, names=names, verbose=False) == ['fall3d']
+
+        # Interrupted stage is run again
+        fingerprints = read_fingerprints(aim.basepath + fingerprint_extension)
+        del fingerprints['source']
+        write_fingerprints(aim.basepath + fingerprint_extension, fingerprints)
+        assert run_stages(aim, verbose=False) == ['source']
+
+    def test_get_upstream_key(self):
+        """test_get_upstream_key - Test grouping of sweep members by shared SetGrn and SetDbs inputs
+        """
+
+        names = ['Maximum_grainsize', 'Mass_eruption_rate', 'Wind_profile']
+        params = {'Maximum_grainsize': 4,
+                  'Mass_eruption_rate': 1.0e6,
+                  'Wind_profile': 'a.profile'}
+
+        granum = get_upstream_key(params, names, 'granum')
+        database = get_upstream_key(params, names, 'database')
+        assert granum == (('Maximum_grainsize', '4'),)
+        assert database == (('Wind_profile', "'a.profile'"),)
+
+        # Downstream parameters affect neither
+        other = params.copy()
+        other['Mass_eruption_rate'] = 2.0e6
+        assert get_upstream_key(other, names, 'granum') == granum
+        assert get_upstream_key(other, names, 'database') == database
+
+        # Grain sizes only affect SetGrn and wind only SetDbs
+        other['Maximum_grainsize'] = 5
+        assert get_upstream_key(other, names, 'granum') != granum
+        assert get_upstream_key(other, names, 'database') == database
+
+        other = params.copy()
+        other['Wind_profile'] = 'b.profile'
+        assert get_upstream_key(other, names, 'granum') == granum
+        assert get_upstream_key(other, names, 'database') != database
+
+        self.assertRaises(Exception, get_upstream_key, params, names, 'source')
+
+    def test_get_sweep_rounds(self):
+        """test_get_sweep_rounds - Test that members sharing SetGrn or SetDbs inputs are never run together
+        """
+
+        names = ['Maximum_grainsize', 'Mass_eruption_rate', 'Wind_profile']
+        combinations = []
+        for grainsize in [4, 5]:
+            for mer in [1.0e6, 2.0e6]:
+                for wind in ['a.profile', 'b.profile']:
+                    combinations.append({'Maximum_grainsize': grainsize,
+                                         'Mass_eruption_rate': mer,
+                                         'Wind_profile': wind})
+
+        rounds = get_sweep_rounds(combinations, names)
+        assert len(rounds) == len(combinations)
+
+        # Grain size 4 with both winds and grain size 5 with wind a make
+        # new files. The last two share no files and run together.
+        assert rounds == [0, 1, 2, 2, 1, 2, 2, 2]
+
+        for r in range(max(rounds)):
+            members = [params for params, x in zip(combinations, rounds)
+                       if x == r]
+            for stage in ['granum', 'database']:
+                keys = [get_upstream_key(params, names, stage)
+                        for params in members]
+                assert len(keys) == len(set(keys))
+
+        # Nothing shared
+        names = ['Mass_eruption_rate']
+        combinations = [{'Mass_eruption_rate': x} for x in [1, 2, 3]]
+        assert get_sweep_rounds(combinations, names) == [0, 1, 1]
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_stages, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
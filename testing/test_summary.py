@@ -0,0 +1,73 @@
+import unittest
+import os
+import tempfile
+import shutil
+
+from aim.summary import *
+from test_hazard import write_result
+from Scientific.IO.NetCDF import NetCDFFile
+from numpy import allclose, zeros, percentile, abs
+from numpy.random import RandomState
+
+
+class Test_summary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_p2_quantile(self):
+        """test_p2_quantile - Test streaming percentiles against sorted data
+        """
+
+        random_state = RandomState(17)
+        data = random_state.normal(10, 2, (2000, 3, 4))
+
+        for p in [0.5, 0.9]:
+            sketch = P2Quantile(p, (3, 4))
+            for x in data:
+                sketch.add(x)
+
+            exact = percentile(data, 100*p, axis=0)
+            assert abs(sketch.get() - exact).max() < 0.2
+
+        # Few observations are interpolated exactly
+        sketch = P2Quantile(0.5, (1,))
+        for x in [3, 1, 2]:
+            sketch.add([x])
+        assert allclose(sketch.get(), 2)
+
+    def test_ensemble_summary(self):
+        """test_ensemble_summary - Test mean, maximum and percentile maps
+        """
+
+        filenames = []
+        for i in range(3):
+            load = zeros((2, 1, 2))
+            load[-1, 0, :] = [i, 10*i]
+            filename = os.path.join(self.tmpdir, 'member%i.res.nc' % i)
+            write_result(filename, load)
+            filenames.append(filename)
+
+        outputfilename = os.path.join(self.tmpdir, summary_filename)
+        compute_summary(filenames, outputfilename=outputfilename,
+                        verbose=False)
+
+        fid = NetCDFFile(outputfilename)
+        assert 'THICKNESS_MEAN' not in fid.variables
+        assert allclose(fid.variables['LOAD_MEAN'][:], [[[1, 10]]])
+        assert allclose(fid.variables['LOAD_MAX'][:], [[[2, 20]]])
+        assert allclose(fid.variables['LOAD_P50'][:], [[[1, 10]]])
+        assert allclose(fid.variables['LOAD_P90'][:], [[[1.8, 18]]])
+        assert allclose(fid.variables['LOAD_STD'][:], [[[0.8164966, 8.164966]]])
+        fid.close()
+
+
+################################################################################
+
+if __name__ == '__main__':
+    suite = unittest.makeSuite(Test_summary, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
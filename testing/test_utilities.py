@@ -1,9 +1,26 @@
 import unittest
 
+import os
+import tempfile
+import shutil
+import multiprocessing
+
 from aim.utilities import *
-from numpy import allclose
+from aim.utilities import _write_ascii
+from aim.wrapper import convert_ncgrids
+from test_hazard import write_result
+from numpy import allclose, arange, nan
 from math import sqrt
 
+def convert_in_worker(directory):
+    """Convert NetCDF results with parallel workers from inside a pool worker
+    """
+
+    convert_ncgrids(directory, ['LOAD'], workers=2, verbose=False)
+    return sorted([filename for filename in os.listdir(directory)
+                   if filename.endswith('.asc')])
+
+
 class Test_utilities(unittest.TestCase):
 
     def setUp(self):
@@ -121,7 +138,123 @@ class Test_utilities(unittest.TestCase):
             assert get_wind_direction(direction) == degrees, msg
             assert get_wind_direction('%s' % str(degrees)) == degrees
             degrees += 22.5
-        
+
+    def test_write_ascii(self):
+        """test_write_ascii - Test that block formatted ASCII grids match the cell by cell format
+        """
+
+        data = arange(35, dtype='f').reshape((5, 7))/3 - 4
+        data[2, 3] = nan
+        header = 'ncols 7\nnrows 5\n'
+
+        # Reference written one value at a time with rows upside down
+        reference = header
+        for j in range(5)[::-1]:
+            for i in range(7):
+                reference += '%f ' % data[j, i]
+            reference += '\n'
+
+        fd, filename = tempfile.mkstemp(suffix='.asc')
+        os.close(fd)
+        for block_size in [1, 10, 2**16]:
+            _write_ascii(header, data, filename, None, block_size=block_size)
+            assert open(filename).read() == reference
+
+        _write_ascii(header, data, filename, None, number_format='%g')
+        lines = open(filename).readlines()
+        assert lines[2].split()[:2] == ['5.33333', '5.66667']
+
+        # Extrema returned when writing match those read back
+        header = 'ncols 7\nnrows 5\nxllcorner 0\nyllcorner 0\ncellsize 1\nNODATA_value -9999\n'
+        data = arange(35, dtype='f').reshape((5, 7))/7 - 1
+        for number_format in ['%f', '%.2f', '%g']:
+            extrema = _write_ascii(header, data, filename, None,
+                                   number_format=number_format)
+            assert extrema == calculate_extrema(filename)
+
+        os.remove(filename)
+
+    def test_nc2asc_multiple(self):
+        """test_nc2asc_multiple - Test that one pass over several variables gives the single variable files
+        """
+
+        tmpdir = tempfile.mkdtemp()
+        ncfilename = os.path.join(tmpdir, 'merapi.res.nc')
+        load = arange(24).reshape((2, 3, 4))
+        write_result(ncfilename, load, concentration=load/10.0)
+
+        extrema = {}
+        filenames = nc2asc(ncfilename, ['LOAD', 'C_FL050'], extrema=extrema)
+        assert len(filenames) == 4
+        assert filenames[1] == os.path.join(tmpdir, 'merapi.01h.c_fl050.asc')
+
+        # Extrema of every grid without any files besides the grids
+        assert sorted(extrema.keys()) == sorted([os.path.basename(filename)
+                                                 for filename in filenames])
+        for filename in filenames:
+            assert extrema[os.path.basename(filename)] == calculate_extrema(filename)
+        assert len(os.listdir(tmpdir)) == 5
+
+        contents = {}
+        for filename in filenames:
+            contents[filename] = open(filename).read()
+
+        for subdataset in ['LOAD', 'C_FL050']:
+            for filename in nc2asc(ncfilename, subdataset):
+                assert open(filename).read() == contents[filename]
+
+        # Chunked reading with and without prefetching
+        for chunk_size in [1, 2, 5]:
+            for prefetch in [True, False]:
+                for filename in nc2asc(ncfilename, ['LOAD', 'C_FL050'],
+                                       chunk_size=chunk_size, prefetch=prefetch):
+                    assert open(filename).read() == contents[filename]
+
+        shutil.rmtree(tmpdir)
+
+    def test_convert_ncgrids_in_pool_worker(self):
+        """test_convert_ncgrids_in_pool_worker - Test parallel conversion from a daemonic ensemble worker
+        """
+
+        tmpdir = tempfile.mkdtemp()
+        write_result(os.path.join(tmpdir, 'merapi.res.nc'),
+                     arange(48).reshape((4, 3, 4)))
+
+        pool = multiprocessing.Pool(processes=1)
+        try:
+            filenames = pool.apply(convert_in_worker, (tmpdir,))
+        finally:
+            pool.close()
+            pool.join()
+
+        assert filenames == ['merapi.%02ih.load.asc' % hour for hour in range(1, 5)]
+        shutil.rmtree(tmpdir)
+
+    def test_nc2asc_time_range(self):
+        """test_nc2asc_time_range - Test that only time steps in range are written with chunked prefetching
+        """
+
+        tmpdir = tempfile.mkdtemp()
+        ncfilename = os.path.join(tmpdir, 'merapi.res.nc')
+        write_result(ncfilename, arange(60).reshape((5, 3, 4)))
+
+        for chunk_size in [1, 2, 4]:
+            for prefetch in [True, False]:
+                filenames = nc2asc(ncfilename, 'LOAD', time_range=(0, 3),
+                                   chunk_size=chunk_size, prefetch=prefetch)
+                hours = sorted([os.path.basename(filename).split('.')[1]
+                                for filename in filenames])
+                assert hours == ['01h', '02h', '03h']
+
+                written = [filename for filename in os.listdir(tmpdir)
+                           if filename.endswith('.asc')]
+                assert sorted(written) == ['merapi.%s.load.asc' % hour for hour in hours]
+
+                for filename in written:
+                    os.remove(os.path.join(tmpdir, filename))
+
+        shutil.rmtree(tmpdir)
+
 
 
 ################################################################################